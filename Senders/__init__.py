@@ -1,23 +1,58 @@
+from os import environ
+import ast
 import importlib
 import inspect
 import logging
+import os
 import pkgutil
 
 from Senders.base import BaseSender
 
+# Modules of the package that don't define senders.
+_SUPPORT_MODULES = {'base', 'transport'}
+
+
+def _required_env(module_name: str) -> tuple[str, ...] | None:
+    """
+    The module's `REQUIRED_ENV` constant, read from its source without
+    importing it, or None if it doesn't declare one.
+    """
+    path = os.path.join(__path__[0], f'{module_name}.py')
+    try:
+        with open(path, encoding='utf-8') as f:
+            tree = ast.parse(f.read(), path)
+    except OSError:
+        # Not a plain source file (e.g. a package), so it can only be imported.
+        return None
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == 'REQUIRED_ENV' for t in node.targets):
+            return tuple(ast.literal_eval(node.value))
+    return None
+
 
 def get_senders() -> list[BaseSender]:
-    """Discover and instantiate all enabled senders in the Senders package."""
+    """
+    Discover and instantiate all enabled senders in the Senders package.
+
+    Modules declaring `REQUIRED_ENV` are only imported when all those
+    variables are set, so unconfigured senders (and their dependencies)
+    cost nothing at startup.
+    """
     senders = []
 
     for finder, module_name, _ in pkgutil.iter_modules(__path__):
-        if module_name == 'base':
+        if module_name in _SUPPORT_MODULES:
+            continue
+
+        required = _required_env(module_name)
+        if required is not None and not all(name in environ for name in required):
+            logging.info(f'Sender module not loaded (not configured): {module_name}')
             continue
 
         module = importlib.import_module(f'{__name__}.{module_name}')
 
         for _, cls in inspect.getmembers(module, inspect.isclass):
-            if issubclass(cls, BaseSender) and cls is not BaseSender:
+            if issubclass(cls, BaseSender) and cls is not BaseSender and cls.__module__ == module.__name__:
                 if cls.enabled():
                     senders.append(cls())
                     logging.info(f'Sender enabled: {cls.__name__}')
@@ -1,15 +1,27 @@
-from email.message import Message
-from helpers.misc import retry
-from helpers.messages import *
-from Senders.base import BaseSender
+from helpers.messages import NotificationPayload
+from Senders.base import BaseSender, PermanentSendError, RetryableSendError
+from Senders.transport import get_transport
 from os import environ
 import requests
 import json
 import logging
 
+# Read by `get_senders` before importing this module.
+REQUIRED_ENV = ('BARK_TOKEN',)
+
 # Gmail https://img.butanediol.me/51/a9c92d6ec0446833c947e722628d0585f7e34d.png
 # iCloud https://img.butanediol.me/40/0ef6043445bc21886531ffce6ed97a8da8c143.png
 
+def _check_response(response: requests.Response):
+  """Raise the matching SendError for a failed Bark response."""
+  if response.ok:
+    return
+  error = f'Bark returned HTTP {response.status_code}: {response.text[:200]}'
+  if response.status_code == 429 or response.status_code >= 500:
+    retry_after = response.headers.get('Retry-After')
+    raise RetryableSendError(error, retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None)
+  raise PermanentSendError(error)
+
 class BarkSender(BaseSender):
 
   @classmethod
@@ -22,13 +34,13 @@ class BarkSender(BaseSender):
     self.__bark_group = environ.get('BARK_GROUP', 'Email')
     self.__bark_icon = environ.get('BARK_ICON', 'https://img.butanediol.me/99/f651c5840b88226f6aa5b9cd6398e85deed6e6.png')
     self.__sendMessageUrl = self.__bark_server + '/' + self.__bark_token
+    self.__transport = get_transport()
 
-  @retry(max_tries=20)
-  def send(self, message: Message):
-    content = get_email_summary(message=message)
-    title = extract_email_subject(message=message)
+  def send(self, payload: NotificationPayload):
+    content = payload.summary
+    title = payload.subject
     try:
-      requests.post(
+      response = self.__transport.post(
         url=self.__sendMessageUrl,
         headers={
             "Content-Type": "application/json; charset=utf-8",
@@ -40,6 +52,7 @@ class BarkSender(BaseSender):
             "icon": self.__bark_icon,
         }),
         )
-      logging.info(f'Bark: {title}')
-    except requests.exceptions.RequestException:
-      logging.error('HTTP Request failed')
\ No newline at end of file
+    except requests.exceptions.RequestException as e:
+      raise RetryableSendError(f'HTTP Request failed: {e}') from e
+    _check_response(response)
+    logging.info(f'Bark: {title}')
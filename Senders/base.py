@@ -1,8 +1,41 @@
 from abc import ABC, abstractmethod
-from email.message import Message
+from helpers.messages import NotificationPayload
+
+
+class SendError(Exception):
+    """Base class for errors a sender reports about a failed delivery."""
+
+
+class RetryableSendError(SendError):
+    """A delivery failed for a transient reason (network, rate limit, server error).
+
+    `retry_after` is the delay in seconds requested by the service, if any.
+    """
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class PermanentSendError(SendError):
+    """A delivery can never succeed as is (bad credentials, unknown chat, rejected payload)."""
 
 
 class BaseSender(ABC):
+    """A notification channel.
+
+    `send` (and `send_batch`) may be plain methods, which the dispatcher runs
+    on the sender's worker threads, or `async def` coroutines, which it runs
+    on a shared event loop, SENDER_WORKERS of them at a time. Coroutines
+    must not block: use an async HTTP client rather than `get_transport()`.
+
+    A module defining senders can declare the variables they need as a
+    module-level constant, e.g. `REQUIRED_ENV = ('MY_SENDER_TOKEN',)`, so the
+    module is only imported when they are all set.
+    """
+
+    # Most queued notifications passed to `send_batch` at once; 1 never calls it.
+    max_batch_size = 1
 
     @classmethod
     @abstractmethod
@@ -11,6 +44,26 @@ class BaseSender(ABC):
         pass
 
     @abstractmethod
-    def send(self, message: Message):
-        """Send notification for the given email message."""
+    def send(self, payload: NotificationPayload):
+        """Send notification for the given email.
+
+        The payload is shared with the other senders; read the fields you need
+        from it instead of parsing `payload.message` yourself (mails from a
+        mailbox arrive compacted, with only their headers left in `message`).
+
+        Raise PermanentSendError for failures that retrying cannot fix and
+        RetryableSendError (optionally with `retry_after`) for transient ones.
+        Any other exception is treated as retryable.
+        """
         pass
+
+    def send_batch(self, payloads: list[NotificationPayload]) -> list[Exception | None]:
+        """Send several notifications in one go, e.g. in a single API request.
+
+        Only called when `max_batch_size` is above 1, with up to that many of
+        the notifications already waiting in the queue (a single one still
+        goes through `send`). Either raise, which fails the whole batch, or
+        return one result per payload: None when delivered, or the exception
+        it failed with, classified as in `send`.
+        """
+        raise NotImplementedError(f'{type(self).__name__} sets max_batch_size but does not implement send_batch')
@@ -1,18 +1,44 @@
-from telebot import TeleBot
+from telebot import TeleBot, apihelper
+from telebot.apihelper import ApiTelegramException
 from telebot.types import MessageEntity
-from email.message import Message
-from helpers.misc import retry
-from helpers.messages import extract_email_attachment, extract_email_subject, get_email_summary
-from helpers.strings import extract_email_address
-from Senders.base import BaseSender
+from helpers.messages import Attachment, AttachmentTooLarge, NotificationPayload
+from helpers.metrics import Counter
+from helpers.misc import TokenBucket, backoff_delay
+from helpers.multipart import MultipartStream
+from helpers.upload_cache import UploadCache
+from Senders.base import BaseSender, PermanentSendError, RetryableSendError, SendError
+from Senders.transport import get_transport
 from os import environ
+from typing import IO, Callable, Iterator
+import hashlib
 import io
+import itertools
 import logging
 import re
+import requests
+import sqlite3
+import threading
+import time
+
+# Read by `get_senders` before importing this module.
+REQUIRED_ENV = ('TELEGRAM_BOT_TOKEN', 'TELEGRAM_CHAT_ID')
 
 # Telegram message limit
 _MAX_MESSAGE_LENGTH = 4096
 
+_MB = 1024 * 1024
+
+# 429s waited out in place before the delivery is handed back to the dispatcher,
+# so an attachment is retried on its own instead of resending the whole mail.
+_MAX_RATE_LIMITED_TRIES = 5
+
+# Attempts at fetching and at uploading an attachment. The text is out by then, so
+# a failed attachment is reported in the follow-up message rather than retried with the mail.
+_MAX_ATTACHMENT_TRIES = 3
+
+_RATE_LIMITED = Counter('mailbot_telegram_rate_limited_total', 'Bot API calls answered with 429 and waited out in place.')
+_FILE_CACHE = Counter('mailbot_telegram_file_cache_total', 'Attachments sent by file_id (hit) or uploaded (miss).', ('result',))
+
 # Patterns produced by html2text
 _MARKDOWN_LINK_RE = re.compile(r'\[([^\]]+)\]\(([^)]+)\)')
 _ANGLE_LINK_RE = re.compile(r'<(https?://[^>]+)>')
@@ -25,6 +51,14 @@ _ITALIC_RE = re.compile(r'(?<![*\w])_(.+?)_(?![*\w])')
 # strips them and extracts entity offsets — no cross-pass offset adjustment.
 _S = '\x00'
 _TAG_RE = re.compile(r'\x00([BE]\d+)\x00')
+_PARTIAL_TAG_RE = re.compile(r'\x00[BE]?\d*\Z')
+
+# The body is formatted lazily in slices of this many characters,
+# and only as far as the message can show.
+_SCAN_CHUNK = 2048
+
+# Characters that end a bare URL, as in _BARE_URL_RE.
+_URL_STOP = ')]>*\x00'
 
 
 def _utf16_len(text: str) -> int:
@@ -32,11 +66,91 @@ def _utf16_len(text: str) -> int:
   return len(text.encode('utf-16-le')) // 2
 
 
-def _process_body(body: str) -> tuple[str, list[MessageEntity]]:
+# Each frontier returns the first position at or after `pos` where a match of
+# its pattern could start and still depend on text not read yet. Matches that
+# start before it are final. Frontiers may err early, never late.
+
+def _markdown_link_frontier(text: str, pos: int) -> int:
+  # A '[' is decided once its ']' is followed by something other than '(', or by '(...)'.
+  last_paren = text.rfind(')')
+  bracket = text.find(']', max(last_paren - 1, 0))
+  previous = text.rfind(']', 0, bracket) if bracket != -1 else text.rfind(']')
+  start = text.find('[', max(pos, previous + 1))
+  return len(text) if start == -1 else start
+
+
+def _angle_link_frontier(text: str, pos: int) -> int:
+  # A '<' is decided once a '>' follows it.
+  start = text.find('<', max(pos, text.rfind('>') + 1))
+  return len(text) if start == -1 else start
+
+
+def _bare_url_frontier(text: str, pos: int) -> int:
+  # A URL runs up to the next whitespace or stop character.
+  end = len(text)
+  while end > pos and not (text[end - 1].isspace() or text[end - 1] in _URL_STOP):
+    end -= 1
+  return end
+
+
+def _bold_frontier(text: str, pos: int) -> int:
+  # An opening '**' is decided once another '**' follows it.
+  last = text.rfind('**')
+  return max(pos, last - 2 if last != -1 else len(text) - 1)
+
+
+def _italic_frontier(text: str, pos: int) -> int:
+  # Italics don't span lines.
+  start = text.find('_', max(pos, text.rfind('\n') + 1))
+  return len(text) if start == -1 else start
+
+
+def _substitute(chunks: Iterator[str], pattern: re.Pattern, replace: Callable[[re.Match], str],
+                frontier: Callable[[str, int], int]) -> Iterator[str]:
+  """
+  Lazily apply `pattern.sub(replace, text)` to text arriving in chunks.
+  Yields the same text as `sub` on the whole input, reading only as far as
+  needed to decide the matches before each yielded piece.
+  """
+  text = ''
+  pos = 0
+  exhausted = False
+  while True:
+    # Read at least as much as is still undecided, so rescans stay linear.
+    wanted, read = max(len(text) - pos, _SCAN_CHUNK), 0
+    while not exhausted and read < wanted:
+      chunk = next(chunks, None)
+      if chunk is None:
+        exhausted = True
+      else:
+        text += chunk
+        read += len(chunk)
+
+    decided = len(text) if exhausted else frontier(text, pos)
+    pieces = []
+    for match in pattern.finditer(text, pos):
+      if match.start() >= decided:
+        break
+      pieces += [text[pos:match.start()], replace(match)]
+      pos = match.end()
+    if pos < decided:
+      pieces.append(text[pos:decided])
+      pos = decided
+    yield ''.join(pieces)
+    if exhausted:
+      return
+    # Keep one character for the patterns' lookbehinds.
+    text, pos = text[pos - 1:] if pos else text, min(pos, 1)
+
+
+def _process_body(body: str, limit: int | None = None, offset: int = 0) -> tuple[str, list[MessageEntity]]:
   """Replace links and formatting markers in body with Telegram entities.
 
   Uses sentinel tokens so that all regex passes simply insert markers,
   and entity offsets are computed in one final scan of the result.
+  The passes are chained lazily, so with a `limit` (in UTF-16 units) the body
+  is only processed until the result is longer than that; the rest is dropped.
+  `offset` is added to the entity offsets.
   """
   meta: list[tuple[str, str | None]] = []  # indexed by entity id: (type, url)
 
@@ -51,29 +165,33 @@ def _process_body(body: str) -> tuple[str, list[MessageEntity]]:
       display = 'Link'
     return _mark(display, 'text_link', url)
 
+  chunks = (body[i:i + _SCAN_CHUNK] for i in range(0, len(body), _SCAN_CHUNK))
+
   # Replace links (markdown first, then angle brackets, then bare URLs)
-  text = _MARKDOWN_LINK_RE.sub(_md_link, body)
-  text = _ANGLE_LINK_RE.sub(lambda m: _mark('Link', 'text_link', m.group(1)), text)
-  text = _BARE_URL_RE.sub(lambda m: _mark('Link', 'text_link', m.group(1)), text)
+  chunks = _substitute(chunks, _MARKDOWN_LINK_RE, _md_link, _markdown_link_frontier)
+  chunks = _substitute(chunks, _ANGLE_LINK_RE, lambda m: _mark('Link', 'text_link', m.group(1)), _angle_link_frontier)
+  chunks = _substitute(chunks, _BARE_URL_RE, lambda m: _mark('Link', 'text_link', m.group(1)), _bare_url_frontier)
 
   # Replace formatting markers
-  text = _BOLD_RE.sub(lambda m: _mark(m.group(1), 'bold'), text)
-  text = _ITALIC_RE.sub(lambda m: _mark(m.group(1), 'italic'), text)
+  chunks = _substitute(chunks, _BOLD_RE, lambda m: _mark(m.group(1), 'bold'), _bold_frontier)
+  chunks = _substitute(chunks, _ITALIC_RE, lambda m: _mark(m.group(1), 'italic'), _italic_frontier)
 
   # Single scan: strip sentinel tags, build plain text + entities
-  parts = _TAG_RE.split(text)  # alternates: [text, tag, text, tag, ..., text]
   result_parts: list[str] = []
-  utf16_pos = 0
+  utf16_pos = offset
   open_ents: dict[int, int] = {}
   entities: list[MessageEntity] = []
-
-  for i, part in enumerate(parts):
-    if i % 2 == 0:
+  text = ''
+  for chunk in itertools.chain(chunks, (None,)):
+    if chunk is not None:
+      text += chunk
+    pos = 0
+    for tag in _TAG_RE.finditer(text):
+      part = text[pos:tag.start()]
       result_parts.append(part)
       utf16_pos += _utf16_len(part)
-    else:
-      eid = int(part[1:])
-      if part[0] == 'B':
+      eid = int(tag.group(1)[1:])
+      if tag.group(1)[0] == 'B':
         open_ents[eid] = utf16_pos
       else:
         start = open_ents.pop(eid)
@@ -81,27 +199,47 @@ def _process_body(body: str) -> tuple[str, list[MessageEntity]]:
         entities.append(MessageEntity(
           type=etype, offset=start, length=utf16_pos - start, url=url
         ))
+      pos = tag.end()
+    # The text may end with the beginning of a tag split across chunks.
+    partial = _PARTIAL_TAG_RE.search(text, pos) if chunk is not None else None
+    end = partial.start() if partial else -1
+    part = text[pos:] if end == -1 else text[pos:end]
+    result_parts.append(part)
+    utf16_pos += _utf16_len(part)
+    text = '' if end == -1 else text[end:]
+    if limit is not None and utf16_pos - offset > limit:
+      break
 
   return ''.join(result_parts), entities
 
 
+def _truncate(text: str, max_len: int) -> str:
+  """Return the longest prefix of text that fits in max_len UTF-16 units."""
+  units = 0
+  for i, char in enumerate(text):
+    units += 2 if ord(char) > 0xFFFF else 1
+    if units > max_len:
+      return text[:i]
+  return text
+
+
 def _build_message_with_entities(
   sender: str, to: str, subject: str, body: str
 ) -> tuple[str, list[MessageEntity]]:
   """Build plain text + entity list for a Telegram message."""
-  processed_body, body_entities = _process_body(body)
-
   header_line1 = f'{sender} → {to}'
   header_line2 = subject
-  text = f'{header_line1}\n{header_line2}\n\n{processed_body}'
+  header = f'{header_line1}\n{header_line2}\n\n'
+  header_offset = _utf16_len(header)
+
+  # Body entities are offset by the header; text past the limit is never formatted.
+  processed_body, body_entities = _process_body(body, limit=_MAX_MESSAGE_LENGTH - header_offset, offset=header_offset)
+  text = header + processed_body
 
   # Truncate if needed
-  if _utf16_len(text) > _MAX_MESSAGE_LENGTH:
+  if header_offset + _utf16_len(processed_body) > _MAX_MESSAGE_LENGTH:
     ellipsis = '...'
-    max_len = _MAX_MESSAGE_LENGTH - _utf16_len(ellipsis)
-    while _utf16_len(text) > max_len:
-      text = text[:-1]
-    text += ellipsis
+    text = _truncate(text, _MAX_MESSAGE_LENGTH - _utf16_len(ellipsis)) + ellipsis
 
   # Header bold entities
   entities: list[MessageEntity] = [
@@ -109,17 +247,73 @@ def _build_message_with_entities(
     MessageEntity(type='bold', offset=_utf16_len(header_line1) + 1, length=_utf16_len(header_line2)),
   ]
 
-  # Shift body entities by header length and keep those within bounds
-  header_offset = _utf16_len(f'{header_line1}\n{header_line2}\n\n')
+  # Keep the body entities within bounds
   text_utf16_len = _utf16_len(text)
   for ent in body_entities:
-    ent.offset += header_offset
     if ent.offset + ent.length <= text_utf16_len:
       entities.append(ent)
 
   return text, entities
 
 
+def _classify_error(e: ApiTelegramException) -> SendError:
+  """Map a Telegram API error to a retryable or permanent SendError."""
+  if e.error_code == 429:
+    retry_after = (e.result_json.get('parameters') or {}).get('retry_after')
+    return RetryableSendError(e.description, retry_after=retry_after)
+  if e.error_code >= 500:
+    return RetryableSendError(e.description)
+  # 400 bad request, 401 bad token, 403 bot blocked, 404 unknown chat...
+  return PermanentSendError(e.description)
+
+
+def _format_size(size: int | None) -> str:
+  return 'unknown size' if size is None else f'{size / _MB:.1f} MB'
+
+
+def _request(method, url, params=None, files=None, **kwargs):
+  """
+  Send Bot API requests through the shared transport, streaming uploads instead of building them in memory.
+  telebot's own timeouts and proxies are ignored in favour of the transport's.
+  """
+  if not files:
+    return get_transport().request(method, url, params=params)
+  body = MultipartStream(files)
+  return get_transport().request(method, url, params=params, data=body, headers={'Content-Type': body.content_type})
+
+
+class _RateLimiter:
+  """
+  Paces Bot API calls to stay under Telegram's limits: a global quota for the
+  bot and a quota per chat, which is lower for groups (negative chat ids).
+  Each call waits for its chat's bucket first and then for the global one,
+  so one busy chat doesn't hold global tokens while other chats could send.
+  """
+
+  def __init__(self, global_rate: float, chat_rate: float, group_rate: float):
+    self.__global = TokenBucket(global_rate, capacity=max(global_rate, 1))
+    self.__chat_rate = chat_rate
+    self.__group_rate = group_rate
+    self.__chats: dict[str, TokenBucket] = {}
+    self.__lock = threading.Lock()
+
+  def __chat(self, chat_id: str) -> TokenBucket:
+    with self.__lock:
+      if chat_id not in self.__chats:
+        is_group = str(chat_id).startswith('-')
+        self.__chats[chat_id] = TokenBucket(self.__group_rate if is_group else self.__chat_rate, capacity=3)
+      return self.__chats[chat_id]
+
+  def wait(self, chat_id: str):
+    """Block until a call to `chat_id` fits within both quotas."""
+    time.sleep(self.__chat(chat_id).reserve())
+    time.sleep(self.__global.reserve())
+
+  def pause(self, chat_id: str, seconds: float):
+    """Stop calls to `chat_id` for `seconds`, as asked by a 429 response."""
+    self.__chat(chat_id).pause(seconds)
+
+
 class TelegramSender(BaseSender):
 
   @classmethod
@@ -129,30 +323,194 @@ class TelegramSender(BaseSender):
   def __init__(self):
     self.__chat_id = environ['TELEGRAM_CHAT_ID']
     self.__bot = TeleBot(token=environ['TELEGRAM_BOT_TOKEN'])
+    self.__max_file_size = int(environ.get('TELEGRAM_MAX_FILE_SIZE_MB', '50')) * _MB
+    self.__max_attachments_size = int(environ.get('TELEGRAM_MAX_ATTACHMENTS_SIZE_MB', '100')) * _MB
+    self.__limiter = _RateLimiter(
+      global_rate=float(environ.get('TELEGRAM_GLOBAL_RATE', '30')),
+      chat_rate=float(environ.get('TELEGRAM_CHAT_RATE', '1')),
+      group_rate=float(environ.get('TELEGRAM_GROUP_RATE_PER_MINUTE', '20')) / 60,
+    )
+    cache_size = int(environ.get('TELEGRAM_FILE_CACHE_SIZE', '1000'))
+    # File ids are only valid for the bot that uploaded the file.
+    bot_id = environ['TELEGRAM_BOT_TOKEN'].split(':')[0]
+    self.__file_cache = UploadCache(environ.get('STATE_DB', 'state.db'), f'telegram:{bot_id}', cache_size) if cache_size > 0 else None
+    apihelper.CUSTOM_REQUEST_SENDER = _request
+    if environ.get('TELEGRAM_API_URL'):
+      # A self-hosted Bot API server, or a local stub in tests.
+      apihelper.API_URL = environ['TELEGRAM_API_URL'].rstrip('/') + '/bot{0}/{1}'
+
+  def __api(self, method, **kwargs):
+    """
+    Call a Bot API method once the rate limiter allows it. A 429 pauses the chat
+    for the `retry_after` Telegram asked for, then the call is tried again.
+    """
+    for attempt in range(1, _MAX_RATE_LIMITED_TRIES + 1):
+      self.__limiter.wait(self.__chat_id)
+      try:
+        return method(chat_id=self.__chat_id, **kwargs)
+      except ApiTelegramException as e:
+        retry_after = (e.result_json.get('parameters') or {}).get('retry_after') if e.error_code == 429 else None
+        if retry_after is None or attempt == _MAX_RATE_LIMITED_TRIES:
+          raise
+        logging.warning(f'Telegram rate limit hit, waiting {retry_after}s.')
+        _RATE_LIMITED.inc()
+        self.__limiter.pause(self.__chat_id, retry_after)
+        # A file may have been partly read by the failed upload.
+        document = kwargs.get('document')
+        if hasattr(document, 'seek'):
+          document.seek(0)
 
-  def _format_message(self, message: Message) -> tuple[str, str, str, str]:
-    """Extract and return (sender, to, subject, body) from email."""
-    sender = extract_email_address(message['From'])
-    to = extract_email_address(message['To'])
-    subject = extract_email_subject(message)
-    body = get_email_summary(message)
-    return sender, to, subject, body
-
-  @retry(max_tries=20)
-  def send(self, message: Message):
-    sender, to, subject, body = self._format_message(message)
-    text, entities = _build_message_with_entities(sender, to, subject, body)
-
-    self.__bot.send_message(
-      chat_id=self.__chat_id,
+  def send(self, payload: NotificationPayload):
+    try:
+      self._send(payload)
+    except ApiTelegramException as e:
+      raise _classify_error(e) from e
+    except requests.exceptions.RequestException as e:
+      raise RetryableSendError(f'HTTP Request failed: {e}') from e
+
+  def _send(self, payload: NotificationPayload):
+    sender, to = payload.sender, payload.to
+    text, entities = _build_message_with_entities(sender, to, payload.subject, payload.summary)
+
+    self.__api(
+      self.__bot.send_message,
       text=text,
       entities=entities,
       disable_web_page_preview=True
     )
     logging.info(f'Telegram: {sender} -> {to}')
 
-    for filename, file in extract_email_attachment(message):
-      bytes_io = io.BytesIO(file)
-      bytes_io.name = filename
-      self.__bot.send_document(chat_id=self.__chat_id, document=bytes_io)
-      logging.info(f'Telegram attachment: {filename}')
+    # From here on the text is out, so a failure must not retry the whole
+    # payload: that would send the text again on every attempt.
+    try:
+      self.__send_attachments(payload.attachments)
+    except Exception as e:
+      raise PermanentSendError(f'Text sent, but forwarding the attachments failed: {e}') from e
+
+  def __send_attachments(self, attachments: tuple[Attachment, ...]):
+    """
+    Forward the attachments, then list the ones that were left out: those over
+    the size limits, those that couldn't be fetched (e.g. the mail was moved
+    or deleted in the meantime), and those Telegram kept rejecting.
+    """
+    # Attachments are decoded and uploaded one at a time from spooled files,
+    # so memory use doesn't depend on how large or how many they are.
+    skipped: list[Attachment] = []
+    unavailable: list[Attachment] = []
+    rejected: list[Attachment] = []
+    budget = self.__max_attachments_size
+    for attachment in attachments:
+      limit = min(self.__max_file_size, budget)
+      if attachment.decoded_size is not None and attachment.decoded_size > limit:
+        skipped.append(attachment)
+        continue
+      try:
+        file = self.__open(attachment, limit)
+      except AttachmentTooLarge:
+        skipped.append(attachment)
+        continue
+      except Exception as e:
+        logging.warning(f'Unable to fetch attachment {attachment.filename}: {e}')
+        unavailable.append(attachment)
+        continue
+      with file:
+        budget -= file.seek(0, io.SEEK_END)
+        if not self.__upload(file, attachment.filename):
+          rejected.append(attachment)
+          continue
+      logging.info(f'Telegram attachment: {attachment.filename}')
+
+    notes = []
+    if skipped:
+      names = ', '.join(f'{a.filename} ({_format_size(a.decoded_size)})' for a in skipped)
+      notes.append(f'Attachments over the size limit were not forwarded: {names}')
+    if unavailable:
+      names = ', '.join(a.filename for a in unavailable)
+      notes.append(f'Attachments that could not be fetched from the mailbox were not forwarded: {names}')
+    if rejected:
+      names = ', '.join(a.filename for a in rejected)
+      notes.append(f'Attachments that could not be uploaded were not forwarded: {names}')
+    if notes:
+      self.__api(self.__bot.send_message, text='\n'.join(notes))
+      logging.info(f'Telegram skipped attachments: {"; ".join(notes)}')
+
+  @staticmethod
+  def __open(attachment: Attachment, limit: int) -> IO[bytes]:
+    """
+    Fetch and decode an attachment, retrying connection errors a few times.
+    A mail that is gone (LookupError) or too large is not retried.
+    """
+    for attempt in range(1, _MAX_ATTACHMENT_TRIES + 1):
+      try:
+        return attachment.open(limit=limit)
+      except (AttachmentTooLarge, LookupError):
+        raise
+      except Exception as e:
+        if attempt == _MAX_ATTACHMENT_TRIES:
+          raise
+        logging.warning(f'Attempt {attempt} to fetch attachment {attachment.filename} failed ({e}), retrying.')
+        time.sleep(backoff_delay(attempt))
+
+  def __upload(self, file: io.IOBase, filename: str) -> bool:
+    """
+    Send an attachment, retrying server and network errors a few times.
+    Returns False if it couldn't be sent.
+    """
+    for attempt in range(1, _MAX_ATTACHMENT_TRIES + 1):
+      file.seek(0)
+      try:
+        self.__send_document(file, filename)
+        return True
+      except ApiTelegramException as e:
+        error = _classify_error(e)
+      except requests.exceptions.RequestException as e:
+        error = RetryableSendError(f'HTTP Request failed: {e}')
+      if isinstance(error, PermanentSendError) or attempt == _MAX_ATTACHMENT_TRIES:
+        logging.error(f'Telegram: unable to send attachment {filename}: {error}')
+        return False
+      logging.warning(f'Telegram: attempt {attempt} to send attachment {filename} failed ({error}), retrying.')
+      time.sleep(error.retry_after or backoff_delay(attempt))
+
+  def __send_document(self, file: io.IOBase, filename: str):
+    """
+    Send a decoded attachment by the file_id of an earlier upload of the same
+    content and name, if there was one. Otherwise upload it and remember its file_id.
+    """
+    if self.__file_cache is None:
+      self.__api(self.__bot.send_document, document=file, visible_file_name=filename)
+      return
+
+    # A file_id keeps its original name, so the name is part of the key.
+    key = f'{hashlib.file_digest(file, "sha256").hexdigest()}:{filename}'
+    file.seek(0)
+    try:
+      file_id = self.__file_cache.get(key)
+    except sqlite3.Error as e:
+      logging.error(f'Error while reading the Telegram file cache: {e}')
+      file_id = None
+    if file_id is not None:
+      try:
+        self.__api(self.__bot.send_document, document=file_id)
+        _FILE_CACHE.inc(result='hit')
+        return
+      except ApiTelegramException as e:
+        if e.error_code != 400:
+          raise
+        # E.g. the file expired on Telegram's side; upload it again.
+        logging.info(f'Telegram no longer accepts the file_id of {filename}, uploading it: {e.description}')
+        self.__forget(key)
+
+    message = self.__api(self.__bot.send_document, document=file, visible_file_name=filename)
+    _FILE_CACHE.inc(result='miss')
+    if message is not None and message.document is not None:
+      try:
+        self.__file_cache.put(key, message.document.file_id)
+      except sqlite3.Error as e:
+        # The next copy is uploaded again, nothing worse.
+        logging.error(f'Error while writing the Telegram file cache: {e}')
+
+  def __forget(self, key: str):
+    try:
+      self.__file_cache.discard(key)
+    except sqlite3.Error as e:
+      logging.error(f'Error while writing the Telegram file cache: {e}')
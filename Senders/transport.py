@@ -0,0 +1,162 @@
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from helpers.metrics import Counter, Histogram
+
+_REQUEST_SECONDS = Histogram('mailbot_http_request_seconds', 'Duration of HTTP requests to sender services.', ('host',))
+_REQUEST_ERRORS = Counter('mailbot_http_errors_total', 'HTTP requests that failed or returned a 5xx status.', ('host',))
+
+
+class _Http2Response:
+    """Presents an httpx response with the `requests.Response` attributes senders and telebot use."""
+
+    def __init__(self, response):
+        self.__response = response
+        self.status_code = response.status_code
+        self.reason = response.reason_phrase
+        self.headers = response.headers
+        self.content = response.content
+        self.text = response.text
+        self.url = str(response.url)
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    def json(self, **kwargs):
+        return self.__response.json(**kwargs)
+
+
+class HttpTransport:
+    """Keep-alive HTTP client shared by all senders.
+
+    Connections are pooled per host, so a burst of notifications reuses a
+    handful of TLS connections instead of opening one per request, and every
+    request has connect/read timeouts so a hung service can't block a worker
+    forever. With `http2=True` requests go through httpx, which multiplexes
+    them over one connection per host; this needs `httpx[http2]` installed.
+
+    Failures are always raised as `requests.exceptions.RequestException`,
+    whichever client is used.
+    """
+
+    def __init__(self, connect_timeout: float = 5, read_timeout: float = 30, pool_size: int = 10, http2: bool = False):
+        self.__timeout = (connect_timeout, read_timeout)
+        self.__lock = threading.Lock()
+        self.__hosts: dict[str, dict[str, float]] = {}
+        self.__http2 = None
+        if http2:
+            try:
+                import httpx
+                import h2  # noqa: F401 (httpx needs it for HTTP/2)
+            except ImportError:
+                logging.warning('HTTP2 is enabled but httpx[http2] is not installed, using HTTP/1.1.')
+            else:
+                self.__httpx = httpx
+                self.__http2 = httpx.Client(
+                    http2=True,
+                    timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                    limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                )
+        # Retries are left to the dispatcher, which knows about backoff and Retry-After.
+        self.__adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.__session = requests.Session()
+        self.__session.mount('https://', self.__adapter)
+        self.__session.mount('http://', self.__adapter)
+
+    @classmethod
+    def from_env(cls) -> 'HttpTransport':
+        return cls(
+            connect_timeout=float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5')),
+            read_timeout=float(os.environ.get('HTTP_READ_TIMEOUT', '30')),
+            pool_size=int(os.environ.get('HTTP_POOL_SIZE', '10')),
+            http2=os.environ.get('HTTP2', 'false').lower() == 'true',
+        )
+
+    def request(self, method: str, url: str, *, params=None, data=None, json=None, headers=None):
+        """Send a request over a pooled connection.
+
+        `data` may be bytes, a str, a dict of form fields, or a stream with
+        `__len__` and `__iter__` (such as `MultipartStream`), which is uploaded
+        without being read into memory.
+        """
+        host = urlsplit(url).netloc
+        start = time.monotonic()
+        failed = True
+        try:
+            if self.__http2 is not None:
+                response = self.__request_http2(method, url, params, data, json, headers)
+            else:
+                response = self.__session.request(
+                    method, url, params=params, data=data, json=json, headers=headers, timeout=self.__timeout)
+            failed = response.status_code >= 500
+            return response
+        finally:
+            self.__record(host, time.monotonic() - start, failed)
+
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def __request_http2(self, method, url, params, data, json, headers):
+        httpx = self.__httpx
+        kwargs = {'params': params, 'json': json, 'headers': dict(headers or {})}
+        if isinstance(data, dict):
+            kwargs['data'] = data
+        elif data is not None:
+            kwargs['content'] = data
+            if hasattr(data, '__len__') and not isinstance(data, (bytes, str)):
+                kwargs['headers']['Content-Length'] = str(len(data))
+        try:
+            return _Http2Response(self.__http2.request(method, url, **kwargs))
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+
+    def __record(self, host: str, seconds: float, failed: bool):
+        _REQUEST_SECONDS.observe(seconds, host=host)
+        if failed:
+            _REQUEST_ERRORS.inc(host=host)
+        with self.__lock:
+            stats = self.__hosts.setdefault(host, {'requests': 0, 'errors': 0, 'seconds': 0.0})
+            stats['requests'] += 1
+            stats['errors'] += failed
+            stats['seconds'] += seconds
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Per-host counters: requests sent, errors (network or HTTP 5xx), total
+        seconds spent, and for HTTP/1.1 the connections opened so far and idle now.
+        """
+        with self.__lock:
+            result = {host: dict(stats) for host, stats in self.__hosts.items()}
+        if self.__http2 is None:
+            pools = self.__adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                default_port = 443 if pool.scheme == 'https' else 80
+                host = pool.host if pool.port in (None, default_port) else f'{pool.host}:{pool.port}'
+                stats = result.setdefault(host, {'requests': 0, 'errors': 0, 'seconds': 0.0})
+                stats['connections'] = stats.get('connections', 0) + pool.num_connections
+                stats['idle'] = stats.get('idle', 0) + sum(conn is not None for conn in list(pool.pool.queue))
+        return result
+
+
+_transport: HttpTransport | None = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> HttpTransport:
+    """Return the process-wide transport, created from the environment on first use."""
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = HttpTransport.from_env()
+        return _transport
@@ -0,0 +1,79 @@
+from typing import Callable
+import logging
+import threading
+
+from helpers.messages import DigestPayload, NotificationPayload
+from helpers.misc import RetryScheduler
+
+# How mails are grouped into digests.
+_GROUP_KEYS: dict[str, Callable[[NotificationPayload], object]] = {
+  'sender': lambda payload: payload.sender,
+  'thread': lambda payload: payload.thread_id,
+  'batch': lambda payload: None,
+}
+
+class Coalescer:
+  """
+  Groups mails that arrive close together into one digest notification.
+
+  The first mail of a group opens a window of `window` seconds; every mail with
+  the same key arriving in that window joins the group, which is then handed to
+  `submit` as a single `DigestPayload` (or as is, if it holds one mail). A group
+  that reaches `max_mails` is sent right away.
+
+  Args:
+    submit (Callable[[NotificationPayload], None]): Where payloads go next, e.g. `Dispatcher.submit`.
+    window (float): Seconds to wait for more mails after the first one of a group.
+    group_by (str): `sender`, `thread` (References/In-Reply-To) or `batch` (everything).
+    max_mails (int): Send a group early once it holds this many mails.
+    max_length (int): Maximum length of a digest's text.
+  """
+
+  def __init__(self, submit: Callable[[NotificationPayload], None], window: float, group_by: str = 'sender',
+               max_mails: int = 100, max_length: int = 4096):
+    if group_by not in _GROUP_KEYS:
+      raise ValueError(f'Unknown digest grouping {group_by!r}, expected one of {", ".join(_GROUP_KEYS)}.')
+    self.__submit = submit
+    self.__window = window
+    self.__key = _GROUP_KEYS[group_by]
+    self.__max_mails = max_mails
+    self.__max_length = max_length
+    self.__groups: dict[object, list[NotificationPayload]] = {}
+    self.__lock = threading.Lock()
+    # Flushes run on their own thread, so a full sender queue only delays digests.
+    self.__scheduler = RetryScheduler()
+
+  def add(self, payload: NotificationPayload):
+    """
+    Add a mail to its group, opening a new window if it is the first one.
+    """
+    # Mails routed to different senders never share a digest.
+    key = (payload.senders, self.__key(payload))
+    with self.__lock:
+      group = self.__groups.get(key)
+      if group is None:
+        group = self.__groups[key] = []
+        self.__scheduler.schedule(self.__window, lambda: self.__flush(key, group))
+      group.append(payload)
+      full = len(group) >= self.__max_mails
+    if full:
+      self.__flush(key, group)
+
+  def pending(self) -> int:
+    """
+    Number of mails waiting for their window to close.
+    """
+    with self.__lock:
+      return sum(len(group) for group in self.__groups.values())
+
+  def __flush(self, key: object, group: list[NotificationPayload]):
+    with self.__lock:
+      # The group may have been sent already because it was full.
+      if self.__groups.get(key) is not group:
+        return
+      del self.__groups[key]
+    if len(group) == 1:
+      self.__submit(group[0])
+    else:
+      logging.info(f'Sending {len(group)} mails as one digest.')
+      self.__submit(DigestPayload(group, max_length=self.__max_length))
@@ -0,0 +1,154 @@
+from dataclasses import dataclass
+from os import environ
+import tomllib
+
+# Example MAILBOXES_CONFIG file:
+#
+#   [[accounts]]
+#   server = "imap.gmail.com"
+#   username = "alice@gmail.com"
+#   password_env = "ALICE_PASSWORD"   # or: password = "..."
+#   folders = ["INBOX", "Work"]
+#   port = 993                        # optional, 143 when ssl = false
+#
+#   [[accounts]]
+#   server = "imap.mail.me.com"
+#   username = "bob"
+#   password_env = "BOB_PASSWORD"
+#   remains_unread = false
+#
+# Without MAILBOXES_CONFIG, a single account is read from the IMAP_MAIL_* variables.
+#
+# Example RULES_CONFIG file, checked in order until a rule matches:
+#
+#   [[rules]]
+#   list_id = ["*"]                   # any mailing list
+#   from = ["@github.com"]            # an address, or a whole domain
+#   action = "drop"
+#
+#   [[rules]]
+#   subject = ["invoice", "^urgent"]  # regular expressions, ignoring case
+#   senders = ["Telegram"]
+
+
+@dataclass(frozen=True)
+class AccountConfig:
+  server: str
+  username: str
+  password: str
+  folders: tuple[str, ...] = ('INBOX',)
+  remains_unread: bool = True
+  idle: bool = True
+  port: int | None = None
+  ssl: bool = True
+
+
+@dataclass(frozen=True)
+class RuleConfig:
+  """
+  Where matching mails go: nowhere when `drop` is set, otherwise only to
+  `senders`. Every given condition must match, and a condition matches when
+  any of its values does.
+  """
+  from_addresses: tuple[str, ...] = ()
+  to_addresses: tuple[str, ...] = ()
+  subjects: tuple[str, ...] = ()
+  list_ids: tuple[str, ...] = ()
+  drop: bool = False
+  senders: tuple[str, ...] = ()
+
+
+def _env_flag(name: str, default: str = 'true') -> bool:
+  return environ.get(name, default).lower() == 'true'
+
+
+def load_accounts() -> list[AccountConfig]:
+  """
+  Load the accounts to monitor.
+
+  Returns:
+    list[AccountConfig]: Accounts from the TOML file named by MAILBOXES_CONFIG,
+      or the single account described by the IMAP_MAIL_* variables.
+
+  Raises:
+    KeyError: If a required setting or referenced password variable is missing.
+    ValueError: If the config file lists no accounts.
+  """
+  remains_unread = _env_flag('IMAP_MAIL_REMAINS_UNREAD')
+  idle = _env_flag('IMAP_IDLE')
+  ssl = _env_flag('IMAP_MAIL_SSL')
+
+  path = environ.get('MAILBOXES_CONFIG')
+  if not path:
+    return [AccountConfig(
+      server=environ['IMAP_MAIL_SERVER'],
+      username=environ['IMAP_MAIL_USERNAME'],
+      password=environ['IMAP_MAIL_PASSWORD'],
+      folders=(environ.get('IMAP_MAIL_FOLDER', 'INBOX'),),
+      remains_unread=remains_unread,
+      idle=idle,
+      port=int(environ['IMAP_MAIL_PORT']) if environ.get('IMAP_MAIL_PORT') else None,
+      ssl=ssl,
+    )]
+
+  with open(path, 'rb') as f:
+    config = tomllib.load(f)
+
+  accounts = []
+  for account in config.get('accounts', []):
+    password = account['password'] if 'password' in account else environ[account['password_env']]
+    accounts.append(AccountConfig(
+      server=account['server'],
+      username=account['username'],
+      password=password,
+      folders=tuple(account.get('folders', ['INBOX'])),
+      remains_unread=account.get('remains_unread', remains_unread),
+      idle=account.get('idle', idle),
+      port=account.get('port'),
+      ssl=account.get('ssl', ssl),
+    ))
+
+  if not accounts:
+    raise ValueError(f'No accounts configured in {path}')
+  return accounts
+
+
+def _strings(rule: dict, key: str) -> tuple[str, ...]:
+  value = rule.get(key, [])
+  return (value,) if isinstance(value, str) else tuple(value)
+
+
+def load_rules() -> list[RuleConfig]:
+  """
+  Load the routing rules from the TOML file named by RULES_CONFIG.
+
+  Returns:
+    list[RuleConfig]: The rules in order, none without RULES_CONFIG.
+
+  Raises:
+    ValueError: If a rule has an unknown action, or neither drops mail nor names senders.
+  """
+  path = environ.get('RULES_CONFIG')
+  if not path:
+    return []
+
+  with open(path, 'rb') as f:
+    config = tomllib.load(f)
+
+  rules = []
+  for number, rule in enumerate(config.get('rules', []), 1):
+    action = rule.get('action', 'deliver')
+    if action not in ('deliver', 'drop'):
+      raise ValueError(f'Rule {number} in {path}: unknown action {action!r}, expected "deliver" or "drop".')
+    senders = _strings(rule, 'senders')
+    if action == 'deliver' and not senders:
+      raise ValueError(f'Rule {number} in {path}: set `senders`, or `action = "drop"`.')
+    rules.append(RuleConfig(
+      from_addresses=_strings(rule, 'from'),
+      to_addresses=_strings(rule, 'to'),
+      subjects=_strings(rule, 'subject'),
+      list_ids=_strings(rule, 'list_id'),
+      drop=action == 'drop',
+      senders=senders,
+    ))
+  return rules
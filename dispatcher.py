@@ -0,0 +1,315 @@
+from concurrent.futures import Future
+from typing import Callable
+import asyncio
+import inspect
+import logging
+import queue
+import threading
+import time
+
+from helpers.messages import NotificationPayload
+from helpers.outbox import Outbox, outbox_entries
+from helpers.metrics import Counter, Gauge, Histogram
+from helpers.misc import RetryScheduler, backoff_delay
+from Senders.base import BaseSender, PermanentSendError, RetryableSendError
+
+_SEND_SECONDS = Histogram('mailbot_send_seconds', 'Duration of delivery attempts, including formatting.', ('sender', 'result'))
+_DELIVERIES = Counter('mailbot_deliveries_total', 'Mails delivered or given up on.', ('sender', 'result'))
+_RETRIES = Counter('mailbot_send_retries_total', 'Failed delivery attempts that were scheduled for retry.', ('sender',))
+_QUEUE_DEPTH = Gauge('mailbot_sender_queue_depth', 'Deliveries waiting in a sender queue.', ('sender',))
+_PARKED = Gauge('mailbot_sender_parked', 'Deliveries waiting for a retry.', ('sender',))
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+def _event_loop() -> asyncio.AbstractEventLoop:
+  """
+  The event loop async senders run on, started on its own thread on first use.
+  """
+  global _loop
+  with _loop_lock:
+    if _loop is None:
+      _loop = asyncio.new_event_loop()
+      threading.Thread(target=_loop.run_forever, name='async-senders', daemon=True).start()
+    return _loop
+
+
+class _Delivery:
+  """
+  A mail waiting to be sent through one channel, with its failed attempts so far
+  and its outbox keys.
+  """
+  __slots__ = ('payload', 'keys', 'attempt')
+
+  def __init__(self, payload: NotificationPayload, keys: tuple[str, ...] = (), attempt: int = 0):
+    self.payload = payload
+    self.keys = keys
+    self.attempt = attempt
+
+
+class _SenderChannel:
+  """
+  A bounded queue and its worker threads for one sender.
+  Failed deliveries are parked on the retry scheduler instead of blocking a worker.
+
+  Plain senders are called on the worker threads. Async senders are called on
+  the shared event loop, up to `workers` at a time. Senders with a
+  `max_batch_size` get the deliveries waiting in the queue together.
+  """
+
+  def __init__(self, sender: BaseSender, queue_size: int, workers: int, scheduler: RetryScheduler,
+               max_tries: int, retry_base: float, retry_max: float, outbox: Outbox | None):
+    self.sender = sender
+    self.name = sender.__class__.__name__
+    self.queue: queue.Queue[_Delivery] = queue.Queue(maxsize=queue_size)
+    self.delivered = 0
+    self.failed = 0
+    self.blocked = 0
+    self.retries = 0
+    self.parked = 0
+    self.__lock = threading.Lock()
+    self.__scheduler = scheduler
+    self.__max_tries = max_tries
+    self.__retry_base = retry_base
+    self.__retry_max = retry_max
+    self.__outbox = outbox
+    # Outbox keys queued or parked here, so a mail fetched twice isn't queued twice.
+    self.__in_flight: set[str] = set()
+    self.__batch_size = max(sender.max_batch_size, 1)
+    self.__async = inspect.iscoroutinefunction(sender.send) or (
+      self.__batch_size > 1 and inspect.iscoroutinefunction(sender.send_batch))
+    if self.__async:
+      # One thread feeds the event loop, which runs up to `workers` sends at once.
+      self.__slots = threading.BoundedSemaphore(workers)
+      workers = 1
+    for i in range(workers):
+      threading.Thread(target=self.__work, name=f'{self.name}-{i}', daemon=True).start()
+
+  def put(self, payload: NotificationPayload, keys: tuple[str, ...] = ()):
+    with self.__lock:
+      if keys and self.__in_flight.issuperset(keys):
+        return
+      self.__in_flight.update(keys)
+    delivery = _Delivery(payload, keys)
+    try:
+      self.queue.put_nowait(delivery)
+    except queue.Full:
+      # Backpressure: the producer waits until the channel catches up.
+      with self.__lock:
+        self.blocked += 1
+      logging.warning(f'{self.name} queue is full ({self.queue.maxsize}), waiting for it to drain.')
+      self.queue.put(delivery)
+    _QUEUE_DEPTH.set(self.queue.qsize(), sender=self.name)
+
+  def __requeue(self, delivery: _Delivery):
+    """
+    Called by the scheduler when a retry is due. Never blocks the scheduler:
+    if the queue is full, the retry is parked a little longer.
+    """
+    try:
+      self.queue.put_nowait(delivery)
+    except queue.Full:
+      self.__scheduler.schedule(self.__retry_base, lambda: self.__requeue(delivery))
+      return
+    with self.__lock:
+      self.parked -= 1
+      _PARKED.set(self.parked, sender=self.name)
+
+  def __work(self):
+    while True:
+      if self.__async:
+        # The slot is freed once the coroutine is done, so at most `workers` run at once.
+        self.__slots.acquire()
+      deliveries = self.__take()
+      _QUEUE_DEPTH.set(self.queue.qsize(), sender=self.name)
+      start = time.perf_counter()
+      if self.__async:
+        future = asyncio.run_coroutine_threadsafe(self.__send_async([d.payload for d in deliveries]), _event_loop())
+        future.add_done_callback(lambda f, deliveries=deliveries, start=start: self.__done(deliveries, f, start))
+      else:
+        self.__finish(deliveries, self.__send([d.payload for d in deliveries]), start)
+
+  def __take(self) -> list[_Delivery]:
+    """
+    Wait for a delivery, then add whatever else is already queued, up to the sender's batch size.
+    """
+    deliveries = [self.queue.get()]
+    while len(deliveries) < self.__batch_size:
+      try:
+        deliveries.append(self.queue.get_nowait())
+      except queue.Empty:
+        break
+    return deliveries
+
+  def __send(self, payloads: list[NotificationPayload]) -> list[Exception | None]:
+    try:
+      if len(payloads) == 1:
+        self.sender.send(payloads[0])
+        return [None]
+      return self.__check_results(payloads, self.sender.send_batch(payloads))
+    except Exception as e:
+      return [e] * len(payloads)
+
+  async def __send_async(self, payloads: list[NotificationPayload]) -> list[Exception | None]:
+    try:
+      if len(payloads) == 1:
+        await self.__call(self.sender.send, payloads[0])
+        return [None]
+      return self.__check_results(payloads, await self.__call(self.sender.send_batch, payloads))
+    except Exception as e:
+      return [e] * len(payloads)
+
+  @staticmethod
+  async def __call(hook: Callable, *args):
+    """
+      Await a coroutine hook, or run a plain one on a worker thread: either
+      hook may be the plain one (e.g. an async `send_batch` next to a plain
+      `send`), and a blocking call on the loop would stall every async sender.
+    """
+    if inspect.iscoroutinefunction(hook):
+      return await hook(*args)
+    return await asyncio.to_thread(hook, *args)
+
+  def __check_results(self, payloads: list[NotificationPayload], results: list[Exception | None]) -> list[Exception | None]:
+    if len(results) != len(payloads):
+      raise ValueError(f'{self.name}.send_batch returned {len(results)} results for {len(payloads)} notifications')
+    return list(results)
+
+  def __done(self, deliveries: list[_Delivery], future: Future, start: float):
+    """
+    Called on the event loop when an async send is over.
+    """
+    self.__slots.release()
+    try:
+      results = future.result()
+    except BaseException as e:
+      # Only when the loop itself gave up on the coroutine.
+      results = [RetryableSendError(f'Send was cancelled: {e!r}')] * len(deliveries)
+    self.__finish(deliveries, results, start)
+
+  def __finish(self, deliveries: list[_Delivery], results: list[Exception | None], start: float):
+    elapsed = time.perf_counter() - start
+    for delivery, error in zip(deliveries, results):
+      try:
+        if error is None:
+          _SEND_SECONDS.observe(elapsed, sender=self.name, result='ok')
+          self.__delivered(delivery)
+        else:
+          _SEND_SECONDS.observe(elapsed, sender=self.name, result='error')
+          self.__failed(delivery, error)
+      finally:
+        self.queue.task_done()
+
+  def __delivered(self, delivery: _Delivery):
+    _DELIVERIES.inc(sender=self.name, result='delivered')
+    with self.__lock:
+      self.delivered += 1
+      self.__in_flight.difference_update(delivery.keys)
+    if self.__outbox is not None:
+      self.__outbox.delivered(delivery.keys, self.name)
+
+  def __failed(self, delivery: _Delivery, error: Exception):
+    delivery.attempt += 1
+    final = isinstance(error, PermanentSendError) or delivery.attempt >= self.__max_tries
+    if self.__outbox is not None:
+      self.__outbox.failed(delivery.keys, self.name, str(error), final)
+    if final:
+      with self.__lock:
+        self.failed += 1
+        self.__in_flight.difference_update(delivery.keys)
+      _DELIVERIES.inc(sender=self.name, result='failed')
+      logging.error(f'{self.name}: giving up after {delivery.attempt} attempt(s): {error}')
+      return
+
+    retry_after = error.retry_after if isinstance(error, RetryableSendError) else None
+    delay = retry_after if retry_after is not None else backoff_delay(delivery.attempt, self.__retry_base, self.__retry_max)
+    with self.__lock:
+      self.retries += 1
+      self.parked += 1
+      _PARKED.set(self.parked, sender=self.name)
+    _RETRIES.inc(sender=self.name)
+    logging.warning(f'{self.name}: attempt {delivery.attempt} failed ({error}), retrying in {delay:.1f}s.')
+    self.__scheduler.schedule(delay, lambda: self.__requeue(delivery))
+
+
+class Dispatcher:
+  """
+  Fans mails out to every sender through a separate bounded queue per sender,
+  so a slow or failing channel neither delays the others nor stalls fetching
+  (until its own queue is full, at which point `submit` blocks).
+
+  Transient failures are retried with exponential backoff and jitter (or after
+  the delay the service asked for); permanent failures are dropped right away.
+
+  With an `Outbox`, every delivery is recorded before it is queued and its
+  result afterwards, so unfinished deliveries survive a restart, and mails
+  some sender already delivered are not sent through it again.
+  """
+
+  def __init__(self, senders: list[BaseSender], queue_size: int = 1000, workers: int = 1,
+               max_tries: int = 20, retry_base: float = 1, retry_max: float = 300, outbox: Outbox | None = None):
+    self.__scheduler = RetryScheduler()
+    self.__outbox = outbox
+    self.__channels = [
+      _SenderChannel(sender, queue_size, workers, self.__scheduler, max_tries, retry_base, retry_max, outbox)
+      for sender in senders
+    ]
+
+  def record(self, payload: NotificationPayload) -> bool:
+    """
+    Record a mail in the outbox ahead of `submit`, e.g. while it waits to join a digest.
+    Returns False when every sender has already delivered it.
+    """
+    return bool(self.__pending_senders(payload)[1])
+
+  def submit(self, payload: NotificationPayload):
+    """
+    Queue a mail for every sender it is routed to that hasn't delivered it yet. Blocks only
+    while a sender's queue is full. All senders share the payload, so the mail
+    is parsed only once.
+    """
+    keys, wanted = self.__pending_senders(payload)
+    if not wanted:
+      if keys:
+        logging.info(f'Skipping already notified mail: {payload.subject}')
+      return
+    for channel in self.__channels:
+      if channel.name in wanted:
+        channel.put(payload, keys)
+
+  def __pending_senders(self, payload: NotificationPayload) -> tuple[tuple[str, ...], set[str]]:
+    """
+    The mail's outbox keys, and the senders that still have to deliver it.
+    """
+    names = {channel.name for channel in self.__channels}
+    if payload.senders is not None:
+      names &= payload.senders
+    entries = outbox_entries(payload) if self.__outbox is not None else []
+    if not entries or not names:
+      return (), names
+    return tuple(entry.key for entry in entries), self.__outbox.add(entries, names)
+
+  def stats(self) -> dict[str, dict[str, int]]:
+    """
+    Per-sender queue depth, capacity, deliveries parked for retry and delivery counters.
+    """
+    return {
+      channel.name: {
+        'depth': channel.queue.qsize(),
+        'capacity': channel.queue.maxsize,
+        'delivered': channel.delivered,
+        'failed': channel.failed,
+        'retries': channel.retries,
+        'parked': channel.parked,
+        'blocked': channel.blocked,
+      }
+      for channel in self.__channels
+    }
+
+  def join(self):
+    """
+    Wait until every queued mail has been handled (retries still parked are not waited for).
+    """
+    for channel in self.__channels:
+      channel.queue.join()
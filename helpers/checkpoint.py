@@ -0,0 +1,47 @@
+import sqlite3
+import threading
+
+class CheckpointStore:
+  """
+  Durable record of the last processed UID per server/user/folder.
+
+  Backed by SQLite in WAL mode, so each save is a single atomic upsert
+  that does not have to rewrite the whole file.
+  """
+
+  def __init__(self, path: str):
+    self.__lock = threading.Lock()
+    self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self.__db.execute('PRAGMA journal_mode=WAL')
+    self.__db.execute('PRAGMA synchronous=NORMAL')
+    self.__db.execute(
+      'CREATE TABLE IF NOT EXISTS checkpoints ('
+      ' server TEXT NOT NULL,'
+      ' username TEXT NOT NULL,'
+      ' folder TEXT NOT NULL,'
+      ' uidvalidity INTEGER,'
+      ' last_uid INTEGER NOT NULL,'
+      ' PRIMARY KEY (server, username, folder))'
+    )
+
+  def load(self, server: str, username: str, folder: str) -> tuple[int | None, int] | None:
+    """
+    Return the stored (uidvalidity, last_uid) for a folder, or None if it was never saved.
+    """
+    with self.__lock:
+      row = self.__db.execute(
+        'SELECT uidvalidity, last_uid FROM checkpoints WHERE server = ? AND username = ? AND folder = ?',
+        (server, username, folder),
+      ).fetchone()
+    return row
+
+  def save(self, server: str, username: str, folder: str, uidvalidity: int | None, last_uid: int):
+    """
+    Record the last processed UID of a folder.
+    """
+    with self.__lock:
+      self.__db.execute(
+        'INSERT INTO checkpoints (server, username, folder, uidvalidity, last_uid) VALUES (?, ?, ?, ?, ?)'
+        ' ON CONFLICT (server, username, folder) DO UPDATE SET uidvalidity = excluded.uidvalidity, last_uid = excluded.last_uid',
+        (server, username, folder, uidvalidity, last_uid),
+      )
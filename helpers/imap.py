@@ -0,0 +1,196 @@
+from email.message import Message
+import re
+
+# Tokens of an IMAP response line: parentheses, quoted strings, a literal
+# marker ending the line, and atoms. Atoms may contain a bracketed section
+# with spaces, e.g. `BODY[HEADER.FIELDS (FROM TO)]<0>`.
+_TOKEN_RE = re.compile(
+  rb'\s*(?:(?P<open>\()|(?P<close>\))|"(?P<quoted>(?:[^"\\]|\\.)*)"|(?P<literal>\{\d+\+?\})$'
+  rb'|(?P<atom>[^\s()"\[\]]*\[[^\]]*\][^\s()]*|[^\s()"\[\]]+))'
+)
+_QUOTED_ESCAPE_RE = re.compile(rb'\\(.)')
+
+
+def _split_responses(data: list) -> list[list[tuple[bool, bytes]]]:
+  """
+  Group imaplib's FETCH data into responses.
+  A response with literals arrives as (line, literal) tuples followed by the rest
+  of the line as bytes; one without literals is a single bytes item.
+  Each response becomes a list of (is_literal, bytes) segments.
+  """
+  responses: list[list[tuple[bool, bytes]]] = []
+  current: list[tuple[bool, bytes]] = []
+  for item in data:
+    if item is None:
+      continue
+    if isinstance(item, tuple):
+      current += [(False, item[0]), (True, item[1])]
+    else:
+      current.append((False, item))
+      responses.append(current)
+      current = []
+  if current:
+    responses.append(current)
+  return responses
+
+
+def _tokenize(segments: list[tuple[bool, bytes]]) -> list:
+  """
+  Parse a response into nested lists. Atoms and strings are bytes, NIL is None.
+  """
+  root: list = []
+  stack = [root]
+  for is_literal, segment in segments:
+    if is_literal:
+      stack[-1].append(segment)
+      continue
+    pos = 0
+    while pos < len(segment):
+      match = _TOKEN_RE.match(segment, pos)
+      if not match or match.end() == pos:
+        break
+      pos = match.end()
+      if match['open']:
+        stack.append([])
+        stack[-2].append(stack[-1])
+      elif match['close']:
+        if len(stack) > 1:
+          stack.pop()
+      elif match['quoted'] is not None:
+        stack[-1].append(_QUOTED_ESCAPE_RE.sub(rb'\1', match['quoted']))
+      elif match['atom']:
+        stack[-1].append(None if match['atom'].upper() == b'NIL' else match['atom'])
+      # A literal marker is followed by the literal segment itself.
+  return root
+
+
+def parse_fetch_response(data: list) -> list[dict[str, object]]:
+  """
+  Parse the data of a FETCH command into one dict per message.
+
+  Args:
+    data (list): The data returned by `imaplib.IMAP4.uid('FETCH', ...)`.
+
+  Returns:
+    list[dict[str, object]]: Fetched items keyed by upper-cased name
+      (e.g. `UID`, `BODYSTRUCTURE`, `BODY[HEADER]`), with values as bytes,
+      None for NIL, or nested lists.
+  """
+  messages = []
+  for segments in _split_responses(data):
+    tokens = _tokenize(segments)
+    # "<seq> (<name> <value> <name> <value> ...)"
+    items = next((token for token in tokens if isinstance(token, list)), [])
+    messages.append({
+      items[i].decode().upper(): items[i + 1]
+      for i in range(0, len(items) - 1, 2)
+      if isinstance(items[i], bytes)
+    })
+  return messages
+
+
+def _params(value) -> dict[str, str]:
+  """
+  Convert a BODYSTRUCTURE parameter list ("NAME" "value" ...) to a dict.
+  """
+  if not isinstance(value, list):
+    return {}
+  return {
+    value[i].decode(errors='replace').lower(): (value[i + 1] or b'').decode(errors='replace')
+    for i in range(0, len(value) - 1, 2)
+    if isinstance(value[i], bytes)
+  }
+
+
+class BodyPart:
+  """
+  A leaf part of a BODYSTRUCTURE, addressable with `BODY[<section>]`.
+  """
+  __slots__ = ('section', 'content_type', 'params', 'encoding', 'size', 'disposition', 'disposition_params')
+
+  def __init__(self, section: str, structure: list):
+    self.section = section
+    self.content_type = f'{_str(structure[0])}/{_str(structure[1])}'.lower()
+    self.params = _params(structure[2])
+    self.encoding = _str(structure[5]).lower() or '7bit'
+    self.size = int(structure[6]) if isinstance(structure[6], bytes) and structure[6].isdigit() else 0
+    # The disposition follows the type-specific fields.
+    if self.content_type == 'message/rfc822':
+      index = 11
+    elif self.content_type.startswith('text/'):
+      index = 9
+    else:
+      index = 8
+    disposition = structure[index] if len(structure) > index else None
+    if isinstance(disposition, list) and disposition:
+      self.disposition = _str(disposition[0]).lower()
+      self.disposition_params = _params(disposition[1] if len(disposition) > 1 else None)
+    else:
+      self.disposition = None
+      self.disposition_params = {}
+
+  def headers(self) -> Message:
+    """
+    A header-only Message describing this part, so the `email` package can
+    decode its filename (RFC 2231), charset and transfer encoding.
+    """
+    part = Message()
+    part['Content-Type'] = self.content_type
+    for name, value in self.params.items():
+      part.set_param(name, value, header='Content-Type')
+    if self.disposition:
+      part['Content-Disposition'] = self.disposition
+      for name, value in self.disposition_params.items():
+        part.set_param(name, value, header='Content-Disposition')
+    part['Content-Transfer-Encoding'] = self.encoding
+    return part
+
+
+def _str(value) -> str:
+  return value.decode(errors='replace') if isinstance(value, bytes) else ''
+
+
+def _child(prefix: str, index: int) -> str:
+  return f'{prefix}.{index}' if prefix else str(index)
+
+
+def body_parts(structure: list, prefix: str = '') -> list[BodyPart]:
+  """
+  Flatten a BODYSTRUCTURE into its leaf parts, in the same order as `Message.walk()`.
+  Parts of attached messages (message/rfc822) are included after the attached message itself.
+
+  Args:
+    structure (list): The parsed BODYSTRUCTURE value.
+    prefix (str): Section of the enclosing part, empty for the whole message.
+  """
+  if structure and isinstance(structure[0], list):
+    parts = []
+    for i, child in enumerate(_multipart_children(structure), 1):
+      parts += _leaf_parts(child, _child(prefix, i))
+    return parts
+  return _leaf_parts(structure, _child(prefix, 1))
+
+
+def _multipart_children(structure: list) -> list[list]:
+  """
+  The child parts of a multipart BODYSTRUCTURE: the leading lists before the subtype.
+  """
+  children = []
+  for item in structure:
+    if not isinstance(item, list):
+      break
+    children.append(item)
+  return children
+
+
+def _leaf_parts(structure: list, section: str) -> list[BodyPart]:
+  if structure and isinstance(structure[0], list):
+    parts = []
+    for i, child in enumerate(_multipart_children(structure), 1):
+      parts += _leaf_parts(child, f'{section}.{i}')
+    return parts
+
+  part = BodyPart(section, structure)
+  if part.content_type == 'message/rfc822' and len(structure) > 8 and isinstance(structure[8], list):
+    return [part] + body_parts(structure[8], prefix=section)
+  return [part]
@@ -0,0 +1,228 @@
+import logging
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from helpers.metrics import Gauge
+
+_LEASES_HELD = Gauge('mailbot_leases_held', 'Account leases held by this instance.')
+_LEASE_MEMBERS = Gauge('mailbot_lease_members', 'Live instances sharing the accounts, this one included.')
+
+
+def default_holder() -> str:
+  """
+  An id for this process that no other instance, or earlier run, shares.
+  """
+  return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+class LeaseStore:
+  """
+  Time-limited leases that let several instances share one set of accounts
+  without notifying the same mail twice. Each account is watched only by the
+  instance holding its lease.
+
+  Leases and the list of live instances live in the same SQLite WAL database
+  as the checkpoints, so all instances must use the same `STATE_DB` on a
+  filesystem with working locks (a shared volume, not a network share).
+
+  A background thread renews the leases this instance holds and its own
+  membership every `ttl / 3` seconds. An instance that stops renewing loses
+  its leases after `ttl` seconds, and the others take them over. Each
+  instance holds at most its fair share (accounts / live instances, rounded
+  up), so accounts are spread over the instances, and an instance holding
+  more than its share (e.g. after another one started) gives the extras up.
+
+  Example usage:
+    leases = LeaseStore('state.db', ttl=30)
+    leases.register(['me@imap.example.com'])
+    leases.wait('me@imap.example.com')
+    while leases.held('me@imap.example.com'):
+      ...
+
+  Args:
+    path (str): SQLite database file shared by the instances.
+    ttl (float): Seconds a lease stays valid without renewal, which is the
+      longest failover takes.
+    holder (str | None): Id of this instance, unique per process by default.
+  """
+
+  def __init__(self, path: str, ttl: float = 30, holder: str | None = None):
+    self.holder = holder or default_holder()
+    self.ttl = ttl
+    self.__lock = threading.Lock()
+    self.__changed = threading.Condition(self.__lock)
+    self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=ttl / 3)
+    self.__db.execute('PRAGMA journal_mode=WAL')
+    self.__db.execute(
+      'CREATE TABLE IF NOT EXISTS leases ('
+      ' name TEXT PRIMARY KEY,'
+      ' holder TEXT NOT NULL,'
+      ' expires REAL NOT NULL)'
+    )
+    self.__db.execute(
+      'CREATE TABLE IF NOT EXISTS lease_members ('
+      ' holder TEXT PRIMARY KEY,'
+      ' expires REAL NOT NULL)'
+    )
+    self.__names: set[str] = set()
+    self.__held: set[str] = set()
+    self.__members = 1
+    self.__closed = False
+    self.__renewed = time.monotonic()
+    self.__heartbeat()
+    threading.Thread(target=self.__renew_loop, name='leases', daemon=True).start()
+
+  def register(self, names: list[str]):
+    """
+    Declare the leases this instance may hold, which sets its fair share.
+    Every instance is expected to register the same names.
+    """
+    with self.__lock:
+      self.__names.update(names)
+
+  def held(self, name: str) -> bool:
+    """
+    Whether this instance still holds `name`. Only a cached flag, cheap enough
+    to check before every notification.
+    """
+    with self.__lock:
+      return name in self.__held
+
+  def acquire(self, name: str) -> bool:
+    """
+    Take `name` if it is free or expired and this instance has room for it in
+    its fair share. Returns whether it is held now.
+    """
+    with self.__lock:
+      if self.__closed:
+        return False
+      if name in self.__held:
+        return True
+      if len(self.__held) >= self.__share():
+        return False
+      now = time.time()
+      try:
+        self.__db.execute(
+          'INSERT INTO leases (name, holder, expires) VALUES (?, ?, ?)'
+          ' ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires = excluded.expires'
+          ' WHERE leases.holder = excluded.holder OR leases.expires < ?',
+          (name, self.holder, now + self.ttl, now),
+        )
+        row = self.__db.execute('SELECT holder FROM leases WHERE name = ?', (name,)).fetchone()
+      except sqlite3.Error as e:
+        logging.error(f'Error while acquiring lease on {name}: {e}')
+        return False
+      if row is None or row[0] != self.holder:
+        return False
+      self.__held.add(name)
+      _LEASES_HELD.set(len(self.__held))
+    logging.info(f'Acquired lease on {name}.')
+    return True
+
+  def wait(self, name: str):
+    """
+    Block until `name` is acquired, trying again every renewal period.
+    """
+    logged = False
+    while not self.acquire(name):
+      if not logged:
+        logging.info(f'{name} is watched by another instance, standing by.')
+        logged = True
+      with self.__changed:
+        self.__changed.wait(self.ttl / 3)
+
+  def release(self, name: str):
+    """
+    Give up `name` right away, so another instance can take it without waiting for it to expire.
+    """
+    with self.__lock:
+      self.__release(name)
+
+  def close(self):
+    """
+    Release every lease and leave the member list, e.g. on shutdown.
+    """
+    with self.__lock:
+      self.__closed = True
+      for name in list(self.__held):
+        self.__release(name)
+      self.__db.execute('DELETE FROM lease_members WHERE holder = ?', (self.holder,))
+
+  def __release(self, name: str):
+    self.__held.discard(name)
+    _LEASES_HELD.set(len(self.__held))
+    try:
+      self.__db.execute('DELETE FROM leases WHERE name = ? AND holder = ?', (name, self.holder))
+      logging.info(f'Released lease on {name}.')
+    except sqlite3.Error as e:
+      # It expires on its own.
+      logging.error(f'Error while releasing lease on {name}: {e}')
+
+  def __share(self) -> int:
+    return max(math.ceil(len(self.__names) / self.__members), 1)
+
+  def __heartbeat(self):
+    """
+    Renew this instance's membership and count the live instances.
+    """
+    now = time.time()
+    with self.__lock:
+      if self.__closed:
+        return
+      self.__db.execute(
+        'INSERT INTO lease_members (holder, expires) VALUES (?, ?)'
+        ' ON CONFLICT (holder) DO UPDATE SET expires = excluded.expires',
+        (self.holder, now + self.ttl),
+      )
+      self.__db.execute('DELETE FROM lease_members WHERE expires < ?', (now,))
+      self.__members = self.__db.execute('SELECT COUNT(*) FROM lease_members').fetchone()[0] or 1
+      _LEASE_MEMBERS.set(self.__members)
+
+  def __renew(self):
+    """
+    Extend the held leases, dropping the ones another instance took over
+    (this one was too slow to renew) and the ones above the fair share.
+    """
+    now = time.time()
+    with self.__lock:
+      if self.__closed:
+        return
+      for name in sorted(self.__held):
+        renewed = self.__db.execute(
+          'UPDATE leases SET expires = ? WHERE name = ? AND holder = ? AND expires >= ?',
+          (now + self.ttl, name, self.holder, now),
+        ).rowcount
+        if not renewed:
+          logging.warning(f'Lost lease on {name}.')
+          self.__release(name)
+      for name in sorted(self.__held)[self.__share():]:
+        logging.info(f'Handing {name} over to another instance.')
+        self.__release(name)
+      self.__renewed = time.monotonic()
+      self.__changed.notify_all()
+
+  def __expire(self):
+    """
+    Stop using the held leases once they may have expired without renewal.
+    Done locally ahead of time, before another instance can take them over.
+    """
+    with self.__lock:
+      if self.__held and time.monotonic() - self.__renewed >= self.ttl / 2:
+        logging.warning(f'Could not renew leases on {", ".join(sorted(self.__held))}, giving them up.')
+        self.__held.clear()
+        _LEASES_HELD.set(0)
+
+  def __renew_loop(self):
+    while True:
+      time.sleep(self.ttl / 3)
+      try:
+        self.__heartbeat()
+        self.__renew()
+      except sqlite3.Error as e:
+        logging.error(f'Error while renewing leases: {e}')
+        self.__expire()
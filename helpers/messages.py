@@ -1,56 +1,95 @@
 from email.message import Message
 from helpers.strings import *
+from typing import IO, Callable, Iterable, Iterator, NamedTuple
+import binascii
+import functools
 import html2text
+import itertools
+import quopri
+import re
+import tempfile
+import threading
 
-def extract_summary_from_plaintext(message: Message) -> str | None:
-  """
-  Extracts the email summary from a given message object.
-  """
+# Attachments are decoded in chunks of this size, and kept in memory up to _SPOOL_MAX_MEMORY.
+_CHUNK_SIZE = 1024 * 1024
+_SPOOL_MAX_MEMORY = 1024 * 1024
+_NON_BASE64_RE = re.compile(rb'[^A-Za-z0-9+/]')
 
-  summary = ''
+# HTML is converted in slices of about this many characters, each cut before a tag.
+_HTML_CHUNK = 16 * 1024
 
-  for part in message.walk():
-    if part.get_content_type() == 'text/plain':
-      charset = part.get_content_charset() or 'utf-8'
-      summary += part.get_payload(decode=True).decode(charset)
+# Characters of summary kept per mail. Senders show about 4,000 characters at most;
+# the margin covers markup (link URLs, bold markers) that they strip before showing it.
+SUMMARY_BUDGET = 16 * 1024
 
-  return summary == '' and None or summary
+def _new_html2text() -> html2text.HTML2Text:
+  h = html2text.HTML2Text()
+  h.body_width = 0
+  h.ignore_tables = True
+  h.ignore_images = True
+  h.use_automatic_links = True
+  return h
 
-def extract_summary_from_html(message: Message) -> str | None:
-  """
-  Extracts the plaintext HTML content from a given message object.
+def iter_html_text(html: str) -> Iterator[str]:
   """
+  Convert HTML to text, yielding the text as it is produced.
 
-  summary = ''
+  The HTML is fed to html2text in slices, so a caller that stops iterating
+  early never pays for converting the rest of the document.
+  """
+  h = _new_html2text()
+  start = 0
+  while start < len(html):
+    # Cutting before a tag keeps text nodes whole, so the output is the same as in one go.
+    end = html.find('<', start + _HTML_CHUNK)
+    end = len(html) if end == -1 else end
+    h.feed(html[start:end])
+    start = end
+    # Text already written out never changes, so hand it over and drop it.
+    text = ''.join(h.outtextlist)
+    h.outtextlist.clear()
+    if text:
+      yield text.replace('&nbsp_place_holder;', ' ')
+  h.feed('')
+  yield h.finish()
 
+def _part_texts(message: Message, content_type: str) -> Iterator[str]:
   for part in message.walk():
-    if part.get_content_type() == 'text/html':
+    if part.get_content_type() == content_type:
       charset = part.get_content_charset() or 'utf-8'
-      html = part.get_payload(decode=True).decode(charset)
-      h = html2text.HTML2Text()
-      h.body_width = 0
-      h.ignore_tables = True
-      h.ignore_images = True
-      h.use_automatic_links = True
-      summary += h.handle(data=html)
-
-  return summary.strip() == '' and None or summary
+      yield part.get_payload(decode=True).decode(charset)
 
-def get_email_summary(message: Message) -> str:
+def get_email_summary(message: Message, budget: int | None = None) -> str:
   """
   Retrieve email body from a Message object and return it as a string.
 
+  The body is converted and compacted in a single streaming pass that stops
+  once `budget` characters are collected, so the cost of a huge HTML mail is
+  bounded by the budget rather than by the size of the mail.
+
   Args:
     message (Message): A Message object containing email message.
+    budget (int | None): Maximum length of the summary, or None for all of it.
 
   Returns:
-    str: The retrieved email body as a string.
+    str: The retrieved email body as a string, the same as without a budget but cut to `budget` characters.
   """
-  # Get summary
-  summary = extract_summary_from_plaintext(message=message) or extract_summary_from_html(message=message) or ''
-  summary = compact_string(summary)
+  plaintexts = _part_texts(message, 'text/plain')
+  first = next((text for text in plaintexts if text), None)
+  if first is not None:
+    texts = itertools.chain((first,), plaintexts)
+  else:
+    texts = itertools.chain.from_iterable(iter_html_text(html) for html in _part_texts(message, 'text/html'))
 
-  return summary
+  pieces: list[str] = []
+  length = 0
+  for piece in iter_compact_string(texts):
+    pieces.append(piece)
+    length += len(piece)
+    if budget is not None and length >= budget:
+      break
+  summary = ''.join(pieces)
+  return summary if budget is None else summary[:budget]
 
 def extract_email_subject(message: Message) -> str:
   """
@@ -74,28 +113,365 @@ def extract_email_subject(message: Message) -> str:
   except AttributeError:
     return subject
 
-def extract_email_attachment(message: Message) -> list[tuple[str, bytes]]:
+class _memoized:
   """
-  Extract all email attachments from a given `email.message.Message` object.
+  Like `functools.cached_property`, but computes each value at most once
+  even when several sender threads ask for it at the same time. The lock is
+  reentrant, as a field may read others (a digest's summary reads its sender).
+  """
+  def __init__(self, func):
+    self.__func = func
+    self.__name = func.__name__
+    self.__doc__ = func.__doc__
+
+  def __get__(self, instance, owner=None):
+    if instance is None:
+      return self
+    cache = instance._cache
+    if self.__name not in cache:
+      with instance._lock:
+        if self.__name not in cache:
+          cache[self.__name] = self.__func(instance)
+    return cache[self.__name]
+
+class AttachmentTooLarge(Exception):
+  """Raised by `Attachment.open()` when the decoded content exceeds the given limit."""
+
+class _TransferDecoder:
+  """
+  Incremental Content-Transfer-Encoding decoder, so parts can be decoded chunk by chunk.
+  Unknown encodings (7bit, 8bit, binary) are passed through.
+  """
+  def __init__(self, encoding: str):
+    self.__encoding = encoding.lower()
+    self.__pending = b''
+
+  def feed(self, chunk: bytes) -> bytes:
+    if self.__encoding == 'base64':
+      data = self.__pending + _NON_BASE64_RE.sub(b'', chunk)
+      cut = len(data) - len(data) % 4
+      self.__pending = data[cut:]
+      return binascii.a2b_base64(data[:cut])
+    if self.__encoding == 'quoted-printable':
+      # Soft line breaks never span a newline, so decode whole lines only.
+      data = self.__pending + chunk
+      cut = data.rfind(b'\n') + 1
+      self.__pending = data[cut:]
+      return quopri.decodestring(data[:cut])
+    return chunk
+
+  def flush(self) -> bytes:
+    rest, self.__pending = self.__pending, b''
+    if self.__encoding == 'base64' and rest:
+      try:
+        return binascii.a2b_base64(rest + b'=' * (-len(rest) % 4))
+      except binascii.Error:
+        return b''
+    if self.__encoding == 'quoted-printable':
+      return quopri.decodestring(rest)
+    return rest
+
+def _encoded_bytes(text: str) -> bytes:
+  """
+  Turn an encoded payload string back into bytes, the way `Message.get_payload(decode=True)` does.
+  """
+  try:
+    return text.encode('ascii', 'surrogateescape')
+  except UnicodeEncodeError:
+    return text.encode('raw-unicode-escape')
+
+def _encoded_payload(part: Message) -> bytes:
+  """
+  The still-encoded payload of a parsed part.
+  """
+  payload = part.get_payload()
+  if isinstance(payload, list):
+    # An attached message (message/rfc822) is forwarded as-is.
+    return b''.join(sub.as_bytes() for sub in payload)
+  return _encoded_bytes(payload)
+
+def _byte_chunks(data: bytes) -> Iterator[bytes]:
+  """
+  Yield `data` in chunks.
+  """
+  view = memoryview(data)
+  for i in range(0, len(data), _CHUNK_SIZE):
+    yield bytes(view[i:i + _CHUNK_SIZE])
+
+class Attachment:
+  """
+  An attachment of a `NotificationPayload`. Its content is only loaded
+  (decoded, or downloaded from the server) when opened.
 
   Args:
-    message (Message): The email message to extract attachments from.
+    filename (str): The decoded file name.
+    content_type (str): The MIME type, e.g. `application/pdf`.
+    chunks (Callable[[], Iterable[bytes]]): Returns the encoded content, chunk by chunk.
+    encoding (str): The Content-Transfer-Encoding of the chunks.
+    size (int | None): Size of the encoded part in bytes, if known.
+  """
+  __slots__ = ('filename', 'content_type', 'encoding', 'size', '_chunks')
 
-  Returns:
-    A list of tuples, where each tuple contains the name and content of an extracted attachment.
-    Each attachment is represented by a tuple containing its filename (as a string) and
-    its content (as bytes).
+  def __init__(self, filename: str, content_type: str, chunks: Callable[[], Iterable[bytes]],
+               encoding: str = '7bit', size: int | None = None):
+    self.filename = filename
+    self.content_type = content_type
+    self.encoding = encoding.lower()
+    self.size = size
+    self._chunks = chunks
+
+  @property
+  def decoded_size(self) -> int | None:
+    """
+    Estimated size of the decoded content, if the encoded size is known.
+    Base64 lines are taken to be the usual 76 characters plus CRLF.
+    """
+    if self.size is None:
+      return None
+    return self.size * 76 // 78 * 3 // 4 if self.encoding == 'base64' else self.size
+
+  def open(self, limit: int | None = None) -> IO[bytes]:
+    """
+    Decode the attachment into a temporary file, one chunk at a time.
+    The file stays in memory while small and moves to disk beyond `_SPOOL_MAX_MEMORY`.
+
+    Args:
+      limit (int | None): Maximum decoded size in bytes.
+
+    Returns:
+      IO[bytes]: The decoded content, rewound. Close it when done.
+
+    Raises:
+      AttachmentTooLarge: If the content is larger than `limit`.
+    """
+    file = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_MEMORY)
+    decoder = _TransferDecoder(self.encoding)
+    chunks = iter(self._chunks())
+    try:
+      for chunk in itertools.chain(chunks, (None,)):
+        file.write(decoder.feed(chunk) if chunk is not None else decoder.flush())
+        if limit is not None and file.tell() > limit:
+          raise AttachmentTooLarge(f'{self.filename} is larger than {limit} bytes')
+    except BaseException:
+      file.close()
+      raise
+    finally:
+      # Release whatever the source holds (e.g. an IMAP connection) right away.
+      if hasattr(chunks, 'close'):
+        chunks.close()
+    file.seek(0)
+    return file
+
+  def read(self) -> bytes:
+    with self.open() as file:
+      return file.read()
+
+class MailSource(NamedTuple):
+  """Where a mail was fetched from."""
+  server: str
+  username: str
+  folder: str
+  uidvalidity: int | None
+  uid: int
 
-  Notes:
-    If an attachment's filename cannot be determined, it is given the default name 'Untitled attachment'.
-    Normally, the max size of an email attachment is no larger than 50MB.
+class NotificationPayload:
   """
-  attachments: list[tuple[str, bytes]] = []
+  The parts of an email that senders need, shared by all senders and retries.
 
-  for part in message.walk():
-    if part.get_content_disposition() == 'attachment':
-      filename = decode_header_string(part.get_filename('Untitled attachment'))
-      file = part.get_payload(decode=True)
-      attachments.append((filename, file))
+  Every field is computed lazily on first access and memoized, so the MIME walk
+  and HTML conversion run once per email instead of once per sender and attempt.
+  Payloads are immutable.
+
+  Args:
+    message (Message): The email to notify about. It may hold only the headers and
+      text parts, when the attachments are given separately.
+    attachments (tuple[Attachment, ...] | None): Attachments to use instead of
+      the ones found in `message`.
+    source (MailSource | None): Where the mail was fetched from, when it came from a mailbox.
+    senders (frozenset[str] | None): Names of the senders to deliver it through, or None for all of them.
+  """
+  __slots__ = ('_message', '_cache', '_lock', '_source', '_senders')
+
+  # Every memoized field, as computed by `compact`.
+  _FIELDS = ('sender', 'to', 'subject', 'message_id', 'thread_id', 'summary', 'attachments')
+
+  def __init__(self, message: Message, attachments: tuple[Attachment, ...] | None = None, source: MailSource | None = None,
+               senders: frozenset[str] | None = None):
+    object.__setattr__(self, '_message', message)
+    object.__setattr__(self, '_cache', {} if attachments is None else {'attachments': attachments})
+    object.__setattr__(self, '_lock', threading.RLock())
+    object.__setattr__(self, '_source', source)
+    object.__setattr__(self, '_senders', senders)
+
+  def __setattr__(self, name, value):
+    raise AttributeError(f'{type(self).__name__} is immutable')
+
+  @property
+  def message(self) -> Message:
+    """The email; only its headers once the payload is compacted."""
+    return self._message
+
+  @property
+  def source(self) -> MailSource | None:
+    return self._source
+
+  @property
+  def senders(self) -> frozenset[str] | None:
+    return self._senders
+
+  def compact(self) -> 'NotificationPayload':
+    """
+    Compute every field now, then drop the body and keep only the headers.
+
+    A compacted payload holds little more than its summary and attachment
+    references, so mails waiting in queues or for retries don't keep their
+    parsed text around.
+
+    Returns:
+      NotificationPayload: This payload.
+    """
+    for name in self._FIELDS:
+      getattr(self, name)
+    headers = Message()
+    for name, value in self._message.raw_items():
+      headers.set_raw(name, value)
+    with self._lock:
+      object.__setattr__(self, '_message', headers)
+    return self
+
+  @_memoized
+  def sender(self) -> str:
+    """The sender's email address."""
+    return extract_email_address(self._message['From'])
+
+  @_memoized
+  def to(self) -> str:
+    """The recipient's email address."""
+    return extract_email_address(self._message['To'])
+
+  @_memoized
+  def subject(self) -> str:
+    """The decoded subject, see `extract_email_subject`."""
+    return extract_email_subject(self._message)
+
+  @_memoized
+  def message_id(self) -> str | None:
+    """The Message-ID header, if any."""
+    return self._message['Message-ID']
+
+  @_memoized
+  def thread_id(self) -> str | None:
+    """The Message-ID of the first mail of the thread (References, In-Reply-To), or this mail's own."""
+    for header in ('References', 'In-Reply-To', 'Message-ID'):
+      ids = (self._message[header] or '').split()
+      if ids:
+        return ids[0]
+    return None
+
+  @_memoized
+  def summary(self) -> str:
+    """The compacted body text, up to `SUMMARY_BUDGET` characters; see `get_email_summary`."""
+    return get_email_summary(self._message, budget=SUMMARY_BUDGET)
+
+  @_memoized
+  def attachments(self) -> tuple[Attachment, ...]:
+    """
+    Index of the attachments; contents are decoded on `Attachment.read()`.
+    Their encoded content is copied out of the parsed message, so that a
+    compacted payload doesn't keep the whole mail alive.
+    """
+    attachments = []
+    for part in self._message.walk():
+      if part.get_content_disposition() == 'attachment':
+        is_message = isinstance(part.get_payload(), list)
+        encoded = _encoded_payload(part)
+        attachments.append(Attachment(
+          decode_header_string(part.get_filename('Untitled attachment')),
+          part.get_content_type(),
+          functools.partial(_byte_chunks, encoded),
+          '7bit' if is_message else part.get('Content-Transfer-Encoding', '7bit'),
+          None if is_message else len(encoded),
+        ))
+    return tuple(attachments)
+
+class DigestPayload(NotificationPayload):
+  """
+  Several mails delivered as a single notification.
+
+  The summary lists every mail's subject (and sender, when they differ) followed
+  by the start of its text. It is kept within `max_length` characters, together
+  with the sender, recipient and subject lines, by giving each mail an equal share.
+
+  Args:
+    payloads (list[NotificationPayload]): The mails, in arrival order; at least two,
+      all going to the same senders.
+    max_length (int): Maximum length of the notification text.
+  """
+  __slots__ = ('_payloads', '_max_length')
+
+  def __init__(self, payloads: list[NotificationPayload], max_length: int = 4096):
+    super().__init__(payloads[0].message, senders=payloads[0].senders)
+    object.__setattr__(self, '_payloads', tuple(payloads))
+    object.__setattr__(self, '_max_length', max_length)
+
+  @property
+  def payloads(self) -> tuple[NotificationPayload, ...]:
+    return self._payloads
+
+  @_memoized
+  def sender(self) -> str:
+    senders = dict.fromkeys(p.sender for p in self._payloads)
+    return next(iter(senders)) if len(senders) == 1 else f'{len(senders)} senders'
+
+  @_memoized
+  def to(self) -> str:
+    return ', '.join(dict.fromkeys(p.to for p in self._payloads))
+
+  @_memoized
+  def subject(self) -> str:
+    subjects = {p.subject for p in self._payloads}
+    count = len(self._payloads)
+    return f'{self._payloads[0].subject} ({count} mails)' if len(subjects) == 1 else f'{count} new mails'
+
+  @_memoized
+  def message_id(self) -> str | None:
+    return None
+
+  @_memoized
+  def thread_id(self) -> str | None:
+    return self._payloads[0].thread_id
+
+  @_memoized
+  def summary(self) -> str:
+    one_sender = len({p.sender for p in self._payloads}) == 1
+    titles = [p.subject if one_sender else f'{p.subject} — {p.sender}' for p in self._payloads]
+    # Room left once the sender, recipient and subject lines are shown.
+    budget = self._max_length - len(self.sender) - len(self.to) - len(self.subject) - 8
+
+    # List as many subjects as fit, keeping room for a "… and N more" line.
+    entries: list[str] = []
+    used = 0
+    for i, title in enumerate(titles):
+      entry = f'• {title}'
+      reserve = len(f'… and {len(titles)} more') + 2 if i < len(titles) - 1 else 0
+      if entries and used + len(entry) + 2 + reserve > budget:
+        break
+      entries.append(entry)
+      used += len(entry) + 2
+
+    # The rest is shared equally by the texts of the listed mails.
+    share = (budget - used) // len(entries) - 1
+    if share > 20:
+      for i, payload in enumerate(self._payloads[:len(entries)]):
+        text = payload.summary
+        if len(text) > share:
+          text = text[:share - 1].rstrip() + '…'
+        if text:
+          entries[i] += f'\n{text}'
+    if len(entries) < len(titles):
+      entries.append(f'… and {len(titles) - len(entries)} more')
+    return '\n\n'.join(entries)
 
-  return attachments
\ No newline at end of file
+  @_memoized
+  def attachments(self) -> tuple[Attachment, ...]:
+    return tuple(itertools.chain.from_iterable(p.attachments for p in self._payloads))
@@ -0,0 +1,206 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+import bisect
+import logging
+import threading
+import time
+
+# Metrics in the Prometheus text exposition format, served over HTTP when
+# METRICS_PORT is set. Metrics are module-level objects next to the code they
+# measure, e.g.:
+#
+#   _POLL_SECONDS = Histogram('mailbot_poll_seconds', 'Time spent checking a folder.', ('account', 'folder'))
+#
+#   with _POLL_SECONDS.time(account=account, folder=folder):
+#     ...
+#
+# Updates are a dict lookup under a lock, so they are cheap enough to keep on
+# when nothing scrapes them.
+
+# Prometheus client defaults, extended for slow IMAP servers and uploads.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value: str) -> str:
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = '') -> str:
+  pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+  if extra:
+    pairs.append(extra)
+  return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+  if value == float('inf'):
+    return '+Inf'
+  return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+  kind = ''
+
+  def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (), registry: 'Registry | None' = None):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = tuple(labels)
+    self._lock = threading.Lock()
+    self._values: dict[tuple[str, ...], object] = {}
+    (registry or REGISTRY).register(self)
+
+  def _key(self, labels: dict[str, object]) -> tuple[str, ...]:
+    if set(labels) != set(self.labelnames):
+      raise ValueError(f'{self.name} takes labels {self.labelnames}, got {tuple(labels)}.')
+    return tuple(str(labels[name]) for name in self.labelnames)
+
+  def render(self) -> Iterator[str]:
+    yield f'# HELP {self.name} {self.documentation}'
+    yield f'# TYPE {self.name} {self.kind}'
+    # Copy under the lock, as updates keep changing histogram counts in place.
+    with self._lock:
+      values = sorted((key, self._copy(value)) for key, value in self._values.items())
+    for key, value in values:
+      yield from self._samples(key, value)
+
+  def _copy(self, value):
+    return value
+
+  def _samples(self, key: tuple[str, ...], value) -> Iterator[str]:
+    yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Counter(_Metric):
+  """
+  A value that only goes up, e.g. mails fetched or retries.
+  """
+  kind = 'counter'
+
+  def inc(self, amount: float = 1, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+  """
+  A value that is set, e.g. a queue depth or the last processed UID.
+  """
+  kind = 'gauge'
+
+  def set(self, value: float, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = value
+
+
+class Histogram(_Metric):
+  """
+  A distribution of observations, usually durations in seconds, counted in
+  cumulative buckets as Prometheus expects.
+  """
+  kind = 'histogram'
+
+  def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+               buckets: tuple[float, ...] = DEFAULT_BUCKETS, registry: 'Registry | None' = None):
+    super().__init__(name, documentation, labels, registry)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, value: float, **labels):
+    key = self._key(labels)
+    with self._lock:
+      counts = self._values.get(key)
+      if counts is None:
+        # One count per bucket plus +Inf, then the sum.
+        counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+      counts[bisect.bisect_left(self.buckets, value)] += 1
+      counts[-1] += value
+
+  @contextmanager
+  def time(self, **labels):
+    """
+    Observe how long the `with` block took, whether or not it raised.
+    """
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter() - start, **labels)
+
+  def _copy(self, counts: list) -> list:
+    return list(counts)
+
+  def _samples(self, key: tuple[str, ...], counts: list) -> Iterator[str]:
+    cumulative = 0
+    for bound, count in zip(self.buckets + (float('inf'),), counts):
+      cumulative += count
+      le = f'le="{_format_value(bound)}"'
+      yield f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}'
+    yield f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(counts[-1])}'
+    yield f'{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}'
+
+
+class Registry:
+  """
+  The set of metrics exposed together.
+  """
+
+  def __init__(self):
+    self.__metrics: dict[str, _Metric] = {}
+    self.__lock = threading.Lock()
+
+  def register(self, metric: _Metric):
+    with self.__lock:
+      if metric.name in self.__metrics:
+        raise ValueError(f'Metric {metric.name} is already registered.')
+      self.__metrics[metric.name] = metric
+
+  def render(self) -> str:
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    with self.__lock:
+      metrics = list(self.__metrics.values())
+    return ''.join(line + '\n' for metric in metrics for line in metric.render())
+
+
+REGISTRY = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+  registry: Registry = REGISTRY
+
+  def do_GET(self):
+    if self.path.split('?')[0] not in ('/', '/metrics'):
+      self.send_error(404)
+      return
+    body = self.registry.render().encode()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    logging.debug(f'Metrics request from {self.address_string()}: {format % args}')
+
+
+def start_metrics_server(port: int, address: str = '', registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+  """
+  Serve `registry` at `/metrics` on a background thread.
+
+  Args:
+    port (int): Port to listen on.
+    address (str): Interface to listen on, all of them by default.
+    registry (Registry): The metrics to expose.
+
+  Returns:
+    ThreadingHTTPServer: The running server, e.g. to `shutdown()` it.
+  """
+  handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+  server = ThreadingHTTPServer((address, port), handler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+  logging.info(f'Serving metrics on {address or "*"}:{server.server_address[1]}/metrics')
+  return server
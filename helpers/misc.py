@@ -1,33 +1,166 @@
+from typing import Callable
+import heapq
+import itertools
+import logging
+import random
+import threading
 import time
 
-def retry(max_tries:int=3, expnential_backoff_c=1):
+def backoff_delay(attempt: int, base: float = 1, cap: float = 300) -> float:
   """
-  A decorator that provides a mechanism for retrying a function in case of exceptions.
+  Compute the delay before a retry, using exponential backoff with jitter.
 
   Args:
-    max_tries (int): Maximum number of times the decorated function is allowed to be retried.
-      Default value is 3.
-    expnential_backoff_c (int/float): The factor by which the delay between retries is increased on each
-      subsequent retry attempt. Default value is 1, meaning there will be no exponential backoff.
+    attempt (int): Number of failed attempts so far (1 for the first retry).
+    base (float): Delay after the first failure, in seconds.
+    cap (float): Upper bound for the delay, in seconds.
 
   Returns:
-    A decorator that wraps the passed-in function, providing a mechanism for retrying it in case of exceptions.
+    float: A random delay between half and all of `min(cap, base * 2 ** (attempt - 1))`,
+      so retries from many failures at once don't arrive in lockstep.
+  """
+  delay = min(cap, base * 2 ** (attempt - 1))
+  return delay / 2 + random.uniform(0, delay / 2)
+
+class RetryScheduler:
+  """
+  A delay queue that runs callbacks once their delay has passed.
+
+  Failed work is parked here instead of sleeping in the caller's thread,
+  so the caller can move on to other work in the meantime. Callbacks run
+  on the scheduler's own thread and should be quick (e.g. re-queue a job).
+
+  Example usage:
+    scheduler = RetryScheduler()
+    scheduler.schedule(backoff_delay(attempt), lambda: jobs.put(job))
+  """
+  def __init__(self):
+    self.__heap: list[tuple[float, int, Callable[[], None]]] = []
+    self.__counter = itertools.count()
+    self.__condition = threading.Condition()
+    threading.Thread(target=self.__run, name='retry-scheduler', daemon=True).start()
+
+  def schedule(self, delay: float, callback: Callable[[], None]):
+    """
+    Run `callback` after `delay` seconds.
+    """
+    with self.__condition:
+      heapq.heappush(self.__heap, (time.monotonic() + delay, next(self.__counter), callback))
+      self.__condition.notify()
+
+  def pending(self) -> int:
+    """
+    Number of callbacks waiting for their delay to pass.
+    """
+    with self.__condition:
+      return len(self.__heap)
+
+  def __run(self):
+    while True:
+      with self.__condition:
+        while not self.__heap or self.__heap[0][0] > time.monotonic():
+          timeout = self.__heap[0][0] - time.monotonic() if self.__heap else None
+          self.__condition.wait(timeout)
+        _, _, callback = heapq.heappop(self.__heap)
+      try:
+        callback()
+      except Exception as e:
+        logging.error(f'Scheduled retry failed: {e}')
+
+class TokenBucket:
+  """
+  A token bucket rate limiter: `rate` tokens per second, up to `capacity` at once.
+
+  `reserve()` takes a token right away, even one that has not been earned yet,
+  and returns how long the caller must wait before using it. Callers therefore
+  queue up in the order they arrived, and no lock is held while they sleep.
+
+  Example usage:
+    bucket = TokenBucket(rate=1, capacity=3)
+    time.sleep(bucket.reserve())
+  """
+  def __init__(self, rate: float, capacity: float = 1):
+    self.__rate = rate
+    self.__capacity = capacity
+    self.__tokens = capacity
+    self.__updated = time.monotonic()
+    self.__lock = threading.Lock()
+
+  def __refill(self, now: float):
+    if now > self.__updated:
+      self.__tokens = min(self.__capacity, self.__tokens + (now - self.__updated) * self.__rate)
+      self.__updated = now
+
+  def reserve(self) -> float:
+    """
+    Take one token and return the seconds to wait before it is available.
+    """
+    with self.__lock:
+      now = time.monotonic()
+      self.__refill(now)
+      self.__tokens -= 1
+      wait = max(self.__updated - now, 0)
+      return wait if self.__tokens >= 0 else wait - self.__tokens / self.__rate
+
+  def pause(self, seconds: float):
+    """
+    Hand out no tokens for the next `seconds` (e.g. after the service asked to back off),
+    then start again with at most one token.
+    """
+    with self.__lock:
+      now = time.monotonic()
+      self.__refill(now)
+      self.__tokens = min(self.__tokens, 1)
+      self.__updated = max(self.__updated, now + seconds)
+
+class AdaptiveInterval:
+  """
+  A polling interval that follows the mailbox's activity.
+
+  New mail brings the interval down to `minimum`, as more tends to follow;
+  each quiet poll then stretches it by `growth`, up to `maximum`. Errors
+  (including a server throttling us) at least double it, with jitter, so a
+  struggling server is not hammered by every account at once.
 
   Example usage:
-    @retry(max_tries=5, expnential_backoff_c=2)
-    def foo():
-      # function implementation
-  """
-  def decorator(func):
-    def wrapper(*args, **kwargs):
-      delay = 1
-      for _ in range(max_tries):
-        try:
-          return func(*args, **kwargs)
-        except Exception as e:
-          print(f"Exception caught: {e}")
-          time.sleep(delay)
-          delay *= expnential_backoff_c
-      raise Exception("Failed after multiple retries.")
-    return wrapper
-  return decorator
\ No newline at end of file
+    interval = AdaptiveInterval(start=30, minimum=10, maximum=300)
+    while True:
+      found = poll()
+      time.sleep(interval.next(found))
+  """
+  def __init__(self, start: float, minimum: float, maximum: float, growth: float = 1.5):
+    self.__minimum = min(minimum, start)
+    self.__maximum = max(maximum, start)
+    self.__start = start
+    self.__growth = growth
+    self.__current = start
+
+  @property
+  def minimum(self) -> float:
+    return self.__minimum
+
+  @property
+  def maximum(self) -> float:
+    return self.__maximum
+
+  @property
+  def current(self) -> float:
+    return self.__current
+
+  def next(self, found: bool, failed: bool = False) -> float:
+    """
+    Seconds to wait before the next poll.
+
+    Args:
+      found (bool): Whether the last poll found new mail.
+      failed (bool): Whether it ended with an error.
+    """
+    if failed:
+      self.__current = min(max(self.__current, self.__start) * 2, self.__maximum)
+      # The jitter never goes below the minimum, so fixed bounds mean a fixed interval.
+      return max(self.__current / 2 + random.uniform(0, self.__current / 2), self.__minimum)
+    if found:
+      self.__current = self.__minimum
+    else:
+      self.__current = min(self.__current * self.__growth, self.__maximum)
+    return self.__current
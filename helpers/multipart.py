@@ -0,0 +1,86 @@
+from typing import IO, Iterator
+import io
+import os
+import uuid
+
+class MultipartStream:
+  """
+  A multipart/form-data request body that reads its files lazily.
+
+  `requests` builds multipart bodies in memory; passing this object as `data`
+  instead makes it stream the files from disk with a known Content-Length.
+
+  Args:
+    fields (dict): Form fields. Values are `(filename, file)` tuples, file objects
+      (named after their `name` attribute), or plain values sent as text.
+
+  Example usage:
+    body = MultipartStream({'document': ('report.pdf', file)})
+    requests.post(url, data=body, headers={'Content-Type': body.content_type})
+  """
+  def __init__(self, fields: dict):
+    boundary = uuid.uuid4().hex
+    self.content_type = f'multipart/form-data; boundary={boundary}'
+    self.__segments: list[bytes | IO[bytes]] = []
+    self.__length = 0
+    self.__index = 0
+    self.__offset = 0
+
+    for name, value in fields.items():
+      if isinstance(value, tuple):
+        filename, file = value[0], value[1]
+      elif hasattr(value, 'read'):
+        filename, file = os.path.basename(str(getattr(value, 'name', name))), value
+      else:
+        filename, file = None, None
+
+      header = f'--{boundary}\r\nContent-Disposition: form-data; name="{_quote(name)}"'
+      if file is None:
+        self.__add(f'{header}\r\n\r\n'.encode())
+        self.__add(value if isinstance(value, bytes) else str(value).encode())
+      else:
+        # Telegram expects the raw UTF-8 filename rather than RFC 2231 encoding.
+        self.__add(f'{header}; filename="{_quote(filename)}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode())
+        self.__add_file(file)
+      self.__add(b'\r\n')
+    self.__add(f'--{boundary}--\r\n'.encode())
+
+  def __add(self, data: bytes):
+    self.__segments.append(data)
+    self.__length += len(data)
+
+  def __add_file(self, file: IO[bytes]):
+    start = file.tell()
+    self.__length += file.seek(0, io.SEEK_END) - start
+    file.seek(start)
+    self.__segments.append(file)
+
+  def __len__(self) -> int:
+    return self.__length
+
+  def read(self, size: int = -1) -> bytes:
+    out = bytearray()
+    while self.__index < len(self.__segments) and (size < 0 or len(out) < size):
+      segment = self.__segments[self.__index]
+      want = -1 if size < 0 else size - len(out)
+      if isinstance(segment, bytes):
+        end = len(segment) if want < 0 else self.__offset + want
+        piece = segment[self.__offset:end]
+        self.__offset += len(piece)
+        done = self.__offset >= len(segment)
+      else:
+        piece = segment.read(want)
+        done = not piece
+      out += piece
+      if done:
+        self.__index += 1
+        self.__offset = 0
+    return bytes(out)
+
+  def __iter__(self) -> Iterator[bytes]:
+    while chunk := self.read(64 * 1024):
+      yield chunk
+
+
+def _quote(value: str) -> str:
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\r', ' ').replace('\n', ' ')
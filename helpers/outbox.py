@@ -0,0 +1,226 @@
+from typing import Iterable, NamedTuple
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from helpers.messages import DigestPayload, MailSource, NotificationPayload
+
+# Finished rows are pruned at most this often, in seconds.
+_PRUNE_INTERVAL = 3600
+
+# Delivery states of an outbox row.
+PENDING = 'pending'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+
+class OutboxEntry(NamedTuple):
+  """A mail to deliver, as recorded in the outbox: its dedupe key and where it came from."""
+  key: str
+  source: MailSource | None
+
+
+def outbox_entries(payload: NotificationPayload) -> list[OutboxEntry]:
+  """
+  The outbox entries of a payload: one per mail, so a digest has one per mail it holds.
+  Mails are keyed by Message-ID, or by their folder and UID when they have none.
+  Mails with neither (e.g. built by hand) are not recorded.
+  """
+  payloads = payload.payloads if isinstance(payload, DigestPayload) else (payload,)
+  entries = []
+  for mail in payloads:
+    source = mail.source
+    if mail.message_id and mail.message_id.strip():
+      entries.append(OutboxEntry(mail.message_id.strip(), source))
+    elif source is not None:
+      entries.append(OutboxEntry(f'uid:{source.server}/{source.username}/{source.folder}/{source.uidvalidity}/{source.uid}', source))
+  return entries
+
+
+class Outbox:
+  """
+  Durable record of every (mail, sender) delivery, in the same kind of SQLite
+  WAL database as the checkpoints.
+
+  A row is written for each sender before the mail is queued, so a crash
+  doesn't lose the notification: pending rows are retried on the next start.
+  Deliveries a sender gave up on are not, so a mail that can't be delivered
+  isn't sent again on every start; they age out like delivered rows. Rows
+  are keyed by Message-ID, so a mail seen again (after a UIDVALIDITY reset,
+  or in another folder) isn't notified twice.
+
+  New rows are committed right away, before the mailbox checkpoint can move
+  past the mail. Delivery results are only needed after a restart, so they
+  are queued and committed in batches by a background thread.
+
+  Args:
+    path (str): SQLite database file.
+    retention (float): Seconds to keep finished rows, which is how long
+      duplicates are recognized.
+    flush_interval (float): Longest time a delivery result waits to be written.
+  """
+
+  def __init__(self, path: str, retention: float = 7 * 24 * 3600, flush_interval: float = 0.5):
+    self.__lock = threading.Lock()
+    self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+    self.__db.execute('PRAGMA journal_mode=WAL')
+    self.__db.execute('PRAGMA synchronous=NORMAL')
+    self.__db.execute(
+      'CREATE TABLE IF NOT EXISTS outbox ('
+      ' message_key TEXT NOT NULL,'
+      ' sender TEXT NOT NULL,'
+      ' state TEXT NOT NULL,'
+      ' attempts INTEGER NOT NULL DEFAULT 0,'
+      ' error TEXT,'
+      ' server TEXT,'
+      ' username TEXT,'
+      ' folder TEXT,'
+      ' uidvalidity INTEGER,'
+      ' uid INTEGER,'
+      ' updated REAL NOT NULL,'
+      ' PRIMARY KEY (message_key, sender))'
+    )
+    self.__db.execute('CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, updated)')
+    self.__retention = retention
+    self.__flush_interval = flush_interval
+    self.__updates: queue.Queue[tuple[str, tuple]] = queue.Queue()
+    # Deliveries whose result is queued but not written yet, so `add` already sees them.
+    self.__delivering: set[tuple[str, str]] = set()
+    self.prune()
+    self.__pruned = time.monotonic()
+    threading.Thread(target=self.__write, name='outbox', daemon=True).start()
+
+  def add(self, entries: Iterable[OutboxEntry], senders: Iterable[str]) -> set[str]:
+    """
+    Record mails for delivery through `senders`, unless already recorded.
+
+    Returns:
+      set[str]: The senders that haven't delivered every one of the mails yet.
+    """
+    entries = list(entries)
+    senders = list(senders)
+    now = time.time()
+    with self.__lock:
+      self.__db.execute('BEGIN')
+      try:
+        self.__db.executemany(
+          'INSERT OR IGNORE INTO outbox (message_key, sender, state, server, username, folder, uidvalidity, uid, updated)'
+          ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+          [
+            (entry.key, sender, PENDING, *(entry.source or (None,) * 5), now)
+            for entry in entries
+            for sender in senders
+          ],
+        )
+        wanted = {
+          sender
+          for entry in entries
+          for (sender,) in self.__db.execute(
+            'SELECT sender FROM outbox WHERE message_key = ? AND state != ?', (entry.key, DELIVERED))
+        }
+        self.__db.execute('COMMIT')
+      except BaseException:
+        self.__db.execute('ROLLBACK')
+        raise
+      return {
+        sender
+        for sender in wanted & set(senders)
+        if not all((entry.key, sender) in self.__delivering for entry in entries)
+      }
+
+  def delivered(self, keys: Iterable[str], sender: str):
+    """
+    Mark mails as delivered by `sender`. Written in the background.
+    """
+    for key in keys:
+      with self.__lock:
+        self.__delivering.add((key, sender))
+      self.__updates.put((
+        'UPDATE outbox SET state = ?, attempts = attempts + 1, error = NULL, updated = ? WHERE message_key = ? AND sender = ?',
+        (DELIVERED, time.time(), key, sender),
+      ))
+
+  def failed(self, keys: Iterable[str], sender: str, error: str, final: bool):
+    """
+    Record a failed attempt, and whether `sender` gave up. Written in the background.
+    Given up deliveries are not retried on the next start.
+    """
+    for key in keys:
+      self.__updates.put((
+        'UPDATE outbox SET state = ?, attempts = attempts + 1, error = ?, updated = ? WHERE message_key = ? AND sender = ?',
+        (FAILED if final else PENDING, error[:500], time.time(), key, sender),
+      ))
+
+  def unfinished(self) -> dict[tuple[str, str, str], dict[int | None, list[int]]]:
+    """
+    Mails some sender still has to deliver, to fetch again after a restart.
+    Deliveries a sender gave up on are left out.
+
+    Returns:
+      dict: UIDs by UIDVALIDITY, by (server, username, folder).
+    """
+    with self.__lock:
+      rows = self.__db.execute(
+        'SELECT DISTINCT server, username, folder, uidvalidity, uid FROM outbox'
+        ' WHERE state = ? AND uid IS NOT NULL ORDER BY uid',
+        (PENDING,),
+      ).fetchall()
+    result: dict[tuple[str, str, str], dict[int | None, list[int]]] = {}
+    for server, username, folder, uidvalidity, uid in rows:
+      result.setdefault((server, username, folder), {}).setdefault(uidvalidity, []).append(uid)
+    return result
+
+  def prune(self):
+    """
+    Forget rows that haven't changed for longer than the retention, whatever
+    their state. Given up rows are no longer retried, so they age out too.
+    """
+    with self.__lock:
+      removed = self.__db.execute('DELETE FROM outbox WHERE updated < ?', (time.time() - self.__retention,)).rowcount
+    if removed:
+      logging.info(f'Removed {removed} old outbox entries.')
+
+  def flush(self):
+    """
+    Wait until every queued delivery result has been written.
+    """
+    self.__updates.join()
+
+  def __write(self):
+    """
+    Commit queued updates in batches: whatever arrives within `flush_interval`
+    of the first one goes into the same transaction.
+    """
+    while True:
+      batch = [self.__updates.get()]
+      deadline = time.monotonic() + self.__flush_interval
+      while (remaining := deadline - time.monotonic()) > 0:
+        try:
+          batch.append(self.__updates.get(timeout=remaining))
+        except queue.Empty:
+          break
+      try:
+        with self.__lock:
+          self.__db.execute('BEGIN')
+          try:
+            for sql, params in batch:
+              self.__db.execute(sql, params)
+            self.__db.execute('COMMIT')
+          except BaseException:
+            self.__db.execute('ROLLBACK')
+            raise
+          finally:
+            for _, params in batch:
+              if params[0] == DELIVERED:
+                self.__delivering.discard(params[-2:])
+      except Exception as e:
+        # Losing a result only means the delivery may be repeated after a restart.
+        logging.error(f'Error while writing the outbox: {e}')
+      finally:
+        for _ in batch:
+          self.__updates.task_done()
+      if time.monotonic() - self.__pruned > _PRUNE_INTERVAL:
+        self.__pruned = time.monotonic()
+        self.prune()
@@ -1,4 +1,5 @@
 from email.header import decode_header
+from typing import Iterable, Iterator
 import logging
 
 def compact_string(text: str) -> str:
@@ -11,7 +12,41 @@ def compact_string(text: str) -> str:
   Returns:
     str: The input string with all whitespace characters removed.
   """
-  return strip_leading_and_trailing_spaces(remove_excessive_newlines(strip_leading_and_trailing_spaces(text)))
+  return ''.join(iter_compact_string((text,)))
+
+
+def iter_compact_string(chunks: Iterable[str]) -> Iterator[str]:
+  """
+  Streaming version of `compact_string`, in a single pass.
+
+  Strips every line and collapses runs of more than one blank line into one,
+  yielding the result as soon as each line is complete.
+
+  Args:
+    chunks (Iterable[str]): The text, in pieces of any size.
+
+  Yields:
+    str: Consecutive pieces of `compact_string` applied to the whole text.
+  """
+  partial: list[str] = []
+  newlines = 0
+  first = True
+  for chunk in chunks:
+    partial.append(chunk)
+    if '\n' not in chunk:
+      continue
+    lines = ''.join(partial).split('\n')
+    partial = [lines.pop()]
+    for line in lines:
+      newlines += 0 if first else 1
+      first = False
+      line = line.strip()
+      if line:
+        yield '\n' * min(newlines, 2) + line
+        newlines = 0
+  newlines += 0 if first else 1
+  line = ''.join(partial).strip()
+  yield '\n' * min(newlines, 2) + line
 
 
 def remove_excessive_newlines(text: str) -> str:
@@ -0,0 +1,75 @@
+import sqlite3
+import threading
+import time
+
+class UploadCache:
+  """
+  Durable map from uploaded content to the id the service gave it, so the
+  same file can be sent again by reference instead of being uploaded again.
+
+  Backed by SQLite in WAL mode, next to the checkpoints. Only the
+  `max_entries` most recently used ids are kept.
+
+  Args:
+    path (str): SQLite database file.
+    namespace (str): Keeps the ids of different services (or bots) apart.
+    max_entries (int): Entries kept; the least recently used go first.
+  """
+
+  def __init__(self, path: str, namespace: str, max_entries: int = 1000):
+    self.__lock = threading.Lock()
+    self.__namespace = namespace
+    self.__max_entries = max_entries
+    self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+    self.__db.execute('PRAGMA journal_mode=WAL')
+    self.__db.execute('PRAGMA synchronous=NORMAL')
+    self.__db.execute(
+      'CREATE TABLE IF NOT EXISTS uploads ('
+      ' namespace TEXT NOT NULL,'
+      ' key TEXT NOT NULL,'
+      ' remote_id TEXT NOT NULL,'
+      ' used REAL NOT NULL,'
+      ' PRIMARY KEY (namespace, key))'
+    )
+    self.__db.execute('CREATE INDEX IF NOT EXISTS uploads_used ON uploads (namespace, used)')
+
+  def get(self, key: str) -> str | None:
+    """
+    Return the id stored for `key` and mark it as recently used, or None if unknown.
+    """
+    with self.__lock:
+      row = self.__db.execute(
+        'SELECT remote_id FROM uploads WHERE namespace = ? AND key = ?', (self.__namespace, key)).fetchone()
+      if row is not None:
+        self.__db.execute(
+          'UPDATE uploads SET used = ? WHERE namespace = ? AND key = ?', (time.time(), self.__namespace, key))
+    return row[0] if row else None
+
+  def put(self, key: str, remote_id: str):
+    """
+    Remember the id of an upload, evicting the least recently used entries beyond `max_entries`.
+    """
+    with self.__lock:
+      self.__db.execute('BEGIN')
+      try:
+        self.__db.execute(
+          'INSERT INTO uploads (namespace, key, remote_id, used) VALUES (?, ?, ?, ?)'
+          ' ON CONFLICT (namespace, key) DO UPDATE SET remote_id = excluded.remote_id, used = excluded.used',
+          (self.__namespace, key, remote_id, time.time()),
+        )
+        self.__db.execute(
+          'DELETE FROM uploads WHERE namespace = ? AND key NOT IN'
+          ' (SELECT key FROM uploads WHERE namespace = ? ORDER BY used DESC LIMIT ?)',
+          (self.__namespace, self.__namespace, self.__max_entries),
+        )
+        self.__db.execute('COMMIT')
+      except BaseException:
+        self.__db.execute('ROLLBACK')
+        raise
+
+  def discard(self, key: str):
+    """
+    Forget `key`, e.g. when the service no longer accepts its id.
+    """
+    with self.__lock:
+      self.__db.execute('DELETE FROM uploads WHERE namespace = ? AND key = ?', (self.__namespace, key))
@@ -1,38 +1,194 @@
+from contextlib import contextmanager
 from email.message import Message
-from os import environ
+from typing import Generator, Iterator
+import functools
 import imaplib
 import email.header
+import email.parser
 import logging
+import re
+import threading
+import time
+
+from helpers.checkpoint import CheckpointStore
+from helpers.imap import BodyPart, body_parts, parse_fetch_response
+from helpers.messages import Attachment, MailSource, NotificationPayload
+from helpers.metrics import Counter, Gauge, Histogram
+from helpers.strings import decode_header_string
+from rules import RuleSet
 
 # Some Concepts:
 #   Each mail has a unique identifier (UID).
 #   To fetch mails we first have to use UID commands
-#     to get the UIDs of the mails we want to fetch. (UID SEARCH [UNSEEN \ ALL])
+#     to get the UIDs of the mails we want to fetch. (UID SEARCH UID <lastUid+1>:*)
+#   UIDs only grow within a folder as long as its UIDVALIDITY doesn't change,
+#     so UIDNEXT (and HIGHESTMODSEQ with CONDSTORE) tell us cheaply whether to search at all.
+#   The last processed UID is checkpointed together with UIDVALIDITY,
+#     so a restart resumes where the previous run stopped.
+#   Servers advertising IDLE (RFC 2177) can push new mail notifications
+#     (untagged EXISTS responses), so we don't have to poll on a timer.
+#   New mails are fetched in two steps: BODYSTRUCTURE and headers first, then
+#     only the text parts the summary needs (BODY.PEEK[<section>]).
+#     Attachments stay on the server until a sender reads them.
 
-class Mailbox:
-  def __init__(self):
-    self.__mail_server = environ['IMAP_MAIL_SERVER']
-    self.__mail_username = environ['IMAP_MAIL_USERNAME']
-    self.__mail_password = environ['IMAP_MAIL_PASSWORD']
-    self.__mail_folder = environ.get('IMAP_MAIL_FOLDER', 'INBOX')
-    self.__mail_remains_unread = environ.get('IMAP_MAIL_REMAINS_UNREAD', 'true').lower() == 'true'
+# RFC 2177: clients should re-issue IDLE at least every 29 minutes.
+_IDLE_MAX_SECONDS = 29 * 60
+# How long to wait for the tagged response after sending DONE.
+_IDLE_DONE_TIMEOUT = 30
+# Attachments are downloaded in pieces of this size.
+_PART_CHUNK_SIZE = 1024 * 1024
+
+_IMAP_SECONDS = Histogram('mailbot_imap_command_seconds', 'Duration of IMAP commands.', ('account', 'command'))
+_IMAP_BYTES = Counter('mailbot_imap_fetched_bytes_total', 'Bytes received in FETCH responses.', ('account',))
+_RECONNECTS = Counter('mailbot_imap_reconnects_total', 'Reconnections to the IMAP server.', ('account',))
+_IMAP_ERRORS = Counter('mailbot_imap_errors_total', 'Failed IMAP operations.', ('account', 'stage'))
+_POLL_SECONDS = Histogram('mailbot_poll_seconds', 'Time spent checking a folder for new mail.', ('account', 'folder'))
+_PARSE_SECONDS = Histogram('mailbot_parse_seconds', 'Time spent building a payload from fetched data.', ('account',))
+_MAILS = Counter('mailbot_mails_total', 'New mails fetched.', ('account', 'folder'))
+_LAST_UID = Gauge('mailbot_last_uid', 'Last processed UID.', ('account', 'folder'))
+_DROPPED = Counter('mailbot_mails_dropped_total', 'New mails dropped by a rule before their body was fetched.', ('account', 'folder'))
+
+
+def _status_value(data: list, item: str) -> int | None:
+  """
+    Read a numeric item from a STATUS response, e.g. `INBOX (UIDNEXT 42 UIDVALIDITY 1)`.
+  """
+  match = re.search(rf'\b{item} (\d+)'.encode(), data[0] or b'')
+  return int(match.group(1)) if match else None
+
+
+def _uid_set(uids: list[int]) -> str:
+  """
+    Build a compact IMAP sequence set from sorted UIDs, e.g. [1, 2, 3, 7] -> `1:3,7`.
+  """
+  ranges: list[str] = []
+  start = prev = uids[0]
+  for uid in uids[1:] + [None]:
+    if uid != prev + 1:
+      ranges.append(str(start) if start == prev else f'{start}:{prev}')
+      start = uid
+    prev = uid
+  return ','.join(ranges)
+
+
+def _response_size(data: list) -> int:
+  """
+    Number of bytes in an imaplib response, literals included.
+  """
+  return sum(
+    sum(len(piece) for piece in item) if isinstance(item, tuple) else len(item or b'')
+    for item in data
+  )
+
+
+def _summary_parts(parts: list[BodyPart]) -> list[BodyPart]:
+  """
+    The parts `get_email_summary` reads: every text/plain part, plus
+    the text/html ones when there is no non-empty plain text.
+  """
+  plain = [part for part in parts if part.content_type == 'text/plain']
+  if any(part.size for part in plain):
+    return plain
+  return plain + [part for part in parts if part.content_type == 'text/html']
+
+
+class _SocketLines:
+  """
+    Minimal CRLF line reader on the raw IMAP socket, used while idling.
+    imaplib's buffered file becomes unusable after a read timeout,
+    so IDLE reads bypass it.
+  """
+  def __init__(self, sock):
+    self.__sock = sock
+    self.__buffer = b''
+
+  def readline(self, deadline: float) -> bytes | None:
+    """
+      Return the next line without CRLF, or None if `deadline` (monotonic) passes first.
+    """
+    while b'\r\n' not in self.__buffer:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return None
+      self.__sock.settimeout(remaining)
+      try:
+        chunk = self.__sock.recv(4096)
+      except TimeoutError:
+        return None
+      if not chunk:
+        raise imaplib.IMAP4.abort('connection closed while idling')
+      self.__buffer += chunk
+    line, self.__buffer = self.__buffer.split(b'\r\n', 1)
+    return line
+
+
+class ImapConnection:
+  """
+    One authenticated IMAP session. All watched folders of an account share it,
+    selecting their folder in turn.
+  """
+  def __init__(self, server: str, username: str, password: str, use_idle: bool = True, idle_timeout: int = 1500,
+               port: int | None = None, ssl: bool = True):
+    self.__server = server
+    self.__account = f'{username}@{server}'
+    self.__port = port
+    self.__ssl = ssl
+    self.__username = username
+    self.__password = password
+    self.__use_idle = use_idle
+    self.__idle_timeout = min(idle_timeout, _IDLE_MAX_SECONDS)
     self.__imap = None
+    self.__selected: str | None = None
+    self.__capabilities: set[str] = set()
+    self.__sidecar: ImapConnection | None = None
+    self.__sidecar_lock = threading.Lock()
     self.__connect()
-    self.__lastUid = self.__get_max_uid()
+
+  @property
+  def server(self) -> str:
+    return self.__server
+
+  @property
+  def username(self) -> str:
+    return self.__username
+
+  @property
+  def account(self) -> str:
+    """
+      `username@server`, as used in metric labels.
+    """
+    return self.__account
+
+  @property
+  def imap(self) -> imaplib.IMAP4:
+    return self.__imap
 
   def __connect(self):
     """
       Establish IMAP connection and authenticate.
       Raises on failure so callers can decide how to handle it.
     """
-    self.__imap = imaplib.IMAP4_SSL(self.__mail_server)
-    self.__imap.login(self.__mail_username, self.__mail_password)
+    if self.__ssl:
+      self.__imap = imaplib.IMAP4_SSL(self.__server, self.__port or imaplib.IMAP4_SSL_PORT)
+    else:
+      # Unencrypted, for local servers and test setups only.
+      self.__imap = imaplib.IMAP4(self.__server, self.__port or imaplib.IMAP4_PORT)
+    self.__selected = None
+    self.__imap.login(self.__username, self.__password)
+    # Servers may advertise more capabilities once authenticated.
+    _, data = self.__imap.capability()
+    self.__capabilities = set(data[-1].decode().upper().split())
+    self.__imap.capabilities = tuple(self.__capabilities)
+    if self.__capabilities & {'CONDSTORE', 'QRESYNC'} and 'ENABLE' in self.__capabilities:
+      # Makes SELECT report HIGHESTMODSEQ (RFC 7162).
+      self.__imap.enable('CONDSTORE')
 
   def __reconnect(self):
     """
       Re-establish IMAP connection after a failure.
     """
-    logging.info('Reconnecting to IMAP server...')
+    logging.info(f'Reconnecting to IMAP server {self.__server}...')
+    _RECONNECTS.inc(account=self.__account)
     try:
       self.__connect()
       logging.info('Reconnected successfully.')
@@ -40,82 +196,561 @@ class Mailbox:
       logging.error(f'Reconnect failed: {e}')
       raise
 
-  def __ensure_connected(self):
+  def ensureConnected(self):
     """
       Ensure we have a working IMAP connection.
       Try a NOOP to check; reconnect if it fails.
     """
     try:
-      self.__imap.noop()
+      with _IMAP_SECONDS.time(account=self.__account, command='NOOP'):
+        self.__imap.noop()
     except Exception:
       self.__reconnect()
 
-  def getUnseenMails(self) -> list[Message]:
+  def select(self, folder: str):
+    """
+      Select a folder. Its response codes stay available through `imap.response()`.
+    """
+    self.__selected = None
+    with _IMAP_SECONDS.time(account=self.__account, command='SELECT'):
+      self.__imap.select(folder)
+    # Drop the counts SELECT reported, so any EXISTS kept from now on announces a change.
+    self.__imap.response('EXISTS')
+    self.__imap.response('EXPUNGE')
+    self.__selected = folder
+
+  def status(self, folder: str, items: str) -> tuple[str, list]:
+    """
+      Run STATUS on `folder`, see `imaplib.IMAP4.status`.
+    """
+    with _IMAP_SECONDS.time(account=self.__account, command='STATUS'):
+      return self.__imap.status(folder, items)
+
+  def uid(self, command: str, *args) -> tuple[str, list]:
+    """
+      Run a UID command (SEARCH, FETCH, STORE...), see `imaplib.IMAP4.uid`.
+    """
+    with _IMAP_SECONDS.time(account=self.__account, command=command.upper()):
+      typ, data = self.__imap.uid(command, *args)
+    if command.upper() == 'FETCH':
+      _IMAP_BYTES.inc(_response_size(data), account=self.__account)
+    return typ, data
+
+  @contextmanager
+  def sidecar(self):
     """
-    Get unseen mails since the last processed UID.
-    Handles connection failures by reconnecting and retrying once.
+      A second connection to the same account, for on-demand downloads from
+      other threads while this one is busy or idling. Opened on first use and
+      used by one thread at a time.
     """
+    with self.__sidecar_lock:
+      if self.__sidecar is None:
+        self.__sidecar = ImapConnection(self.__server, self.__username, self.__password, use_idle=False,
+                                        port=self.__port, ssl=self.__ssl)
+      else:
+        self.__sidecar.ensureConnected()
+      yield self.__sidecar
+
+  def close(self):
+    """
+      Log out, along with the sidecar connection. Errors are ignored, as the
+      connection is given up either way.
+    """
+    with self.__sidecar_lock:
+      if self.__sidecar is not None:
+        self.__sidecar.close()
+        self.__sidecar = None
     try:
-      self.__ensure_connected()
-      uids = self.__get_uids()
+      self.__imap.logout()
     except Exception as e:
-      logging.error(f'Error while fetching UIDs: {e}')
-      return []
+      logging.debug(f'Error while logging out of {self.__account}: {e}')
 
-    uids = [uid for uid in uids if uid > self.__lastUid]
-    logging.debug('Unseen UIDs: ' + str(uids))
+  def supportsIdle(self) -> bool:
+    """
+      Whether push mode can be used: enabled in config and advertised by the server.
+    """
+    return self.__use_idle and 'IDLE' in self.__capabilities
 
-    if len(uids) == 0:
-      return []
+  def waitForMail(self, folder: str) -> bool:
+    """
+      Block in IMAP IDLE on `folder` until the server announces new mail or
+      the IDLE timeout passes, whichever comes first.
+      Returns False when push mode is unavailable (not supported, disabled
+      or the IDLE session failed); the caller should then sleep and poll.
+    """
+    if not self.supportsIdle():
+      return False
 
-    mails: list[Message] = []
-    for uid in uids:
+    try:
+      self.ensureConnected()
+      if self.__selected != folder:
+        self.select(folder)
+      elif self.__announced_new_mail():
+        # Mail that arrived after the last poll, announced outside IDLE (e.g. on NOOP);
+        # the server won't announce it again once IDLE starts.
+        return True
+      self.__idle(self.__idle_timeout)
+      return True
+    except Exception as e:
+      logging.error(f'Error while idling: {e}')
+      _IMAP_ERRORS.inc(account=self.__account, stage='idle')
+      return False
+
+  def __announced_new_mail(self) -> bool:
+    """
+      Whether the server sent an untagged EXISTS since the last SELECT (or the
+      last call), which imaplib kept. Any EXISTS counts, not only a larger one:
+      with mail expunged in between, new mail can leave the count unchanged.
+      At worst this costs a poll that finds nothing.
+    """
+    _, data = self.__imap.response('EXISTS')
+    # Expunged mail needs no notification; drained so it doesn't pile up.
+    self.__imap.response('EXPUNGE')
+    return any(count is not None for count in data)
+
+  def __idle(self, timeout: float) -> bool:
+    """
+      Run a single IDLE command for at most `timeout` seconds.
+      Returns True if the server reported new messages (EXISTS).
+    """
+    sock = self.__imap.sock
+    saved_timeout = sock.gettimeout()
+    lines = _SocketLines(sock)
+    tag = self.__imap._new_tag()
+
+    try:
+      self.__imap.send(tag + b' IDLE\r\n')
+      line = lines.readline(time.monotonic() + _IDLE_DONE_TIMEOUT)
+      if line is None or not line.startswith(b'+'):
+        raise imaplib.IMAP4.error(f'IDLE rejected: {line!r}')
+      logging.debug('Idling...')
+
+      has_new_mail = False
+      deadline = time.monotonic() + timeout
+      while not has_new_mail:
+        line = lines.readline(deadline)
+        if line is None:
+          break
+        logging.debug(f'IDLE: {line!r}')
+        # Untagged "* <n> EXISTS" means the message count changed.
+        has_new_mail = line.startswith(b'* ') and line.upper().endswith(b' EXISTS')
+
+      self.__imap.send(b'DONE\r\n')
+      deadline = time.monotonic() + _IDLE_DONE_TIMEOUT
+      while True:
+        line = lines.readline(deadline)
+        if line is None:
+          raise imaplib.IMAP4.abort('timed out waiting for IDLE to finish')
+        if line.startswith(tag + b' '):
+          break
+      if not line[len(tag) + 1:].upper().startswith(b'OK'):
+        raise imaplib.IMAP4.error(f'IDLE failed: {line!r}')
+    finally:
+      sock.settimeout(saved_timeout)
+
+    return has_new_mail
+
+
+class Mailbox:
+  """
+    Tracks new mail in one folder over a (possibly shared) ImapConnection.
+  """
+  def __init__(self, connection: ImapConnection, folder: str, checkpoints: CheckpointStore,
+               remains_unread: bool = True, fetch_batch_size: int = 25, rules: RuleSet | None = None):
+    self.__conn = connection
+    self.__mail_server = connection.server
+    self.__mail_username = connection.username
+    self.__mail_folder = folder
+    self.__mail_remains_unread = remains_unread
+    self.__fetch_batch_size = max(fetch_batch_size, 1)
+    self.__rules = rules
+    self.__failed = False
+    self.__uidvalidity: int | None = None
+    self.__uidnext: int | None = None
+    self.__modseq: int | None = None
+    self.__seen_modseq: int | None = None
+    self.__checkpoints = checkpoints
+    self.__lastUid = self.__get_start_uid()
+    self.__save_checkpoint()
+
+  @property
+  def folder(self) -> str:
+    return self.__mail_folder
+
+  @property
+  def failed(self) -> bool:
+    """
+      Whether the last poll ended with an IMAP error (connection lost, server throttling...).
+    """
+    return self.__failed
+
+  def supportsIdle(self) -> bool:
+    return self.__conn.supportsIdle()
+
+  def waitForMail(self) -> bool:
+    """
+      Wait for new mail in this folder with IMAP IDLE, see `ImapConnection.waitForMail`.
+    """
+    return self.__conn.waitForMail(self.__mail_folder)
+
+  def getUnseenMails(self) -> Generator[NotificationPayload, None, None]:
+    """
+    Yield the mails received since the last processed UID, one at a time.
+
+    Mails are fetched in batches of `fetch_batch_size` but built only as the
+    caller asks for them, and each one is compacted as soon as its summary is
+    ready, so memory use depends on the batch size rather than on the backlog.
+    The checkpoint moves past a batch once all its mails have been handed over.
+    Connection failures are logged and end the poll; the next poll retries the
+    unfinished batch. So does a caller throwing an error into the generator
+    when it can't take a mail.
+    """
+    labels = {'account': self.__conn.account, 'folder': self.__mail_folder}
+    self.__failed = False
+    # Time spent polling, without the time the caller spends on each mail.
+    busy = 0.0
+    resumed = time.perf_counter()
+    try:
       try:
-        _, body = self.__imap.uid('fetch', str(uid), 'BODY[]')
-        message = email.message_from_bytes(body[0][1])
-        mails.append(message)
-        if self.__mail_remains_unread: self.__mark_as_unread(uid)
-        # Advance lastUid per successfully processed email,
-        # so a failure mid-batch doesn't skip earlier successes
-        # or re-send them on the next poll.
-        self.__lastUid = uid
+        self.__conn.ensureConnected()
+        uids = self.__get_new_uids()
       except Exception as e:
-        logging.error(f'Error while fetching mail {uid}: {e}')
-        # Stop processing this batch — connection is likely dead.
-        # Successfully fetched mails are returned; remaining UIDs
-        # (including this one) will be retried on the next poll
-        # because lastUid was only advanced for successes.
-        break
+        logging.error(f'Error while fetching UIDs: {e}')
+        _IMAP_ERRORS.inc(account=labels['account'], stage='search')
+        self.__failed = True
+        return
+
+      logging.debug('Unseen UIDs: ' + str(uids))
+
+      for start in range(0, len(uids), self.__fetch_batch_size):
+        batch = uids[start:start + self.__fetch_batch_size]
+        try:
+          structures, fetched, routes = self.__fetch_batch(batch)
+        except Exception as e:
+          logging.error(f'Error while fetching mails {batch[0]}-{batch[-1]}: {e}')
+          _IMAP_ERRORS.inc(account=labels['account'], stage='fetch')
+          self.__failed = True
+          # Stop processing — connection is likely dead.
+          # This batch and the remaining ones will be retried on the next poll
+          # because lastUid was only advanced for completed batches.
+          return
+
+        for uid in batch:
+          # Popped, so each mail's fetched text is released once it is built.
+          mail = self.__build(uid, structures.pop(uid, None), fetched.pop(uid, {}), routes.get(uid))
+          if mail is None:
+            continue
+          _MAILS.inc(**labels)
+          busy += time.perf_counter() - resumed
+          resumed = None
+          try:
+            yield mail
+          except Exception as e:
+            # Thrown back by the caller: the mail wasn't handed over, so the
+            # checkpoint stays before this batch and the next poll retries it.
+            logging.error(f'Failed to hand over mail {uid}, retrying it on the next poll: {e}')
+            self.__failed = True
+            return
+          resumed = time.perf_counter()
+
+        self.__lastUid = batch[-1]
+        self.__save_checkpoint()
+
+      # Only a fully processed poll may short-circuit the next search.
+      self.__seen_modseq = self.__modseq
+    finally:
+      _POLL_SECONDS.observe(busy + (time.perf_counter() - resumed if resumed is not None else 0), **labels)
+
+  def getMails(self, uidvalidity: int | None, uids: list[int]) -> Generator[NotificationPayload, None, None]:
+    """
+    Yield specific mails again, e.g. the ones the outbox still has to deliver
+    after a restart. The checkpoint is left alone. Nothing is yielded when the
+    folder's UIDVALIDITY is no longer `uidvalidity`, as the UIDs then point
+    to other mails; mails since expunged are skipped.
+    """
+    try:
+      self.__conn.ensureConnected()
+      self.__select()
+    except Exception as e:
+      logging.error(f'Error while selecting {self.__mail_folder}: {e}')
+      _IMAP_ERRORS.inc(account=self.__conn.account, stage='search')
+      return
+    if uidvalidity != self.__uidvalidity:
+      logging.warning(f'UIDVALIDITY of {self.__mail_folder} changed, not fetching {len(uids)} unfinished mail(s) again.')
+      return
+
+    for start in range(0, len(uids), self.__fetch_batch_size):
+      batch = uids[start:start + self.__fetch_batch_size]
+      try:
+        structures, fetched, routes = self.__fetch_batch(batch)
+      except Exception as e:
+        logging.error(f'Error while fetching mails {batch[0]}-{batch[-1]}: {e}')
+        _IMAP_ERRORS.inc(account=self.__conn.account, stage='fetch')
+        return
+      for uid in batch:
+        mail = self.__build(uid, structures.pop(uid, None), fetched.pop(uid, {}), routes.get(uid))
+        if mail is None:
+          continue
+        try:
+          yield mail
+        except Exception as e:
+          # Thrown back by the caller; the outbox still lists the mail for the next start.
+          logging.error(f'Failed to hand over mail {uid} again: {e}')
+          return
+
+  def __fetch_batch(self, uids: list[int]) -> tuple[dict[int, tuple[bytes, list[BodyPart]]], dict[int, dict[str, object]],
+                                                   dict[int, frozenset[str] | None]]:
+    """
+      Fetch a batch of mails: structure and headers first, then the text parts
+      the summary is built from, with one FETCH per distinct set of sections.
+      Mails whose structure can't be parsed are downloaded whole.
+      The rules run on the headers in between, so the text of dropped mails
+      is never downloaded.
+      Returns the headers and structure by UID, the fetched items by UID,
+      and the senders each mail is routed to by UID.
+    """
+    # BODY.PEEK leaves \Seen alone; plain BODY[HEADER] marks the mail as read.
+    header_item = 'BODY.PEEK[HEADER]' if self.__mail_remains_unread else 'BODY[HEADER]'
+    _, data = self.__conn.uid('FETCH', _uid_set(uids), f'(UID BODYSTRUCTURE {header_item})')
+
+    structures: dict[int, tuple[bytes, list[BodyPart]]] = {}
+    whole: list[int] = []
+    for item in parse_fetch_response(data):
+      if 'UID' not in item:
+        continue
+      uid = int(item['UID'])
+      try:
+        structures[uid] = (item['BODY[HEADER]'], body_parts(item['BODYSTRUCTURE']))
+      except Exception as e:
+        logging.warning(f'Unable to read the structure of mail {uid}, fetching it whole: {e}')
+        whole.append(uid)
+
+    routes: dict[int, frozenset[str] | None] = {}
+    if self.__rules is not None:
+      parser = email.parser.BytesHeaderParser()
+      for uid in list(structures):
+        routes[uid] = self.__route(uid, parser.parsebytes(structures[uid][0]))
+        if routes[uid] is not None and not routes[uid]:
+          del structures[uid]
+
+    groups: dict[tuple[str, ...], list[int]] = {}
+    for uid in uids:
+      if uid in structures:
+        sections = tuple(part.section for part in _summary_parts(structures[uid][1]))
+        groups.setdefault(sections, []).append(uid)
+
+    fetched: dict[int, dict[str, object]] = {}
+    for sections, group in groups.items():
+      if sections:
+        items = ' '.join(f'BODY.PEEK[{section}]' for section in sections)
+        _, data = self.__conn.uid('FETCH', _uid_set(group), f'(UID {items})')
+        fetched.update((int(item['UID']), item) for item in parse_fetch_response(data) if 'UID' in item)
+
+    if whole:
+      item = 'BODY.PEEK[]' if self.__mail_remains_unread else 'BODY[]'
+      _, data = self.__conn.uid('FETCH', _uid_set(sorted(whole)), f'(UID {item})')
+      fetched.update((int(item['UID']), item) for item in parse_fetch_response(data) if 'UID' in item)
+
+    return structures, fetched, routes
+
+  def __route(self, uid: int, headers: Message) -> frozenset[str] | None:
+    """
+      The senders the rules route a mail to (empty when dropped, None for all).
+      A mail the rules fail on goes to every sender.
+    """
+    try:
+      route = self.__rules.route(headers)
+    except Exception as e:
+      logging.error(f'Unable to apply the rules to mail {uid}, notifying every sender: {e}')
+      return None
+    if route is not None and not route:
+      logging.debug(f'Mail {uid} dropped by a rule.')
+      _DROPPED.inc(account=self.__conn.account, folder=self.__mail_folder)
+    return route
+
+  def __build(self, uid: int, structure: tuple[bytes, list[BodyPart]] | None, fetched: dict[str, object],
+              route: frozenset[str] | None) -> NotificationPayload | None:
+    """
+      Build the compacted payload of a fetched mail, for the senders in `route`.
+      Returns None for mails expunged since the search, which are simply
+      missing from the responses, or dropped by a rule, and for mails that
+      can't be parsed, which are logged and skipped.
+    """
+    try:
+      with _PARSE_SECONDS.time(account=self.__conn.account):
+        if structure is not None:
+          header, parts = structure
+          return self.__build_payload(uid, header, parts, fetched, route).compact()
+        if isinstance(fetched.get('BODY[]'), bytes):
+          message = email.message_from_bytes(fetched['BODY[]'])
+          if self.__rules is not None:
+            route = self.__route(uid, message)
+            if route is not None and not route:
+              return None
+          return NotificationPayload(message, source=self.__source(uid), senders=route).compact()
+        return None
+    except Exception as e:
+      logging.error(f'Unable to parse mail {uid}, skipping it: {e}')
+      _IMAP_ERRORS.inc(account=self.__conn.account, stage='parse')
+      return None
+
+  def __build_payload(self, uid: int, header: bytes, parts: list[BodyPart], fetched: dict[str, object],
+                      route: frozenset[str] | None) -> NotificationPayload:
+    """
+      Assemble a payload from the headers and fetched text parts of a mail.
+      The attachments are downloaded when a sender reads them.
+    """
+    message = email.message_from_bytes(header)
+    text_parts: list[Message] = []
+    for part in _summary_parts(parts):
+      raw = fetched.get(f'BODY[{part.section}]') or b''
+      text_part = part.headers()
+      text_part.set_payload(raw.decode('ascii', 'surrogateescape'))
+      text_parts.append(text_part)
+
+    if message.get_content_maintype() != 'multipart':
+      # Single-part mail: the top-level headers describe the body.
+      if text_parts:
+        message.set_payload(text_parts[0].get_payload())
+    else:
+      # Each part, even a multipart's only one, keeps its own headers.
+      message.set_payload(text_parts)
+
+    attachments = tuple(
+      Attachment(
+        decode_header_string(part.headers().get_filename('Untitled attachment')),
+        part.content_type,
+        functools.partial(self.__part_chunks, uid, part.section),
+        part.encoding,
+        part.size,
+      )
+      for part in parts
+      if part.disposition == 'attachment'
+    )
+    return NotificationPayload(message, attachments, source=self.__source(uid), senders=route)
+
+  def __source(self, uid: int) -> MailSource:
+    return MailSource(self.__mail_server, self.__mail_username, self.__mail_folder, self.__uidvalidity, uid)
+
+  def __part_chunks(self, uid: int, section: str) -> Iterator[bytes]:
+    """
+      Stream one encoded body part with partial FETCHes (`BODY.PEEK[<section>]<offset.length>`),
+      so a large attachment is never held in memory whole. Called from sender
+      threads, so it goes through the account's sidecar connection.
+    """
+    with self.__conn.sidecar() as side:
+      side.select(self.__mail_folder)
+      _, uidvalidity = side.imap.response('UIDVALIDITY')
+      if self.__uidvalidity is not None and uidvalidity[-1] is not None and int(uidvalidity[-1]) != self.__uidvalidity:
+        raise LookupError(f'UIDVALIDITY of {self.__mail_folder} changed, mail {uid} is gone.')
 
-    return mails
+      offset = 0
+      while True:
+        _, data = side.uid('FETCH', str(uid), f'(UID BODY.PEEK[{section}]<{offset}.{_PART_CHUNK_SIZE}>)')
+        chunk = next((
+          item.get(f'BODY[{section}]<{offset}>')
+          for item in parse_fetch_response(data)
+          if item.get('UID') == str(uid).encode()
+        ), None)
+        if chunk is None and offset == 0:
+          raise LookupError(f'Mail {uid} is no longer in {self.__mail_folder}.')
+        if not chunk:
+          return
+        yield chunk
+        if len(chunk) < _PART_CHUNK_SIZE:
+          return
+        offset += len(chunk)
 
-  def __get_uids(self) -> list[int]:
+  def __select(self):
     """
-      Get all mail UIDs from the selected folder.
+      Select the folder and record the UIDVALIDITY, UIDNEXT and (with CONDSTORE)
+      HIGHESTMODSEQ the server reports for it.
     """
-    self.__imap.select(self.__mail_folder)
-    _, uids = self.__imap.uid('SEARCH', "ALL")
+    self.__conn.select(self.__mail_folder)
+    uidvalidity = self.__response_int('UIDVALIDITY')
+    self.__uidnext = self.__response_int('UIDNEXT')
+    self.__modseq = self.__response_int('HIGHESTMODSEQ')
+
+    if uidvalidity is not None and self.__uidvalidity is not None and uidvalidity != self.__uidvalidity:
+      # Old UIDs mean nothing after a UIDVALIDITY change, start over from the current end.
+      logging.warning(f'UIDVALIDITY of {self.__mail_folder} changed ({self.__uidvalidity} -> {uidvalidity}).')
+      self.__lastUid = self.__uidnext - 1 if self.__uidnext is not None else self.__search_max_uid()
+      self.__seen_modseq = None
+      self.__uidvalidity = uidvalidity
+      self.__save_checkpoint()
+    elif uidvalidity is not None:
+      self.__uidvalidity = uidvalidity
+
+  def __get_new_uids(self) -> list[int]:
+    """
+      Get UIDs above the last processed one.
+      Only `UID <lastUid+1>:*` is searched, and the search is skipped entirely
+      when HIGHESTMODSEQ or UIDNEXT show nothing was added since the last poll.
+    """
+    self.__select()
+    if self.__modseq is not None and self.__modseq == self.__seen_modseq:
+      return []
+    if self.__uidnext is not None and self.__uidnext <= self.__lastUid + 1:
+      return []
+
+    _, uids = self.__conn.uid('SEARCH', 'UID', f'{max(self.__lastUid + 1, 1)}:*')
     if not uids[0]:
       return []
-    return [int(uid) for uid in uids[0].split()]
+    # `n:*` always matches the highest UID, even when that is lower than n.
+    return sorted(uid for uid in map(int, uids[0].split()) if uid > self.__lastUid)
 
-  def __get_max_uid(self) -> int:
+  def __get_start_uid(self) -> int:
     """
-      Get the highest UID in the mailbox, or -1 if empty.
+      Get the UID to continue after: the checkpointed one if it's still valid,
+      otherwise the highest UID in the mailbox (0 if empty) from STATUS.
+      Neither requires listing the folder.
     """
     try:
-      uids = self.__get_uids()
-      return max(uids) if len(uids) > 0 else -1
+      _, data = self.__conn.status(self.__mail_folder, '(UIDNEXT UIDVALIDITY)')
+      self.__uidvalidity = _status_value(data, 'UIDVALIDITY')
+
+      checkpoint = self.__checkpoints.load(self.__mail_server, self.__mail_username, self.__mail_folder)
+      if checkpoint is not None:
+        uidvalidity, last_uid = checkpoint
+        if uidvalidity == self.__uidvalidity:
+          logging.info(f'Resuming {self.__mail_folder} after UID {last_uid}.')
+          return last_uid
+        logging.warning(f'UIDVALIDITY of {self.__mail_folder} changed ({uidvalidity} -> {self.__uidvalidity}), ignoring checkpoint.')
+
+      uidnext = _status_value(data, 'UIDNEXT')
+      if uidnext is not None:
+        return uidnext - 1
+      # Not every server reports UIDNEXT, ask for the highest UID instead.
+      self.__conn.select(self.__mail_folder)
+      return self.__search_max_uid()
     except Exception:
       logging.critical('Failed to read mailbox during startup.')
       raise
 
-  def __mark_as_unread(self, uid: int):
+  def __save_checkpoint(self):
     """
-      Mark mail as unread.
+      Persist the last processed UID. Failures are logged, not raised:
+      losing a checkpoint only means re-deciding the start position next time.
     """
-    logging.info(f'Mark mail {uid} as unread.')
+    _LAST_UID.set(self.__lastUid, account=self.__conn.account, folder=self.__mail_folder)
     try:
-      self.__imap.uid('STORE', str(uid), '-FLAGS', '(\\SEEN)')
+      self.__checkpoints.save(self.__mail_server, self.__mail_username, self.__mail_folder, self.__uidvalidity, self.__lastUid)
     except Exception as e:
-      logging.error(f'Error while marking mail {uid} as unread: {e}')
+      logging.error(f'Error while saving checkpoint: {e}')
+
+  def __search_max_uid(self) -> int:
+    """
+      Get the highest UID in the selected folder, or 0 if empty.
+    """
+    _, uids = self.__conn.uid('SEARCH', 'UID', '*')
+    return int(uids[0].split()[-1]) if uids[0] else 0
+
+  def __response_int(self, code: str) -> int | None:
+    """
+      Pop an integer response code (e.g. `[UIDNEXT 42]`) from the last command.
+    """
+    _, data = self.__conn.imap.response(code)
+    try:
+      return int(data[-1])
+    except (TypeError, ValueError, IndexError):
+      return None
@@ -1,26 +1,102 @@
+import atexit
 import time
 import os
 import logging
+import signal
+import sys
 
 from dotenv import load_dotenv
 load_dotenv()
 
 from Senders import get_senders
-from mailbot import Mailbox
-from random import randint
+from Senders.transport import get_transport
+from coalescer import Coalescer
+from config import load_accounts, load_rules
+from dispatcher import Dispatcher
+from helpers.checkpoint import CheckpointStore
+from helpers.lease import LeaseStore
+from helpers.metrics import start_metrics_server
+from helpers.outbox import Outbox
+from monitor import AccountMonitor
+from rules import RuleSet
 
-logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s \t %(levelname)s \t %(message)s')
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s \t %(levelname)s \t %(threadName)s \t %(message)s')
 interval = int(os.environ.get('INTERVAL', '30'))
+# Without the POLL_* bounds, the folder is polled every INTERVAL seconds as before.
+min_interval = int(os.environ.get('POLL_MIN_INTERVAL', str(interval)))
+max_interval = int(os.environ.get('POLL_MAX_INTERVAL', str(interval)))
+idle_timeout = int(os.environ.get('IMAP_IDLE_TIMEOUT', '1500'))
+fetch_batch_size = int(os.environ.get('IMAP_FETCH_BATCH_SIZE', '25'))
+metrics_port = int(os.environ.get('METRICS_PORT', '0'))
 
-mailbox = Mailbox()
+if metrics_port:
+    start_metrics_server(metrics_port, os.environ.get('METRICS_ADDRESS', ''))
+
+accounts = load_accounts()
 senders = get_senders()
+rules = load_rules()
+rule_set = RuleSet(rules, [sender.__class__.__name__ for sender in senders]) if rules else None
+if rules:
+    logging.info(f'Routing mail with {len(rules)} rule(s).')
+state_db = os.environ.get('STATE_DB', 'state.db')
+checkpoints = CheckpointStore(state_db)
+outbox = Outbox(state_db, retention=float(os.environ.get('OUTBOX_RETENTION_DAYS', '7')) * 86400)
+
+# Instances sharing STATE_DB split the accounts between them with leases.
+lease_ttl = float(os.environ.get('LEASE_TTL', '0'))
+leases = None
+if lease_ttl > 0:
+    leases = LeaseStore(state_db, ttl=lease_ttl, holder=os.environ.get('INSTANCE_ID') or None)
+    atexit.register(leases.close)
+    # Release the leases on `docker stop` too, so other instances take over right away.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+dispatcher = Dispatcher(
+    senders,
+    queue_size=int(os.environ.get('SENDER_QUEUE_SIZE', '1000')),
+    workers=int(os.environ.get('SENDER_WORKERS', '1')),
+    max_tries=int(os.environ.get('SENDER_MAX_TRIES', '20')),
+    retry_base=float(os.environ.get('SENDER_RETRY_BASE', '1')),
+    retry_max=float(os.environ.get('SENDER_RETRY_MAX', '300')),
+    outbox=outbox,
+)
+
+
+
+def deliver_now(payload):
+    dispatcher.submit(payload)
+
+
+def deliver_coalesced(payload):
+    # Record each mail while it waits for its digest, so a restart doesn't lose it.
+    if dispatcher.record(payload):
+        coalescer.add(payload)
+
+
+digest_window = float(os.environ.get('DIGEST_WINDOW', '0'))
+if digest_window > 0:
+    coalescer = Coalescer(
+        dispatcher.submit,
+        window=digest_window,
+        group_by=os.environ.get('DIGEST_GROUP_BY', 'sender'),
+        max_mails=int(os.environ.get('DIGEST_MAX_MAILS', '100')),
+    )
+    on_mail = deliver_coalesced
+else:
+    on_mail = deliver_now
+
+monitors = [
+    AccountMonitor(account, checkpoints, on_mail, interval=interval, idle_timeout=idle_timeout, fetch_batch_size=fetch_batch_size,
+                   outbox=outbox, leases=leases, rules=rule_set, min_interval=min_interval, max_interval=max_interval)
+    for account in accounts
+]
 
-logging.info('Sleep random time to avoid multiple instances running at the same time.')
-time.sleep(randint(0, interval))
+logging.info(f'Start checking {len(accounts)} account(s)...')
+for monitor in monitors:
+    monitor.start()
 
-logging.info('Start checking...')
 while (1):
-    for email in mailbox.getUnseenMails():
-        for sender in senders:
-            sender.send(message=email)
-    time.sleep(interval)
\ No newline at end of file
+    time.sleep(60)
+    stats = dispatcher.stats()
+    level = logging.INFO if any(s['depth'] or s['parked'] for s in stats.values()) else logging.DEBUG
+    logging.log(level, f'Sender queues: {stats}')
+    logging.debug(f'HTTP pools: {get_transport().stats()}')
@@ -0,0 +1,159 @@
+from typing import Callable, Generator
+import contextlib
+import logging
+import threading
+import time
+
+from config import AccountConfig
+from helpers.checkpoint import CheckpointStore
+from helpers.messages import NotificationPayload
+from helpers.lease import LeaseStore
+from helpers.metrics import Gauge
+from helpers.misc import AdaptiveInterval, backoff_delay
+from helpers.outbox import Outbox
+from mailbot import ImapConnection, Mailbox
+from rules import RuleSet
+
+_POLL_INTERVAL = Gauge('mailbot_poll_interval_seconds', 'Seconds until the next poll of an account.', ('account',))
+
+class AccountMonitor(threading.Thread):
+  """
+  Watches every configured folder of one account over a single IMAP connection.
+
+  Each account gets one thread. The threads spend nearly all their time blocked
+  on network I/O (IDLE or sleeping), so many accounts can share one process,
+  one set of senders and one checkpoint store.
+
+  Without IDLE, folders are polled at an interval that adapts to activity:
+  `min_interval` after new mail, growing during quiet periods up to
+  `max_interval`, and backing off on errors (see `AdaptiveInterval`).
+
+  With an `Outbox`, mails a sender was still trying to deliver when the
+  process stopped are fetched again and handed to `on_mail` before watching
+  starts.
+
+  With a `LeaseStore`, the account is only watched while this instance holds
+  its lease, so several instances can share the accounts. A monitor losing
+  its lease stops notifying right away, then stands by to take it back.
+  """
+
+  def __init__(self, account: AccountConfig, checkpoints: CheckpointStore, on_mail: Callable[[NotificationPayload], None],
+               interval: int, idle_timeout: int, fetch_batch_size: int, outbox: Outbox | None = None,
+               leases: LeaseStore | None = None, rules: RuleSet | None = None,
+               min_interval: int | None = None, max_interval: int | None = None):
+    super().__init__(name=f'imap-{account.username}@{account.server}', daemon=True)
+    self.__account = account
+    self.__checkpoints = checkpoints
+    self.__on_mail = on_mail
+    self.__interval = interval
+    self.__min_interval = min_interval if min_interval is not None else interval
+    self.__max_interval = max_interval if max_interval is not None else interval
+    self.__idle_timeout = idle_timeout
+    self.__fetch_batch_size = fetch_batch_size
+    self.__outbox = outbox
+    self.__leases = leases
+    self.__rules = rules
+    self.__lease_name = f'{account.username}@{account.server}'
+    if leases is not None:
+      leases.register([self.__lease_name])
+
+  def run(self):
+    while True:
+      if self.__leases is not None:
+        self.__leases.wait(self.__lease_name)
+      connection, mailboxes = self.__open()
+      try:
+        self.__watch(mailboxes)
+      finally:
+        connection.close()
+      logging.warning(f'Stopped watching {self.__lease_name}, its lease is gone.')
+
+  def __watch(self, mailboxes: list[Mailbox]):
+    """
+    Notify new mail in `mailboxes` for as long as the lease is held.
+    """
+    if self.__outbox is not None:
+      self.__recover(mailboxes)
+    # A connection can only IDLE on its selected folder,
+    # so push mode is used for accounts watching a single folder.
+    push = len(mailboxes) == 1 and mailboxes[0].supportsIdle()
+    interval = AdaptiveInterval(self.__interval, self.__min_interval, self.__max_interval)
+    logging.info(f'Watching {", ".join(m.folder for m in mailboxes)} '
+                 + ('with IDLE.' if push else f'every {interval.minimum:g} to {interval.maximum:g} seconds.'))
+
+    while self.__holds_lease():
+      found = False
+      for mailbox in mailboxes:
+        found = self.__deliver(mailbox.getUnseenMails()) > 0 or found
+      failed = any(mailbox.failed for mailbox in mailboxes)
+      # Returns as soon as the server pushes new mail; falls back to polling otherwise.
+      # A failed poll isn't left waiting for the next push, but retried after a backoff.
+      if push and not failed and mailboxes[0].waitForMail():
+        continue
+      # Without push, waitForMail returning means IDLE failed.
+      delay = interval.next(found, failed=push or failed)
+      _POLL_INTERVAL.set(delay, account=self.__lease_name)
+      logging.debug(f'Next poll in {delay:.1f} seconds.')
+      time.sleep(delay)
+
+  def __holds_lease(self) -> bool:
+    return self.__leases is None or self.__leases.held(self.__lease_name)
+
+  def __deliver(self, mails: Generator[NotificationPayload, None, None]) -> int:
+    """
+    Hand mails to `on_mail` until they run out or the lease is lost. Mails
+    left over stay behind the checkpoint for the next lease holder.
+    When `on_mail` fails (e.g. the outbox can't be written), the error is
+    thrown back into the mailbox, which ends the poll without moving the
+    checkpoint past the mail, so it is retried after the error backoff.
+    Returns the number of mails handed over.
+    """
+    count = 0
+    for email in mails:
+      if not self.__holds_lease():
+        break
+      try:
+        self.__on_mail(email)
+      except Exception as e:
+        with contextlib.suppress(StopIteration):
+          mails.throw(e)
+        break
+      count += 1
+    return count
+
+  def __recover(self, mailboxes: list[Mailbox]):
+    """
+    Deliver again the mails of these folders the outbox has unfinished deliveries for.
+    """
+    account = self.__account
+    try:
+      unfinished = self.__outbox.unfinished()
+    except Exception as e:
+      logging.error(f'Failed to read the outbox: {e}')
+      return
+    for mailbox in mailboxes:
+      for uidvalidity, uids in unfinished.get((account.server, account.username, mailbox.folder), {}).items():
+        logging.info(f'Retrying {len(uids)} undelivered mail(s) from {mailbox.folder}.')
+        self.__deliver(mailbox.getMails(uidvalidity, uids))
+
+  def __open(self) -> tuple[ImapConnection, list[Mailbox]]:
+    """
+    Connect and set up every folder, retrying with exponential backoff
+    (from the interval up to the maximum interval) until it succeeds.
+    """
+    account = self.__account
+    attempt = 0
+    while True:
+      try:
+        connection = ImapConnection(account.server, account.username, account.password,
+                                    use_idle=account.idle, idle_timeout=self.__idle_timeout,
+                                    port=account.port, ssl=account.ssl)
+        return connection, [
+          Mailbox(connection, folder, self.__checkpoints,
+                  remains_unread=account.remains_unread, fetch_batch_size=self.__fetch_batch_size, rules=self.__rules)
+          for folder in account.folders
+        ]
+      except Exception as e:
+        logging.error(f'Failed to open mailbox: {e}')
+        attempt += 1
+        time.sleep(backoff_delay(attempt, self.__interval, max(self.__max_interval, self.__interval)))
@@ -0,0 +1,150 @@
+from email.message import Message
+from email.utils import getaddresses
+from typing import Iterable
+import logging
+import re
+
+from config import RuleConfig
+from helpers.messages import extract_email_subject
+
+_LIST_ID_RE = re.compile(r'<([^>]*)>')
+
+
+def _sender_key(name: str) -> str:
+  """
+  `Telegram`, `telegram` and `TelegramSender` all name the TelegramSender.
+  """
+  return name.lower().removesuffix('sender')
+
+
+def _address_keys(values: Iterable[str]) -> set[str]:
+  """
+  The lowercased addresses in address headers, each also as its `@domain`.
+  """
+  keys = set()
+  for _, address in getaddresses([str(value) for value in values]):
+    address = address.lower()
+    if address:
+      keys.add(address)
+      if '@' in address:
+        keys.add('@' + address.rsplit('@', 1)[1])
+  return keys
+
+
+def _list_id(value: str) -> str:
+  """
+  The id of a List-Id header (`Name <id>`), lowercased.
+  """
+  match = _LIST_ID_RE.search(value)
+  return (match.group(1) if match else value).strip().lower()
+
+
+class RuleSet:
+  """
+  Routing rules compiled into lookup tables, so that routing a mail costs a
+  few dict lookups whatever the number of rules, plus the subject searches
+  of the rules the other conditions left in the running.
+
+  Each rule is a bit. Every condition (From, To/Cc, List-Id, Subject) yields
+  the set of rules it allows as a bit mask: the rules it matches through a
+  hash lookup (addresses, domains, list ids) or their subject patterns, plus
+  the rules without that condition. The lowest bit left after and-ing the
+  masks is the first matching rule.
+
+  Subject patterns are compiled one by one rather than into one combined
+  regex, where inline flags, backreferences and group names of different
+  patterns would clash.
+
+  Args:
+    rules (list[RuleConfig]): The rules, in order.
+    senders (Iterable[str]): Names of the enabled senders, which rules refer to.
+
+  Raises:
+    ValueError: If a subject pattern is not a valid regular expression.
+  """
+
+  def __init__(self, rules: list[RuleConfig], senders: Iterable[str]):
+    known = {_sender_key(name): name for name in senders}
+    self.__routes: list[frozenset[str]] = []
+    self.__all = (1 << len(rules)) - 1
+    self.__from: dict[str, int] = {}
+    self.__to: dict[str, int] = {}
+    self.__list_ids: dict[str, int] = {}
+    self.__any_list = 0
+    # Rules without the condition, which it therefore never rules out.
+    self.__free_from = self.__free_to = self.__free_list = self.__free_subject = 0
+    self.__subjects: list[tuple[list[re.Pattern], int]] = []
+
+    for number, rule in enumerate(rules, 1):
+      bit = 1 << (number - 1)
+      if rule.drop:
+        self.__routes.append(frozenset())
+      else:
+        unknown = [name for name in rule.senders if _sender_key(name) not in known]
+        if unknown:
+          logging.warning(f'Rule {number} names senders that are not enabled: {", ".join(unknown)}')
+        self.__routes.append(frozenset(known[_sender_key(name)] for name in rule.senders if _sender_key(name) in known))
+
+      for table, values in ((self.__from, rule.from_addresses), (self.__to, rule.to_addresses)):
+        for value in values:
+          key = value.strip().lower()
+          table[key] = table.get(key, 0) | bit
+      self.__free_from |= 0 if rule.from_addresses else bit
+      self.__free_to |= 0 if rule.to_addresses else bit
+
+      for value in rule.list_ids:
+        if value.strip() == '*':
+          self.__any_list |= bit
+        else:
+          key = _list_id(value)
+          self.__list_ids[key] = self.__list_ids.get(key, 0) | bit
+      self.__free_list |= 0 if rule.list_ids else bit
+
+      if rule.subjects:
+        patterns = []
+        for pattern in rule.subjects:
+          try:
+            patterns.append(re.compile(pattern, re.IGNORECASE))
+          except re.error as e:
+            raise ValueError(f'Rule {number}: invalid subject pattern {pattern!r}: {e}') from e
+        self.__subjects.append((patterns, bit))
+      else:
+        self.__free_subject |= bit
+
+  def route(self, headers: Message) -> frozenset[str] | None:
+    """
+    Decide where a mail goes from its From, To, Cc, Subject and List-Id headers.
+
+    Returns:
+      frozenset[str] | None: The names of the senders to deliver the mail
+        through, empty to drop it, or None when no rule matches and every
+        sender gets it.
+    """
+    mask = self.__all
+    if mask:
+      mask &= self.__free_from | self.__lookup(self.__from, _address_keys(headers.get_all('From', [])))
+    if mask:
+      recipients = _address_keys(headers.get_all('To', []) + headers.get_all('Cc', []))
+      mask &= self.__free_to | self.__lookup(self.__to, recipients)
+    if mask:
+      list_id = headers['List-Id']
+      listed = self.__any_list | self.__list_ids.get(_list_id(str(list_id)), 0) if list_id is not None else 0
+      mask &= self.__free_list | listed
+    if mask & ~self.__free_subject:
+      subject = extract_email_subject(headers) if headers['Subject'] is not None else ''
+      # Only the rules still in the running are searched.
+      mask &= self.__free_subject | sum(
+        bit for patterns, bit in self.__subjects
+        if mask & bit and any(pattern.search(subject) for pattern in patterns)
+      )
+    if not mask:
+      return None
+    # The lowest bit is the first rule that matched.
+    return self.__routes[(mask & -mask).bit_length() - 1]
+
+  @staticmethod
+  def __lookup(table: dict[str, int], keys: set[str]) -> int:
+    mask = 0
+    for key in keys:
+      mask |= table.get(key, 0)
+    return mask
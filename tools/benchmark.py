@@ -0,0 +1,240 @@
+"""
+Benchmark the parsing, attachment and formatting hot paths on a generated
+corpus of emails, and compare the results with a baseline saved earlier on
+the same machine.
+
+Every function is timed on every email it applies to (best of several runs),
+and its peak memory is measured in a separate run with tracemalloc. A result
+slower or larger than the baseline by more than the tolerance is reported as a
+regression, and the script exits with status 1.
+
+Usage:
+    python tools/benchmark.py
+    python tools/benchmark.py --filter summary --tolerance 2
+    python tools/benchmark.py --save-baseline
+
+Timings depend on the machine, so the baseline is not part of the repository:
+save one with --save-baseline before a change, then compare after it.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from typing import Callable
+from email.header import Header
+from email.message import Message
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from helpers.messages import SUMMARY_BUDGET, NotificationPayload, extract_email_subject, get_email_summary, iter_html_text
+from helpers.strings import compact_string
+from Senders.telegram_sender import _build_message_with_entities, _process_body
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+
+# Each benchmark runs at least this long (and at least MIN_RUNS times) to time it.
+MIN_SECONDS = 0.2
+MIN_RUNS = 3
+
+# Differences below these are noise, whatever the ratio.
+NOISE_MS = 0.05
+NOISE_KIB = 16
+
+_WORDS = ['invoice', 'meeting', 'update', 'please', 'review', 'the', 'attached', 'report', 'before', 'Friday',
+          'thanks', 'team', 'release', 'build', 'failed', 'on', 'main', 'deploy', 'customer', 'order']
+_CJK_EMOJI = '你好世界邮件通知测试こんにちは世界안녕하세요😀🎉🚀👍🔥📧✅❤️'
+
+
+def _sentence(rng: random.Random, words: int = 12) -> str:
+    return ' '.join(rng.choice(_WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def _headers(message: Message, subject: str):
+    message['From'] = 'Alice Example <alice@example.com>'
+    message['To'] = 'bob@example.com'
+    message['Subject'] = subject
+    message['Message-ID'] = '<benchmark@example.com>'
+
+
+def _plain(rng: random.Random) -> Message:
+    body = '\n\n'.join(_sentence(rng) for _ in range(20))
+    message = MIMEText(body, 'plain', 'utf-8')
+    _headers(message, 'Weekly update')
+    return message
+
+
+def _huge_html(rng: random.Random) -> Message:
+    rows = ''.join(
+        f'<tr><td><p>{_sentence(rng, 8)} <b>Deal {i}</b> '
+        f'<a href="https://shop.example.com/item/{i}?utm_source=mail">Buy now</a> '
+        f'https://shop.example.com/raw/{i} <i>limited_offer</i></p></td></tr>\n'
+        for i in range(20000)
+    )
+    html = f'<html><head><style>td {{ padding: 0 }}</style></head><body><table>{rows}</table></body></html>'
+    message = MIMEMultipart('alternative')
+    message.attach(MIMEText(html, 'html', 'utf-8'))
+    _headers(message, 'Huge sale')
+    return message
+
+
+def _cjk_emoji(rng: random.Random) -> Message:
+    lines = [''.join(rng.choice(_CJK_EMOJI) for _ in range(60)) for _ in range(300)]
+    html = ''.join(f'<p><b>{line[:10]}</b> {line} <a href="https://example.com/{i}">{line[:5]}</a></p>'
+                   for i, line in enumerate(lines))
+    message = MIMEMultipart('alternative')
+    message.attach(MIMEText(html, 'html', 'utf-8'))
+    _headers(message, Header('通知 😀 ' + _CJK_EMOJI, 'utf-8').encode())
+    return message
+
+
+def _nested_multipart(rng: random.Random) -> Message:
+    inner: Message = MIMEText(_sentence(rng), 'plain', 'utf-8')
+    for depth in range(30):
+        outer = MIMEMultipart('mixed' if depth % 2 else 'alternative')
+        outer.attach(inner)
+        outer.attach(MIMEText(f'<p>Level {depth}: {_sentence(rng)}</p>', 'html', 'utf-8'))
+        inner = outer
+    _headers(inner, 'Fwd: Fwd: Fwd: Re: nested')
+    return inner
+
+
+def _many_attachments(rng: random.Random) -> Message:
+    message = MIMEMultipart('mixed')
+    message.attach(MIMEText(_sentence(rng), 'plain', 'utf-8'))
+    for i in range(200):
+        attachment = MIMEApplication(rng.randbytes(50 * 1024))
+        attachment.add_header('Content-Disposition', 'attachment', filename=f'scan-{i:03}.pdf')
+        message.attach(attachment)
+    _headers(message, 'Scanned documents')
+    return message
+
+
+CORPUS = {
+    'plain': _plain,
+    'huge_html': _huge_html,
+    'cjk_emoji': _cjk_emoji,
+    'nested_multipart': _nested_multipart,
+    'many_attachments': _many_attachments,
+}
+
+
+def _raw_text(message: Message) -> str:
+    """The summary text before compacting, as the formatters and compact_string receive it."""
+    parts = []
+    for part in message.walk():
+        if part.get_content_type() == 'text/html':
+            parts.append(''.join(iter_html_text(part.get_payload(decode=True).decode())))
+        elif part.get_content_type() == 'text/plain':
+            parts.append(part.get_payload(decode=True).decode())
+    return ''.join(parts)
+
+
+def _open_attachments(message: Message):
+    """Index and decode every attachment the way the Telegram sender does: size estimate, then spooled decode."""
+    for attachment in NotificationPayload(message).attachments:
+        attachment.decoded_size
+        attachment.open().close()
+
+
+def build_benchmarks(corpus: dict[str, Message]) -> dict[str, Callable[[], object]]:
+    """Return the benchmarks by name, as zero-argument callables."""
+    benchmarks = {}
+    for name, message in corpus.items():
+        raw = _raw_text(message)
+        summary = get_email_summary(message, budget=SUMMARY_BUDGET)
+        benchmarks.update({
+            f'get_email_summary[{name}]': lambda m=message: get_email_summary(m, budget=SUMMARY_BUDGET),
+            f'extract_email_subject[{name}]': lambda m=message: extract_email_subject(m),
+            f'NotificationPayload.attachments[{name}]': lambda m=message: NotificationPayload(m).attachments,
+            f'Attachment.open[{name}]': lambda m=message: _open_attachments(m),
+            f'compact_string[{name}]': lambda t=raw: compact_string(t),
+            f'_process_body[{name}]': lambda s=summary: _process_body(s),
+            f'_build_message_with_entities[{name}]':
+                lambda s=summary: _build_message_with_entities('alice@example.com', 'bob@example.com', 'Subject', s),
+        })
+    return benchmarks
+
+
+def measure(func: Callable[[], object]) -> dict[str, float]:
+    """Best time per call in milliseconds, and peak traced memory in KiB."""
+    best = float('inf')
+    runs = 0
+    started = time.perf_counter()
+    while runs < MIN_RUNS or time.perf_counter() - started < MIN_SECONDS:
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+        runs += 1
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'ms': round(best * 1000, 3), 'peak_kib': round(peak / 1024, 1)}
+
+
+def _ratio(value: float, base: float) -> float:
+    return value / base if base else (1.0 if not value else float('inf'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the email parsing and formatting helpers.')
+    parser.add_argument('--filter', default='', help='Only run benchmarks whose name contains this string')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline file to compare with or save to')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='Report a regression when time or memory exceeds the baseline by this factor')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    corpus = {name: build(rng) for name, build in CORPUS.items()}
+    benchmarks = {name: func for name, func in build_benchmarks(corpus).items() if args.filter in name}
+
+    baseline = {}
+    if not args.save_baseline:
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        else:
+            print(f'No baseline at {args.baseline}, nothing to compare with; save one with --save-baseline.')
+
+    results = {}
+    regressions = []
+    print(f'{"benchmark":<50} {"ms":>10} {"peak KiB":>10} {"time x":>8} {"mem x":>8}')
+    for name, func in benchmarks.items():
+        result = results[name] = measure(func)
+        line = f'{name:<50} {result["ms"]:>10.3f} {result["peak_kib"]:>10.1f}'
+        if name in baseline:
+            time_ratio = _ratio(result['ms'], baseline[name]['ms'])
+            memory_ratio = _ratio(result['peak_kib'], baseline[name]['peak_kib'])
+            line += f' {time_ratio:>8.2f} {memory_ratio:>8.2f}'
+            slower = time_ratio > args.tolerance and result['ms'] - baseline[name]['ms'] > NOISE_MS
+            larger = memory_ratio > args.tolerance and result['peak_kib'] - baseline[name]['peak_kib'] > NOISE_KIB
+            if slower or larger:
+                regressions.append(name)
+                line += '  REGRESSION'
+        print(line, flush=True)
+
+    if args.save_baseline:
+        if args.filter and os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                results = {**json.load(f), **results}
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Baseline saved to {args.baseline}')
+    elif regressions:
+        print(f'{len(regressions)} regression(s) beyond {args.tolerance}x the baseline.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
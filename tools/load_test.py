@@ -0,0 +1,602 @@
+"""
+Run main.py against a local stand-in IMAP server and stub Bark/Telegram APIs,
+inject mail at a fixed rate, and report delivery latency, throughput and memory.
+
+The IMAP server supports what the bot uses: SELECT/EXAMINE, STATUS, SEARCH,
+FETCH (BODYSTRUCTURE, sections and partial fetches), STORE and IDLE. Both
+sides can inject failures: dropped IMAP connections, and HTTP 429 or 500
+answers from the stubs.
+
+Latency is measured from the moment a mail is added to the mailbox to the
+moment a stub receives the request naming it. Memory is the peak resident
+size of the main.py process.
+
+Usage:
+    python tools/load_test.py
+    python tools/load_test.py --mails 500 --rate 50 --senders bark
+    python tools/load_test.py --imap-drop 0.01 --http-429 0.05 --http-500 0.02
+    python tools/load_test.py --no-idle --attachments 2 --attachment-kb 512
+    python tools/load_test.py --attachments 2 --attachment-kb 512 --shared-attachments
+"""
+import argparse
+import email.utils
+import hashlib
+import http.server
+import json
+import os
+import random
+import re
+import resource
+import signal
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from email.message import Message
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.policy import SMTP
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+USERNAME = 'load@example.com'
+PASSWORD = 'secret'
+BARK_TOKEN = 'loadtoken'
+TELEGRAM_TOKEN = '123456:loadtest'
+TELEGRAM_CHAT_ID = '42'
+
+# Every injected mail carries its number in the subject, so stubs can tell which one they received.
+_MAIL_ID_RE = re.compile(rb'loadtest-(\d+)')
+
+
+# --- IMAP --------------------------------------------------------------------
+
+class FakeMailbox:
+    """The single folder served by `FakeImapServer`, shared by all its connections."""
+
+    def __init__(self):
+        self.messages: list[tuple[int, bytes, set[str]]] = []
+        self.uidvalidity = 1
+        self.uidnext = 1
+        self.changed = threading.Condition()
+
+    def add(self, raw: bytes):
+        with self.changed:
+            self.messages.append((self.uidnext, raw, set()))
+            self.uidnext += 1
+            self.changed.notify_all()
+
+    def snapshot(self) -> list[tuple[int, bytes, set[str]]]:
+        with self.changed:
+            return list(self.messages)
+
+
+def _quote(value) -> bytes:
+    if value is None:
+        return b'NIL'
+    return b'"' + str(value).replace('\\', '\\\\').replace('"', '\\"').encode() + b'"'
+
+
+def _params(params: list[tuple[str, str]]) -> bytes:
+    if not params:
+        return b'NIL'
+    return b'(' + b' '.join(_quote(key.upper()) + b' ' + _quote(value) for key, value in params) + b')'
+
+
+def _bodystructure(part: Message) -> bytes:
+    if part.is_multipart():
+        children = b''.join(_bodystructure(child) for child in part.get_payload())
+        return children.join((b'(', b' ' + _quote(part.get_content_subtype().upper()) + b' '
+                              + _params([('BOUNDARY', part.get_boundary())]) + b' NIL NIL NIL)'))
+    maintype, subtype = part.get_content_type().upper().split('/')
+    body = part.get_payload().encode('ascii', 'surrogateescape')
+    fields = [_quote(maintype), _quote(subtype), _params(part.get_params()[1:]), b'NIL', b'NIL',
+              _quote((part['Content-Transfer-Encoding'] or '7BIT').upper()), str(len(body)).encode()]
+    if maintype == 'TEXT':
+        fields.append(str(body.count(b'\n')).encode())
+    disposition = part.get_content_disposition()
+    if disposition:
+        disposition = b'(' + _quote(disposition.upper()) + b' ' + _params(part.get_params(header='Content-Disposition')[1:]) + b')'
+    fields += [b'NIL', disposition or b'NIL', b'NIL', b'NIL']
+    return b'(' + b' '.join(fields) + b')'
+
+
+def _section(raw: bytes, section: str) -> bytes:
+    if section == '':
+        return raw
+    if section == 'HEADER':
+        return raw[:raw.find(b'\r\n\r\n') + 4]
+    part = email.message_from_bytes(raw)
+    for number in map(int, section.split('.')):
+        if part.is_multipart():
+            part = part.get_payload()[number - 1]
+        elif number != 1:
+            return b''
+    return part.get_payload().encode('ascii', 'surrogateescape')
+
+
+def _sequence_set(text: str, largest: int) -> set[int]:
+    numbers = set()
+    for item in text.split(','):
+        first, _, last = item.partition(':')
+        first = largest if first == '*' else int(first)
+        last = first if not last else largest if last == '*' else int(last)
+        numbers.update(range(min(first, last), max(first, last) + 1))
+    return numbers
+
+
+class _ImapHandler(socketserver.StreamRequestHandler):
+    server: 'FakeImapServer'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.__write_lock = threading.Lock()
+        # Message count last told to this client, as a real server tracks it.
+        self.reported = 0
+
+    def write(self, data: bytes | str):
+        with self.__write_lock:
+            self.wfile.write(data.encode() if isinstance(data, str) else data)
+
+    def handle(self):
+        server = self.server
+        capabilities = 'IMAP4rev1 UIDPLUS' + (' IDLE' if server.idle else '')
+        self.write(f'* OK [CAPABILITY {capabilities}] Load test server ready\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.decode().rstrip('\r\n').partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+            if command not in ('LOGIN', 'CAPABILITY', 'LOGOUT') and server.should_drop():
+                return
+            if command == 'CAPABILITY':
+                self.write(f'* CAPABILITY {capabilities}\r\n{tag} OK CAPABILITY completed\r\n')
+            elif command == 'LOGIN':
+                if [arg.strip('"') for arg in args.split()] != [USERNAME, PASSWORD]:
+                    self.write(f'{tag} NO [AUTHENTICATIONFAILED] Invalid credentials\r\n')
+                else:
+                    self.write(f'{tag} OK LOGIN completed\r\n')
+            elif command in ('NOOP', 'CLOSE', 'CHECK'):
+                self.announce()
+                self.write(f'{tag} OK {command} completed\r\n')
+            elif command == 'LOGOUT':
+                self.write(f'* BYE Logging out\r\n{tag} OK LOGOUT completed\r\n')
+                return
+            elif command in ('SELECT', 'EXAMINE'):
+                self.select(tag)
+            elif command == 'STATUS':
+                self.write(f'* STATUS INBOX (MESSAGES {len(server.mailbox.messages)} UIDNEXT {server.mailbox.uidnext} '
+                           f'UIDVALIDITY {server.mailbox.uidvalidity})\r\n{tag} OK STATUS completed\r\n')
+            elif command == 'IDLE' and server.idle:
+                self.idle(tag)
+            elif command == 'UID':
+                subcommand, _, args = args.partition(' ')
+                self.dispatch(tag, subcommand.upper(), args, by_uid=True)
+            elif command in ('SEARCH', 'FETCH', 'STORE'):
+                self.dispatch(tag, command, args, by_uid=False)
+            else:
+                self.write(f'{tag} BAD Unknown command\r\n')
+
+    def select(self, tag: str):
+        mailbox = self.server.mailbox
+        messages = mailbox.snapshot()
+        self.reported = len(messages)
+        unseen = next((i + 1 for i, (_, _, flags) in enumerate(messages) if '\\Seen' not in flags), None)
+        self.write(f'* {len(messages)} EXISTS\r\n* 0 RECENT\r\n* FLAGS (\\Seen \\Answered \\Flagged \\Deleted \\Draft)\r\n'
+                   + (f'* OK [UNSEEN {unseen}] First unseen\r\n' if unseen else '')
+                   + f'* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid\r\n'
+                   f'* OK [UIDNEXT {mailbox.uidnext}] Predicted next UID\r\n'
+                   f'{tag} OK [READ-WRITE] SELECT completed\r\n')
+
+    def idle(self, tag: str):
+        mailbox = self.server.mailbox
+        self.write('+ idling\r\n')
+        done = threading.Event()
+
+        def watch():
+            with mailbox.changed:
+                while not done.is_set() and len(mailbox.messages) == self.reported:
+                    mailbox.changed.wait(0.5)
+            if not done.is_set():
+                try:
+                    self.announce()
+                except OSError:
+                    pass
+
+        threading.Thread(target=watch, daemon=True).start()
+        line = self.rfile.readline()
+        done.set()
+        if line.strip().upper() == b'DONE':
+            self.write(f'{tag} OK IDLE terminated\r\n')
+
+    def announce(self):
+        """Send an untagged EXISTS if mail arrived since the client was last told."""
+        count = len(self.server.mailbox.messages)
+        if count != self.reported:
+            self.reported = count
+            self.write(f'* {count} EXISTS\r\n')
+
+    def dispatch(self, tag: str, command: str, args: str, by_uid: bool):
+        messages = self.server.mailbox.snapshot()
+        largest = (messages[-1][0] if by_uid else len(messages)) if messages else 0
+        if command == 'SEARCH':
+            criteria = args.upper().split()
+            if criteria[:1] == ['UID']:
+                wanted = _sequence_set(criteria[1], largest)
+                matches = [(i, m) for i, m in enumerate(messages) if m[0] in wanted]
+            elif criteria[:1] == ['UNSEEN']:
+                matches = [(i, m) for i, m in enumerate(messages) if '\\Seen' not in m[2]]
+            elif criteria[:1] == ['ALL'] or not criteria:
+                matches = list(enumerate(messages))
+            else:
+                wanted = _sequence_set(criteria[0], largest)
+                matches = [(i, m) for i, m in enumerate(messages) if i + 1 in wanted]
+            found = ''.join(f' {m[0] if by_uid else i + 1}' for i, m in matches)
+            self.write(f'* SEARCH{found}\r\n{tag} OK SEARCH completed\r\n')
+        elif command in ('FETCH', 'STORE'):
+            numbers, _, items = args.partition(' ')
+            wanted = _sequence_set(numbers, largest)
+            for i, message in enumerate(messages):
+                if (message[0] if by_uid else i + 1) in wanted:
+                    if command == 'FETCH':
+                        self.fetch(i + 1, message, items)
+                    else:
+                        self.store(i + 1, message, items, by_uid)
+            self.write(f'{tag} OK {command} completed\r\n')
+        else:
+            self.write(f'{tag} BAD Unknown command\r\n')
+
+    def fetch(self, number: int, message: tuple[int, bytes, set[str]], items: str):
+        uid, raw, flags = message
+        parts = [b'UID %d' % uid]
+        for item in re.findall(r'BODYSTRUCTURE|FLAGS|RFC822\.SIZE|BODY(?:\.PEEK)?\[[^\]]*\](?:<\d+\.\d+>)?', items.upper()):
+            if item == 'BODYSTRUCTURE':
+                parts.append(b'BODYSTRUCTURE ' + _bodystructure(email.message_from_bytes(raw)))
+            elif item == 'FLAGS':
+                parts.append(f'FLAGS ({" ".join(sorted(flags))})'.encode())
+            elif item == 'RFC822.SIZE':
+                parts.append(b'RFC822.SIZE %d' % len(raw))
+            else:
+                if '.PEEK' not in item:
+                    flags.add('\\Seen')
+                section = item[item.index('[') + 1:item.index(']')]
+                data = _section(raw, section)
+                origin = b''
+                if item.endswith('>'):
+                    offset, length = map(int, item[item.index('<') + 1:-1].split('.'))
+                    data = data[offset:offset + length]
+                    origin = b'<%d>' % offset
+                parts.append(b'BODY[%s]%s {%d}\r\n' % (section.encode(), origin, len(data)) + data)
+        self.write(b'* %d FETCH (' % number + b' '.join(parts) + b')\r\n')
+
+    def store(self, number: int, message: tuple[int, bytes, set[str]], items: str, by_uid: bool):
+        uid, _, flags = message
+        action, _, values = items.partition(' ')
+        values = set(values.strip('()').split())
+        if action.upper().startswith('+'):
+            flags |= values
+        elif action.upper().startswith('-'):
+            flags -= values
+        else:
+            flags.clear()
+            flags |= values
+        if not action.upper().endswith('.SILENT'):
+            self.write(f'* {number} FETCH ({f"UID {uid} " if by_uid else ""}FLAGS ({" ".join(sorted(flags))}))\r\n')
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """
+    A single-folder IMAP server on localhost, good enough for the bot.
+    Each command after login is answered by closing the connection with
+    probability `drop_rate`.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, idle: bool = True, drop_rate: float = 0.0, seed: int = 0):
+        super().__init__(('127.0.0.1', 0), _ImapHandler)
+        self.mailbox = FakeMailbox()
+        self.idle = idle
+        self.drop_rate = drop_rate
+        self.dropped = 0
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def should_drop(self) -> bool:
+        with self.__lock:
+            if self.drop_rate and self.__random.random() < self.drop_rate:
+                self.dropped += 1
+                return True
+            return False
+
+
+# --- HTTP stubs --------------------------------------------------------------
+
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    server: 'SenderStubServer'
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.read_body()
+        received = time.monotonic()
+        server = self.server
+        channel = 'Telegram' if self.path.startswith('/bot') else 'Bark'
+        failure = server.failure()
+        if failure == 429:
+            if channel == 'Telegram':
+                self.reply(429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                 'parameters': {'retry_after': 1}})
+            else:
+                self.reply(429, {'code': 429, 'message': 'Too Many Requests'}, {'Retry-After': '1'})
+            return
+        if failure == 500:
+            if channel == 'Telegram':
+                self.reply(500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'})
+            else:
+                self.reply(500, {'code': 500, 'message': 'Internal Server Error'})
+            return
+
+        # telebot sends message fields in the query string, files in the body.
+        server.record(channel, self.path.split('?')[0].rsplit('/', 1)[-1], self.path.encode() + body, received)
+        if channel == 'Telegram':
+            result = {
+                'message_id': 1, 'date': int(time.time()), 'text': '',
+                'chat': {'id': int(TELEGRAM_CHAT_ID), 'type': 'private'},
+            }
+            if self.path.split('?')[0].endswith('/sendDocument'):
+                file_id = f'stub-{hashlib.sha256(body).hexdigest()[:16]}'
+                result['document'] = {'file_id': file_id, 'file_unique_id': file_id}
+            self.reply(200, {'ok': True, 'result': result})
+        else:
+            self.reply(200, {'code': 200, 'message': 'success', 'timestamp': int(time.time())})
+
+    def read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if not size:
+                    return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def reply(self, status: int, body: dict, headers: dict[str, str] | None = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class SenderStubServer(http.server.ThreadingHTTPServer):
+    """
+    Answers Bark (`POST /<token>`) and Telegram (`POST /bot<token>/<method>`)
+    requests on localhost, and records when each injected mail first reached
+    each channel. Requests fail with 429 or 500 at the given rates.
+    """
+    daemon_threads = True
+
+    def __init__(self, rate_limit_rate: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        super().__init__(('127.0.0.1', 0), _StubHandler)
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.arrivals: dict[str, dict[int, float]] = {}
+        self.requests: dict[str, int] = {}
+        self.received_bytes: dict[str, int] = {}
+        self.failures = {429: 0, 500: 0}
+        self.last_request = time.monotonic()
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def failure(self) -> int | None:
+        with self.__lock:
+            roll = self.__random.random()
+            self.last_request = time.monotonic()
+            status = 429 if roll < self.rate_limit_rate else 500 if roll < self.rate_limit_rate + self.error_rate else None
+            if status:
+                self.failures[status] += 1
+            return status
+
+    def record(self, channel: str, method: str, body: bytes, received: float):
+        with self.__lock:
+            self.requests[f'{channel} {method}'] = self.requests.get(f'{channel} {method}', 0) + 1
+            self.received_bytes[channel] = self.received_bytes.get(channel, 0) + len(body)
+            arrivals = self.arrivals.setdefault(channel, {})
+            for match in _MAIL_ID_RE.finditer(body):
+                arrivals.setdefault(int(match.group(1)), received)
+
+    def delivered(self, channel: str) -> int:
+        with self.__lock:
+            return len(self.arrivals.get(channel, {}))
+
+
+# --- Load --------------------------------------------------------------------
+
+def build_mail(number: int, rng: random.Random, html: bool, attachments: int, attachment_kb: int,
+               shared_attachments: bool = False) -> bytes:
+    """
+    A mail whose subject carries `loadtest-<number>`. With `shared_attachments`,
+    every mail carries the same attachments, like a logo or terms and conditions.
+    """
+    words = ' '.join(rng.choice(['report', 'invoice', 'meeting', 'update', 'please', 'review', 'thanks'])
+                     for _ in range(200))
+    body = MIMEText(f'<p>{words}</p>', 'html', 'utf-8') if html else MIMEText(words, 'plain', 'utf-8')
+    message = body
+    if attachments:
+        message = MIMEMultipart('mixed')
+        message.attach(body)
+        for i in range(attachments):
+            if shared_attachments:
+                attachment = MIMEApplication(random.Random(i).randbytes(attachment_kb * 1024))
+                attachment.add_header('Content-Disposition', 'attachment', filename=f'shared-{i}.bin')
+            else:
+                attachment = MIMEApplication(rng.randbytes(attachment_kb * 1024))
+                attachment.add_header('Content-Disposition', 'attachment', filename=f'file-{number}-{i}.bin')
+            message.attach(attachment)
+    message['From'] = f'Sender {number % 10} <sender{number % 10}@example.com>'
+    message['To'] = USERNAME
+    message['Subject'] = f'loadtest-{number} Weekly report'
+    message['Date'] = email.utils.formatdate()
+    message['Message-ID'] = f'<loadtest-{number}@example.com>'
+    return message.as_bytes(policy=SMTP)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def _is_watching(log_path: str) -> bool:
+    with open(log_path) as f:
+        return 'Watching ' in f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the whole bot against local IMAP and sender stubs.')
+    parser.add_argument('--mails', type=int, default=200, help='Mails to inject')
+    parser.add_argument('--rate', type=float, default=20, help='Mails injected per second')
+    parser.add_argument('--senders', default='bark,telegram', help='Comma-separated stubs to enable: bark, telegram')
+    parser.add_argument('--html', action='store_true', help='Send HTML mails instead of plain text')
+    parser.add_argument('--attachments', type=int, default=0, help='Attachments per mail')
+    parser.add_argument('--attachment-kb', type=int, default=64, help='Size of each attachment in KiB')
+    parser.add_argument('--shared-attachments', action='store_true', help='Attach the same files to every mail')
+    parser.add_argument('--no-idle', action='store_true', help="Don't advertise IDLE, so the bot polls every --interval")
+    parser.add_argument('--telegram-rate', type=float, default=100,
+                        help='TELEGRAM_CHAT_RATE and TELEGRAM_GLOBAL_RATE for the bot (1 and 30 in production)')
+    parser.add_argument('--interval', type=int, default=1, help='Polling interval for the bot (INTERVAL and both POLL_* bounds), in seconds')
+    parser.add_argument('--imap-drop', type=float, default=0.0, help='Probability of dropping the IMAP connection on a command')
+    parser.add_argument('--http-429', type=float, default=0.0, help='Fraction of sender requests answered with 429')
+    parser.add_argument('--http-500', type=float, default=0.0, help='Fraction of sender requests answered with 500')
+    parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for stragglers after the last mail')
+    parser.add_argument('--log', help='Write the bot\'s output to this file (default: a temporary file)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for mail content and failure injection')
+    args = parser.parse_args()
+
+    senders = {name.strip().lower() for name in args.senders.split(',') if name.strip()}
+    channels = [name for name, key in (('Bark', 'bark'), ('Telegram', 'telegram')) if key in senders]
+    if not channels:
+        parser.error('--senders must name bark and/or telegram')
+
+    imap = FakeImapServer(idle=not args.no_idle, drop_rate=args.imap_drop, seed=args.seed)
+    stubs = SenderStubServer(rate_limit_rate=args.http_429, error_rate=args.http_500, seed=args.seed)
+    for server in (imap, stubs):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    workdir = tempfile.mkdtemp(prefix='mailbot-load-')
+    log_path = args.log or os.path.join(workdir, 'main.log')
+    env = {
+        **os.environ,
+        # Explicit values win over a .env file, which main.py loads without overriding.
+        'IMAP_MAIL_SERVER': '127.0.0.1',
+        'IMAP_MAIL_PORT': str(imap.port),
+        'IMAP_MAIL_SSL': 'false',
+        'IMAP_MAIL_USERNAME': USERNAME,
+        'IMAP_MAIL_PASSWORD': PASSWORD,
+        'IMAP_MAIL_FOLDER': 'INBOX',
+        'MAILBOXES_CONFIG': '',
+        'INTERVAL': str(args.interval),
+        # A fixed polling interval, so runs are comparable whatever the mailbox's activity.
+        'POLL_MIN_INTERVAL': str(args.interval),
+        'POLL_MAX_INTERVAL': str(args.interval),
+        'STATE_DB': os.path.join(workdir, 'state.db'),
+        'PYTHONUNBUFFERED': '1',
+    }
+    for name in ('BARK_TOKEN', 'TELEGRAM_BOT_TOKEN', 'TELEGRAM_CHAT_ID'):
+        env.pop(name, None)
+    if 'Bark' in channels:
+        env.update(BARK_TOKEN=BARK_TOKEN, BARK_SERVER=stubs.url)
+    if 'Telegram' in channels:
+        env.update(TELEGRAM_BOT_TOKEN=TELEGRAM_TOKEN, TELEGRAM_CHAT_ID=TELEGRAM_CHAT_ID, TELEGRAM_API_URL=stubs.url,
+                   TELEGRAM_CHAT_RATE=str(args.telegram_rate), TELEGRAM_GLOBAL_RATE=str(args.telegram_rate))
+
+    rng = random.Random(args.seed)
+    mails = [build_mail(n, rng, args.html, args.attachments, args.attachment_kb, args.shared_attachments) for n in range(args.mails)]
+
+    with open(log_path, 'w') as log:
+        bot = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py')], cwd=ROOT, env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+    print(f'Bot started (pid {bot.pid}), IMAP on port {imap.port}, stubs at {stubs.url}, log in {log_path}')
+
+    injected: dict[int, float] = {}
+    try:
+        # Wait until the bot is watching the folder (it selects it), so startup doesn't count as latency.
+        deadline = time.monotonic() + 30
+        while not _is_watching(log_path) and time.monotonic() < deadline and bot.poll() is None:
+            time.sleep(0.1)
+        if bot.poll() is not None:
+            sys.exit(f'The bot exited with status {bot.returncode}, see {log_path}')
+
+        started = time.monotonic()
+        for number, raw in enumerate(mails):
+            time.sleep(max(0.0, started + number / args.rate - time.monotonic()))
+            injected[number] = time.monotonic()
+            imap.mailbox.add(raw)
+        print(f'Injected {len(mails)} mails in {time.monotonic() - started:.1f}s, waiting for delivery...')
+
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline and bot.poll() is None:
+            # Attachments follow a mail's message, so wait for requests to stop too.
+            if (all(stubs.delivered(channel) >= len(mails) for channel in channels)
+                    and time.monotonic() - stubs.last_request > 1):
+                break
+            time.sleep(0.1)
+    finally:
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(10)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+            bot.wait()
+
+    # ru_maxrss is in KiB on Linux, and in bytes on macOS.
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / (1024 if sys.platform != 'darwin' else 1024 * 1024)
+
+    print()
+    print(f'{"channel":<10} {"delivered":>10} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"max ms":>9} {"mails/s":>9}')
+    for channel in channels:
+        arrivals = stubs.arrivals.get(channel, {})
+        latencies = [(arrivals[n] - injected[n]) * 1000 for n in arrivals if n in injected]
+        if not latencies:
+            print(f'{channel:<10} {0:>10}')
+            continue
+        elapsed = max(arrivals.values()) - min(injected.values())
+        print(f'{channel:<10} {len(latencies):>10} {percentile(latencies, 0.5):>9.0f} {percentile(latencies, 0.9):>9.0f} '
+              f'{percentile(latencies, 0.99):>9.0f} {max(latencies):>9.0f} {len(latencies) / elapsed:>9.1f}')
+    print()
+    print(f'Peak RSS of the bot: {peak_rss:.1f} MiB')
+    print(f'Requests: {dict(sorted(stubs.requests.items()))}')
+    print(f'Received: {", ".join(f"{channel} {size / 1024 / 1024:.1f} MiB" for channel, size in sorted(stubs.received_bytes.items()))}')
+    print(f'Injected failures: {imap.dropped} IMAP connection(s) dropped, '
+          f'{stubs.failures[429]} HTTP 429, {stubs.failures[500]} HTTP 500')
+
+    imap.shutdown()
+    stubs.shutdown()
+    if any(stubs.delivered(channel) < len(mails) for channel in channels):
+        print(f'Some mails were not delivered, see {log_path}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
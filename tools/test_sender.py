@@ -18,6 +18,7 @@ from email.mime.text import MIMEText
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 from Senders import get_senders
+from helpers.messages import NotificationPayload
 
 
 def build_test_message(sender: str, to: str, subject: str, body: str) -> MIMEText:
@@ -43,13 +44,13 @@ def main():
         logging.warning('No senders are enabled. Check your environment variables.')
         return
 
-    message = build_test_message(args.sender, args.to, args.subject, args.body)
+    payload = NotificationPayload(build_test_message(args.sender, args.to, args.subject, args.body))
 
     for sender in senders:
         name = sender.__class__.__name__
         logging.info(f'Sending test message via {name}...')
         try:
-            sender.send(message=message)
+            sender.send(payload)
             logging.info(f'{name}: OK')
         except Exception as e:
             logging.error(f'{name}: Failed - {e}')